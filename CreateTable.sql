@@ -1,4 +1,4 @@
-DROP TABLE IF EXISTS tags, tagnames, likes, papers, users;
+DROP TABLE IF EXISTS user_tags, user_stats, recommendation_queue, recommendations, user_similarity, import_sources, extract_jobs, tag_pairs, tags, tagnames, likes, papers, blobs, users;
 
 CREATE TABLE IF NOT EXISTS users(
     username VARCHAR(50) NOT NULL,
@@ -6,6 +6,16 @@ CREATE TABLE IF NOT EXISTS users(
     PRIMARY KEY(username)
 );
 
+-- Uploaded pdf files by content, shared by every paper with the same file. ref_count is
+-- maintained by triggers on papers, data caches the text extracted from the file.
+CREATE TABLE IF NOT EXISTS blobs(
+    sha256 CHAR(64) NOT NULL,
+    size BIGINT NOT NULL,
+    ref_count INT NOT NULL DEFAULT 0,
+    data TEXT,
+    PRIMARY KEY(sha256)
+);
+
 CREATE TABLE IF NOT EXISTS papers(
     pid  SERIAL PRIMARY KEY,
     username VARCHAR(50) NOT NULL,
@@ -13,13 +23,53 @@ CREATE TABLE IF NOT EXISTS papers(
     begin_time TIMESTAMP NOT NULL,
     description VARCHAR(500),
     data TEXT,
-    FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
+    like_count INT NOT NULL DEFAULT 0,
+    -- Weighted search document: title > description > text
+    search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(description, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(data, '')), 'C')
+    ) STORED,
+    -- NULL for papers whose file is stored by pid
+    blob CHAR(64),
+    FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE,
+    FOREIGN KEY(blob) REFERENCES blobs
 );
 
-CREATE INDEX paper_text_idx ON papers USING gin(to_tsvector('english', data));
+CREATE INDEX paper_search_idx ON papers USING gin(search_vector);
+
+CREATE INDEX paper_like_count_idx ON papers(like_count DESC, pid ASC, begin_time) WHERE like_count > 0;
+
+-- Keyset pagination of the paper lists
+CREATE INDEX paper_time_idx ON papers(begin_time DESC, pid ASC);
+
+CREATE INDEX paper_user_time_idx ON papers(username, begin_time DESC, pid ASC);
+
+CREATE INDEX paper_blob_idx ON papers(blob) WHERE blob IS NOT NULL;
+
+CREATE OR REPLACE FUNCTION count_blob_refs() RETURNS trigger AS $$
+DECLARE
+    delta INT := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+BEGIN
+    UPDATE blobs b SET ref_count = b.ref_count + delta * c.count_papers
+    FROM (SELECT c.blob, COUNT(*) AS count_papers FROM changed_papers c
+          WHERE c.blob IS NOT NULL GROUP BY c.blob) c
+    WHERE b.sha256 = c.blob;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER papers_insert_blob_trigger AFTER INSERT ON papers
+    REFERENCING NEW TABLE AS changed_papers
+    FOR EACH STATEMENT EXECUTE PROCEDURE count_blob_refs();
+
+CREATE TRIGGER papers_delete_blob_trigger AFTER DELETE ON papers
+    REFERENCING OLD TABLE AS changed_papers
+    FOR EACH STATEMENT EXECUTE PROCEDURE count_blob_refs();
 
 CREATE TABLE IF NOT EXISTS tagnames(
     tagname VARCHAR(50) NOT NULL,
+    paper_count INT NOT NULL DEFAULT 0,
     PRIMARY KEY(tagname)
 );
 
@@ -32,6 +82,152 @@ CREATE TABLE IF NOT EXISTS likes(
     FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
 );
 
+CREATE INDEX like_user_idx ON likes(username, pid);
+
+-- Keep papers.like_count in sync with likes
+CREATE OR REPLACE FUNCTION count_likes() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE papers SET like_count = like_count + 1 WHERE pid = NEW.pid;
+    ELSE
+        UPDATE papers SET like_count = like_count - 1 WHERE pid = OLD.pid;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER likes_count_trigger AFTER INSERT OR DELETE ON likes
+    FOR EACH ROW EXECUTE PROCEDURE count_likes();
+
+-- Collaborative filtering: co-like counts between users over the papers with at most
+-- SIMILARITY_MAX_LIKERS likes, maintained by triggers on likes, and the precomputed top
+-- recommendations of each user
+CREATE TABLE IF NOT EXISTS user_similarity(
+    username VARCHAR(50) NOT NULL,
+    other VARCHAR(50) NOT NULL,
+    score INT NOT NULL,
+    PRIMARY KEY(username, other)
+);
+
+CREATE INDEX user_similarity_score_idx ON user_similarity(username, score DESC, other ASC);
+
+CREATE TABLE IF NOT EXISTS recommendations(
+    username VARCHAR(50) NOT NULL,
+    pid INT NOT NULL,
+    score INT NOT NULL,
+    PRIMARY KEY(username, pid),
+    FOREIGN KEY(pid) REFERENCES papers ON DELETE CASCADE,
+    FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
+);
+
+CREATE INDEX recommendations_score_idx ON recommendations(username, score DESC, pid ASC);
+
+CREATE TABLE IF NOT EXISTS recommendation_queue(
+    username VARCHAR(50) NOT NULL,
+    PRIMARY KEY(username)
+);
+
+-- SIMILARITY_MAX_LIKERS of constants.py, written by reset_db. The triggers and
+-- rebuild_user_similarity read the limit from here, so they always apply the same one.
+CREATE OR REPLACE FUNCTION similarity_max_likers() RETURNS INT AS $$
+    SELECT 100;
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION track_co_likes() RETURNS trigger AS $$
+DECLARE
+    -- A paper liked by more users says little about their tastes and would pair almost all of
+    -- them, so it does not count
+    max_likers CONSTANT INT := similarity_max_likers();
+    -- Changed papers with at most max_likers likes on both sides of the change, updated pair by pair
+    small INT[];
+    -- Changed papers crossing the limit, which add or take back all of their pairs
+    crossed INT[];
+BEGIN
+    -- One transaction at a time counts the changes of a paper, seeing the likes committed before
+    PERFORM pg_advisory_xact_lock(hashtext('track_co_likes'), c.pid)
+    FROM (SELECT DISTINCT l.pid FROM changed_likes l ORDER BY l.pid) c;
+
+    -- papers.like_count is already updated; a paper deleted with its likes has none left
+    SELECT array_agg(c.pid) FILTER (WHERE GREATEST(c.after, c.before) <= max_likers),
+           array_agg(c.pid) FILTER (WHERE LEAST(c.after, c.before) <= max_likers AND
+                                          GREATEST(c.after, c.before) > max_likers)
+    INTO small, crossed
+    FROM (
+        SELECT c.pid, COALESCE(MAX(p.like_count), 0) AS after,
+            COALESCE(MAX(p.like_count), 0) + (CASE WHEN TG_OP = 'INSERT' THEN -1 ELSE 1 END) * COUNT(*) AS before
+        FROM changed_likes c LEFT JOIN papers p ON p.pid = c.pid
+        GROUP BY c.pid
+    ) c;
+
+    IF TG_OP = 'INSERT' THEN
+        -- Pairs of users sharing a paper through at least one new like
+        INSERT INTO user_similarity (username, other, score)
+            SELECT a.username, b.username, COUNT(*)
+            FROM likes a JOIN likes b ON a.pid = b.pid AND a.username != b.username
+            WHERE a.pid = ANY(small) AND
+                ((a.pid, a.username) IN (SELECT c.pid, c.username FROM changed_likes c) OR
+                 (b.pid, b.username) IN (SELECT c.pid, c.username FROM changed_likes c))
+            GROUP BY a.username, b.username
+            ORDER BY a.username, b.username
+        ON CONFLICT (username, other) DO UPDATE SET score = user_similarity.score + EXCLUDED.score;
+        -- Papers grown too popular take back the pairs of their previous likers
+        INSERT INTO user_similarity (username, other, score)
+            SELECT a.username, b.username, -COUNT(*)
+            FROM likes a JOIN likes b ON a.pid = b.pid AND a.username != b.username
+            WHERE a.pid = ANY(crossed) AND
+                (a.pid, a.username) NOT IN (SELECT c.pid, c.username FROM changed_likes c) AND
+                (b.pid, b.username) NOT IN (SELECT c.pid, c.username FROM changed_likes c)
+            GROUP BY a.username, b.username
+            ORDER BY a.username, b.username
+        ON CONFLICT (username, other) DO UPDATE SET score = user_similarity.score + EXCLUDED.score;
+    ELSE
+        -- Same pairs, among the likes as they were before the delete
+        WITH before AS (
+            SELECT l.pid, l.username FROM likes l WHERE l.pid = ANY(small)
+            UNION ALL
+            SELECT c.pid, c.username FROM changed_likes c WHERE c.pid = ANY(small)
+        )
+        INSERT INTO user_similarity (username, other, score)
+            SELECT a.username, b.username, -COUNT(*)
+            FROM before a JOIN before b ON a.pid = b.pid AND a.username != b.username
+            WHERE (a.pid, a.username) IN (SELECT c.pid, c.username FROM changed_likes c) OR
+                (b.pid, b.username) IN (SELECT c.pid, c.username FROM changed_likes c)
+            GROUP BY a.username, b.username
+            ORDER BY a.username, b.username
+        ON CONFLICT (username, other) DO UPDATE SET score = user_similarity.score + EXCLUDED.score;
+        -- Papers back under the limit give the pairs of their remaining likers
+        INSERT INTO user_similarity (username, other, score)
+            SELECT a.username, b.username, COUNT(*)
+            FROM likes a JOIN likes b ON a.pid = b.pid AND a.username != b.username
+            WHERE a.pid = ANY(crossed)
+            GROUP BY a.username, b.username
+            ORDER BY a.username, b.username
+        ON CONFLICT (username, other) DO UPDATE SET score = user_similarity.score + EXCLUDED.score;
+    END IF;
+    -- Pairs are symmetric, so every emptied pair has one of these users on its left
+    DELETE FROM user_similarity s
+    WHERE s.score <= 0 AND s.username IN (
+        SELECT c.username FROM changed_likes c
+        UNION
+        SELECT l.username FROM likes l WHERE l.pid = ANY(small) OR l.pid = ANY(crossed));
+    -- The likers and everyone whose pairs changed, at most max_likers per paper
+    INSERT INTO recommendation_queue (username)
+        SELECT c.username FROM changed_likes c
+        UNION
+        SELECT l.username FROM likes l WHERE l.pid = ANY(small) OR l.pid = ANY(crossed)
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER likes_insert_similarity_trigger AFTER INSERT ON likes
+    REFERENCING NEW TABLE AS changed_likes
+    FOR EACH STATEMENT EXECUTE PROCEDURE track_co_likes();
+
+CREATE TRIGGER likes_delete_similarity_trigger AFTER DELETE ON likes
+    REFERENCING OLD TABLE AS changed_likes
+    FOR EACH STATEMENT EXECUTE PROCEDURE track_co_likes();
+
 CREATE TABLE IF NOT EXISTS tags(
     pid INT NOT NULL,
     tagname VARCHAR(50) NOT NULL,
@@ -40,6 +236,206 @@ CREATE TABLE IF NOT EXISTS tags(
     FOREIGN KEY(tagname) REFERENCES tagnames ON DELETE CASCADE
 );
 
+CREATE INDEX tag_name_idx ON tags(tagname, pid);
+
+-- Paper counts of tags and tag pairs (tag1 < tag2), maintained by triggers on tags
+CREATE INDEX tagname_count_idx ON tagnames(paper_count DESC, tagname ASC) WHERE paper_count > 0;
+
+CREATE TABLE IF NOT EXISTS tag_pairs(
+    tag1 VARCHAR(50) NOT NULL,
+    tag2 VARCHAR(50) NOT NULL,
+    paper_count INT NOT NULL,
+    PRIMARY KEY(tag1, tag2),
+    CHECK(tag1 < tag2)
+);
+
+CREATE INDEX tag_pairs_count_idx ON tag_pairs(paper_count DESC, tag1 ASC, tag2 ASC);
+
+CREATE INDEX tag_pairs_tag2_idx ON tag_pairs(tag2, tag1);
+
+CREATE OR REPLACE FUNCTION track_tags() RETURNS trigger AS $$
+DECLARE
+    delta INT := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+BEGIN
+    -- Concurrent uploads and imports sharing tags lock their rows in the same order
+    PERFORM 1 FROM tagnames n WHERE n.tagname IN (SELECT c.tagname FROM changed_tags c)
+    ORDER BY n.tagname FOR NO KEY UPDATE;
+
+    UPDATE tagnames n SET paper_count = n.paper_count + delta * c.count_papers
+    FROM (SELECT c.tagname, COUNT(*) AS count_papers FROM changed_tags c GROUP BY c.tagname) c
+    WHERE n.tagname = c.tagname;
+
+    -- Pairs of tags on the changed papers with at least one changed tag, counted once,
+    -- among the tags as they are after an insert or as they were before a delete
+    WITH paper_tags AS (
+        SELECT t.pid, t.tagname FROM tags t WHERE t.pid IN (SELECT c.pid FROM changed_tags c)
+        UNION ALL
+        SELECT c.pid, c.tagname FROM changed_tags c WHERE TG_OP = 'DELETE'
+    ), changed_pairs AS (
+        SELECT a.tagname AS tag1, b.tagname AS tag2, COUNT(*) AS count_papers
+        FROM paper_tags a JOIN paper_tags b ON a.pid = b.pid AND a.tagname < b.tagname
+        WHERE (a.pid, a.tagname) IN (SELECT c.pid, c.tagname FROM changed_tags c) OR
+            (b.pid, b.tagname) IN (SELECT c.pid, c.tagname FROM changed_tags c)
+        GROUP BY a.tagname, b.tagname
+    )
+    INSERT INTO tag_pairs (tag1, tag2, paper_count)
+        SELECT p.tag1, p.tag2, delta * p.count_papers FROM changed_pairs p ORDER BY p.tag1, p.tag2
+    ON CONFLICT (tag1, tag2) DO UPDATE SET paper_count = tag_pairs.paper_count + EXCLUDED.paper_count;
+
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM tag_pairs p
+        WHERE p.paper_count <= 0 AND (p.tag1 IN (SELECT c.tagname FROM changed_tags c) OR
+                                      p.tag2 IN (SELECT c.tagname FROM changed_tags c));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tags_insert_count_trigger AFTER INSERT ON tags
+    REFERENCING NEW TABLE AS changed_tags
+    FOR EACH STATEMENT EXECUTE PROCEDURE track_tags();
+
+CREATE TRIGGER tags_delete_count_trigger AFTER DELETE ON tags
+    REFERENCING OLD TABLE AS changed_tags
+    FOR EACH STATEMENT EXECUTE PROCEDURE track_tags();
+
+CREATE TABLE IF NOT EXISTS extract_jobs(
+    pid INT NOT NULL,
+    file_path TEXT NOT NULL,
+    state VARCHAR(16) NOT NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    error TEXT,
+    update_time TIMESTAMP NOT NULL,
+    PRIMARY KEY(pid),
+    FOREIGN KEY(pid) REFERENCES papers ON DELETE CASCADE
+);
+
+CREATE INDEX extract_jobs_state_idx ON extract_jobs(state);
+
+CREATE TABLE IF NOT EXISTS import_sources(
+    source TEXT NOT NULL,
+    pid INT NOT NULL,
+    PRIMARY KEY(source),
+    FOREIGN KEY(pid) REFERENCES papers ON DELETE CASCADE
+);
+
+-- Per user statistics and the paper count of each tag a user has used, maintained by
+-- triggers on papers, likes and tags
+CREATE TABLE IF NOT EXISTS user_stats(
+    username VARCHAR(50) NOT NULL,
+    paper_count INT NOT NULL DEFAULT 0,
+    like_count INT NOT NULL DEFAULT 0,
+    tag_count INT NOT NULL DEFAULT 0,
+    PRIMARY KEY(username),
+    FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
+);
+
+CREATE INDEX user_stats_paper_count_idx ON user_stats(paper_count DESC, username ASC) WHERE paper_count > 0;
+
+CREATE TABLE IF NOT EXISTS user_tags(
+    username VARCHAR(50) NOT NULL,
+    tagname VARCHAR(50) NOT NULL,
+    paper_count INT NOT NULL,
+    PRIMARY KEY(username, tagname),
+    FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
+);
+
+CREATE OR REPLACE FUNCTION track_user_papers() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO user_stats (username, paper_count)
+            SELECT c.username, COUNT(*) FROM changed_papers c GROUP BY c.username
+        ON CONFLICT (username) DO UPDATE SET paper_count = user_stats.paper_count + EXCLUDED.paper_count;
+    ELSE
+        UPDATE user_stats s SET paper_count = s.paper_count - c.count_papers
+        FROM (SELECT c.username, COUNT(*) AS count_papers FROM changed_papers c GROUP BY c.username) c
+        WHERE s.username = c.username;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER papers_insert_stats_trigger AFTER INSERT ON papers
+    REFERENCING NEW TABLE AS changed_papers
+    FOR EACH STATEMENT EXECUTE PROCEDURE track_user_papers();
+
+CREATE TRIGGER papers_delete_stats_trigger AFTER DELETE ON papers
+    REFERENCING OLD TABLE AS changed_papers
+    FOR EACH STATEMENT EXECUTE PROCEDURE track_user_papers();
+
+CREATE OR REPLACE FUNCTION uncount_paper_tags() RETURNS trigger AS $$
+BEGIN
+    -- The tags of the paper are still there, the cascade deletes them after the paper
+    UPDATE user_tags u SET paper_count = u.paper_count - 1
+    WHERE u.username = OLD.username AND u.tagname IN (SELECT t.tagname FROM tags t WHERE t.pid = OLD.pid);
+    DELETE FROM user_tags u WHERE u.username = OLD.username AND u.paper_count <= 0;
+    UPDATE user_stats s SET tag_count = (SELECT COUNT(*) FROM user_tags u WHERE u.username = s.username)
+    WHERE s.username = OLD.username;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER papers_delete_tags_trigger BEFORE DELETE ON papers
+    FOR EACH ROW EXECUTE PROCEDURE uncount_paper_tags();
+
+CREATE OR REPLACE FUNCTION track_user_likes() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO user_stats (username, like_count)
+            SELECT c.username, COUNT(*) FROM changed_likes c GROUP BY c.username
+        ON CONFLICT (username) DO UPDATE SET like_count = user_stats.like_count + EXCLUDED.like_count;
+    ELSE
+        UPDATE user_stats s SET like_count = s.like_count - c.count_likes
+        FROM (SELECT c.username, COUNT(*) AS count_likes FROM changed_likes c GROUP BY c.username) c
+        WHERE s.username = c.username;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER likes_insert_stats_trigger AFTER INSERT ON likes
+    REFERENCING NEW TABLE AS changed_likes
+    FOR EACH STATEMENT EXECUTE PROCEDURE track_user_likes();
+
+CREATE TRIGGER likes_delete_stats_trigger AFTER DELETE ON likes
+    REFERENCING OLD TABLE AS changed_likes
+    FOR EACH STATEMENT EXECUTE PROCEDURE track_user_likes();
+
+CREATE OR REPLACE FUNCTION track_user_tags() RETURNS trigger AS $$
+DECLARE
+    delta INT := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+    owners VARCHAR(50)[];
+BEGIN
+    -- Only tags of papers that still exist, uncount_paper_tags handles a deleted paper
+    SELECT array_agg(DISTINCT p.username) INTO owners
+    FROM changed_tags c JOIN papers p ON p.pid = c.pid;
+    IF owners IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO user_tags (username, tagname, paper_count)
+        SELECT p.username, c.tagname, delta * COUNT(*)
+        FROM changed_tags c JOIN papers p ON p.pid = c.pid
+        GROUP BY p.username, c.tagname
+    ON CONFLICT (username, tagname) DO UPDATE SET paper_count = user_tags.paper_count + EXCLUDED.paper_count;
+    DELETE FROM user_tags u WHERE u.username = ANY(owners) AND u.paper_count <= 0;
+
+    INSERT INTO user_stats (username, tag_count)
+        SELECT o.username, (SELECT COUNT(*) FROM user_tags u WHERE u.username = o.username)
+        FROM unnest(owners) AS o(username)
+    ON CONFLICT (username) DO UPDATE SET tag_count = EXCLUDED.tag_count;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tags_insert_stats_trigger AFTER INSERT ON tags
+    REFERENCING NEW TABLE AS changed_tags
+    FOR EACH STATEMENT EXECUTE PROCEDURE track_user_tags();
+
+CREATE TRIGGER tags_delete_stats_trigger AFTER DELETE ON tags
+    REFERENCING OLD TABLE AS changed_tags
+    FOR EACH STATEMENT EXECUTE PROCEDURE track_user_tags();
+
 
 
 
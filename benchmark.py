@@ -0,0 +1,425 @@
+"""
+Benchmark of the APIs of functions.py on a synthetic dataset.
+
+Usage:
+    python -m paper.benchmark --papers 100000 [--concurrency 8] [--calls 500] [--output run.json]
+    python -m paper.benchmark --compare old.json new.json
+
+WARNING: unless --no-load is given, the database is reset and filled with generated data.
+
+The dataset scales with --papers (10^3 to 10^6 is practical): one user per PAPERS_PER_USER papers,
+each posting a Zipf distributed share of them, TAGS_PER_PAPER tags per paper drawn from a Zipf
+distributed vocabulary and LIKES_PER_PAPER likes per paper, also Zipf distributed over papers.
+Likes are loaded with the similarity triggers off and user_similarity is rebuilt once at the
+end; papers over SIMILARITY_MAX_LIKERS likes, i.e. the head of the Zipf distribution, do not
+count, which keeps it to a few tens of millions of pairs at 10^6 papers.
+The fixtures of simple_checker (users, tags and texts) are part of it. Every API of
+simple_checker.ALL_FUNCS that can run repeatedly is then called --calls times from --concurrency
+threads through simple_checker.db_wrapper_debug, and its throughput and latency percentiles
+are reported. Results are saved as json; --compare prints the change between two runs and
+exits with 1 if an API got slower than --threshold.
+"""
+
+# Import necessary packages
+import paper.database_wrapper as db_wrapper
+import paper.functions as funcs
+import paper.cache as cache
+import paper.simple_checker as checker
+from paper.constants import *
+
+import argparse
+import bisect
+import datetime
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+
+
+"""
+Benchmark constants
+"""
+
+PAPERS_PER_USER = 20
+TAGS_PER_PAPER = 3
+LIKES_PER_PAPER = 5
+TAG_VOCABULARY = 1000
+ZIPF_EXPONENT = 1.1
+LOAD_BATCH_SIZE = 10000
+PERCENTILES = [50, 90, 95, 99]
+
+# APIs of ALL_FUNCS that are not benchmarked: they wipe or rebuild the data, or drive the
+# extraction job state machine, which needs a pdf for every call
+SKIPPED_FUNCS = ['reset_db', 'repair_like_counts', 'repair_tag_counts', 'repair_user_stats',
+                 'add_extract_job', 'fail_extract_job', 'retry_extract_job', 'finish_extract_job']
+
+
+class ZipfSampler(object):
+    """
+    Draw indexes of $n items, item i with a probability proportional to 1 / (i + 1) ** s
+    """
+
+    def __init__(self, n, s = ZIPF_EXPONENT):
+        self.cumulative = []
+        total = 0.0
+        for i in range(n):
+            total += 1.0 / (i + 1) ** s
+            self.cumulative.append(total)
+        self.total = total
+
+    def sample(self, rng):
+        return bisect.bisect_left(self.cumulative, rng.random() * self.total)
+
+
+class Dataset(object):
+    """
+    A synthetic dataset of $papers papers, generated deterministically from $seed
+    """
+
+    def __init__(self, papers, seed = 0):
+        self.papers = papers
+        self.seed = seed
+        self.users = checker.USERS + ["user%d" % i for i in range(max(papers // PAPERS_PER_USER, 1))]
+        self.tags = checker.TAGS + ["tag%d" % i for i in range(len(checker.TAGS) + 1, TAG_VOCABULARY + 1)]
+        # Search keywords, without stop words like "a" or "i"
+        self.words = sorted(set(w.strip(".-> ").lower() for text in checker.TEXTS for w in text.split()
+                                if len(w.strip(".-> ")) > 2))
+        self.user_sampler = ZipfSampler(len(self.users))
+        self.tag_sampler = ZipfSampler(len(self.tags))
+        self.paper_sampler = ZipfSampler(papers)
+        # Filled in by load or by read_pids
+        self.pids = []
+        self.likes = 0
+
+    def user(self, rng):
+        return self.users[self.user_sampler.sample(rng)]
+
+    def tag(self, rng):
+        return self.tags[self.tag_sampler.sample(rng)]
+
+    def pid(self, rng):
+        return self.pids[self.paper_sampler.sample(rng) % len(self.pids)]
+
+    def paper_rows(self, rng, count):
+        """
+        Generate $count papers as (uname, title, begin_time, desc, text, tags), oldest first
+        """
+        start = datetime.datetime.now() - datetime.timedelta(days=30)
+        step = datetime.timedelta(days=30) / max(self.papers, 1)
+        for i in range(count):
+            text = " ".join(rng.choice(checker.TEXTS) for j in range(rng.randint(1, 5)))
+            tags = list(set(self.tag(rng) for j in range(TAGS_PER_PAPER)))
+            yield (self.user(rng), "paper %d" % i, (start + step * i).strftime("%Y-%m-%d %H:%M:%S.%f"),
+                   checker.DESCS[0], text, tags)
+
+
+def load_rows(conn, table, columns, rows):
+    """
+    Load rows into a table with COPY and commit
+
+    :return: (status, retval)
+        (0, None)   Success
+    """
+    cur = conn.cursor()
+    funcs.copy_rows(cur, table, columns, rows)
+    conn.commit()
+    return 0, None
+
+
+def set_similarity_triggers(conn, enabled):
+    """
+    Turn the triggers on likes maintaining user_similarity on or off, e.g. around a bulk load
+    followed by funcs.rebuild_user_similarity
+
+    :return: (status, retval)
+        (0, None)   Success
+    """
+    cur = conn.cursor()
+    for trigger in ("likes_insert_similarity_trigger", "likes_delete_similarity_trigger"):
+        cur.execute("""ALTER TABLE likes %s TRIGGER %s;""" % ("ENABLE" if enabled else "DISABLE", trigger))
+    conn.commit()
+    return 0, None
+
+
+def read_pids(conn):
+    """
+    Get the pids of all papers
+    """
+    cur = conn.cursor()
+    cur.execute("""SELECT p.pid FROM papers p ORDER BY p.pid ASC;""")
+    return 0, [item[0] for item in cur.fetchall()]
+
+
+def check(status, what):
+    if status != SUCCESS:
+        print "[Error] Can not %s" % what
+        sys.exit(1)
+
+
+def load(data):
+    """
+    Reset the database and load the dataset
+    """
+    rng = random.Random(data.seed)
+    start = time.time()
+    check(checker.db_wrapper_debug(funcs.reset_db, {})[0], "reset the database")
+    status, conn = db_wrapper.get_db_connection()
+    check(status, "connect to the database")
+    try:
+        check(db_wrapper.call_db_with_conn(conn, load_rows, {
+            'table':"users", 'columns':("username", "password"),
+            'rows':[(uname, uname) for uname in data.users]})[0], "load users")
+        print "[Load] %d users" % len(data.users)
+
+        papers = data.paper_rows(rng, data.papers)
+        owners = dict()
+        loaded = 0
+        while loaded < data.papers:
+            batch = list(itertools.islice(papers, LOAD_BATCH_SIZE))
+            status, pids = db_wrapper.call_db_with_conn(conn, funcs.reserve_paper_ids, {'count':len(batch)})
+            check(status, "reserve pids")
+            rows = [(pid, "benchmark:%d" % pid) + row for pid, row in zip(pids, batch)]
+            check(db_wrapper.call_db_with_conn(conn, funcs.bulk_add_papers, {'papers':rows})[0], "load papers")
+            data.pids.extend(pids)
+            owners.update((pid, row[0]) for pid, row in zip(pids, batch))
+            loaded += len(batch)
+            print "[Load] %d/%d papers" % (loaded, data.papers)
+
+        # Users do not like their own papers
+        likes = set()
+        for i in range(data.papers * LIKES_PER_PAPER):
+            pid, uname = data.pid(rng), rng.choice(data.users)
+            if owners[pid] != uname:
+                likes.add((pid, uname))
+        likes = sorted(likes)
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        # Pairing every batch with all the likes before it would cost a self join per batch
+        check(db_wrapper.call_db_with_conn(conn, set_similarity_triggers, {'enabled':False})[0],
+              "disable the similarity triggers")
+        try:
+            for i in range(0, len(likes), LOAD_BATCH_SIZE):
+                check(db_wrapper.call_db_with_conn(conn, load_rows, {
+                    'table':"likes", 'columns':("pid", "username", "like_time"),
+                    'rows':[(pid, uname, now) for pid, uname in likes[i:i + LOAD_BATCH_SIZE]]})[0], "load likes")
+                print "[Load] %d/%d likes" % (min(i + LOAD_BATCH_SIZE, len(likes)), len(likes))
+        finally:
+            conn.rollback()
+            check(db_wrapper.call_db_with_conn(conn, set_similarity_triggers, {'enabled':True})[0],
+                  "enable the similarity triggers")
+        data.likes = len(likes)
+        status, pairs = db_wrapper.call_db_with_conn(conn, funcs.rebuild_user_similarity, {})
+        check(status, "rebuild user similarity")
+        print "[Load] %d similar user pairs" % pairs
+
+        refreshed = 1
+        while refreshed > 0:
+            status, refreshed = db_wrapper.call_db_with_conn(conn, funcs.refresh_queued_recommendations, {})
+            check(status, "refresh recommendations")
+    finally:
+        db_wrapper.close_db_connection(conn)
+    print "[Load] done in %.1fs" % (time.time() - start)
+
+
+def make_workload(data):
+    """
+    Build the argument generator of every benchmarked API. Each takes a random.Random and
+    returns the argdict of one call, or None if there is nothing to call right now.
+    """
+    begin_time = (datetime.datetime.now() - datetime.timedelta(days=14)).replace(second=0, microsecond=0)
+    new_users = itertools.count()
+    # pids of the papers added by add_new_paper, deleted by delete_paper
+    added = []
+    added_lock = threading.Lock()
+
+    def new_paper(rng):
+        uname, title, begin_time, desc, text, tags = next(data.paper_rows(rng, 1))
+        return {'uname':uname, 'title':"benchmark", 'desc':desc, 'text':text, 'tags':tags}
+
+    def added_pid(rng):
+        with added_lock:
+            return {'pid':added.pop()} if added else None
+
+    workload = {
+        'signup': lambda rng: {'uname':"bench%d_%d" % (data.seed, next(new_users)), 'pwd':"bench"},
+        'login': lambda rng: dict.fromkeys(['uname', 'pwd'], data.user(rng)),
+        'add_new_paper': new_paper,
+        'delete_paper': added_pid,
+        'get_paper_tags': lambda rng: {'pid':data.pid(rng)},
+        'get_likes': lambda rng: {'pid':data.pid(rng)},
+        'get_likes_tags_batch': lambda rng: {'pids':[data.pid(rng) for i in range(30)]},
+        'like_paper': lambda rng: {'uname':data.user(rng), 'pid':data.pid(rng)},
+        'unlike_paper': lambda rng: {'uname':data.user(rng), 'pid':data.pid(rng)},
+        'get_timeline': lambda rng: {'uname':data.user(rng)},
+        'get_timeline_all': lambda rng: {},
+        'get_papers_by_tag': lambda rng: {'tag':data.tag(rng)},
+        'get_papers_by_keyword': lambda rng: {'keyword':rng.choice(data.words), 'rank':rng.random() < 0.5},
+        'get_papers_by_liked': lambda rng: {'uname':data.user(rng)},
+        'get_most_popular_papers': lambda rng: {'begin_time':begin_time},
+        'get_recommend_papers': lambda rng: {'uname':data.user(rng)},
+        'refresh_queued_recommendations': lambda rng: {},
+        'get_most_active_users': lambda rng: {},
+        'get_most_popular_tags': lambda rng: {},
+        'get_most_popular_tag_pairs': lambda rng: {},
+        'get_related_tags': lambda rng: {'tag':data.tag(rng)},
+        'get_number_papers_user': lambda rng: {'uname':data.user(rng)},
+        'get_number_liked_user': lambda rng: {'uname':data.user(rng)},
+        'get_number_tags_user': lambda rng: {'uname':data.user(rng)},
+        'get_user_stats': lambda rng: {'uname':data.user(rng)},
+        'get_extract_job': lambda rng: {'pid':data.pid(rng)},
+        'home_page_bundle': lambda rng: {'uname':data.user(rng)},
+    }
+    return workload, added
+
+
+def percentile(values, p):
+    """
+    The $p-th percentile of sorted $values, by the nearest rank
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))]
+
+
+def bench_api(name, make_args, calls, concurrency, seed, on_result = None):
+    """
+    Call API $name $calls times from $concurrency threads
+
+    :return: A dict of throughput (calls/s), latencies (ms) and errors
+    """
+    func = getattr(funcs, name)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = itertools.count(calls, -1)
+
+    def worker(index):
+        rng = random.Random("%s:%s:%d" % (seed, name, index))
+        while next(remaining) > 0:
+            args = make_args(rng)
+            if args is None:
+                continue
+            start = time.time()
+            status, res = checker.db_wrapper_debug(func, args)
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed * 1000.0)
+                if status != SUCCESS:
+                    errors[0] += 1
+            if on_result is not None and status == SUCCESS:
+                on_result(res)
+
+    threads = [threading.Thread(target=worker, args=(i, )) for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = max(time.time() - start, 1e-9)
+
+    latencies.sort()
+    res = {'calls': len(latencies), 'errors': errors[0], 'seconds': wall,
+           'throughput': len(latencies) / wall,
+           'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+           'max_ms': latencies[-1] if latencies else None}
+    for p in PERCENTILES:
+        res['p%d_ms' % p] = percentile(latencies, p)
+    return res
+
+
+def run(data, calls, concurrency, only = None):
+    """
+    Benchmark every API of ALL_FUNCS that has a workload
+
+    :return: ({api name: result of bench_api}, [names of APIs not benchmarked])
+    """
+    workload, added = make_workload(data)
+    results = dict()
+    skipped = []
+    # add_new_paper before delete_paper, which deletes what it added
+    names = sorted(checker.ALL_FUNCS, key=lambda name: (name == 'delete_paper', name))
+    for name in names:
+        if (only and name not in only) or name in SKIPPED_FUNCS or name not in workload:
+            skipped.append(name)
+            continue
+        on_result = added.append if name == 'add_new_paper' else None
+        results[name] = bench_api(name, workload[name], calls, concurrency, data.seed, on_result)
+        print "[Bench] %s" % format_result(name, results[name])
+    return results, skipped
+
+
+def format_result(name, res):
+    if not res['calls']:
+        return "%-32s no calls" % name
+    return ("%-32s %8.1f calls/s  p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  %d errors" %
+            (name, res['throughput'], res['p50_ms'], res['p95_ms'], res['p99_ms'], res['errors']))
+
+
+def compare(old_path, new_path, threshold):
+    """
+    Print the change of every API between two saved runs
+
+    :return: The names of the APIs whose p95 latency grew by more than $threshold times
+    """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print "old: %s" % json.dumps(old['meta'], sort_keys=True)
+    print "new: %s" % json.dumps(new['meta'], sort_keys=True)
+    regressions = []
+    for name in sorted(set(old['results']) & set(new['results'])):
+        a, b = old['results'][name], new['results'][name]
+        if not a['calls'] or not b['calls']:
+            continue
+        ratio = b['p95_ms'] / a['p95_ms'] if a['p95_ms'] else float('inf')
+        flag = ""
+        if ratio > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print ("%-32s p95 %8.2fms -> %8.2fms (x%.2f)  throughput %8.1f -> %8.1f calls/s%s" %
+               (name, a['p95_ms'], b['p95_ms'], ratio, a['throughput'], b['throughput'], flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the APIs of functions.py")
+    parser.add_argument("--papers", type=int, default=1000, help="size of the generated dataset")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-load", action="store_true", help="reuse the dataset loaded by a previous run")
+    parser.add_argument("--calls", type=int, default=200, help="calls per API")
+    parser.add_argument("--concurrency", type=int, default=4, help="threads calling each API")
+    parser.add_argument("--only", default="", help="comma separated APIs to benchmark, default all")
+    parser.add_argument("--no-cache", action="store_true", help="disable the result cache of read APIs")
+    parser.add_argument("--output", help="save the results to this json file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two saved runs")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="p95 growth reported as a regression by --compare")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    if args.no_cache:
+        cache.CACHE_ENABLED = False
+    data = Dataset(args.papers, args.seed)
+    if args.no_load:
+        status, data.pids = db_wrapper.call_db(read_pids, {})
+        check(status, "read the dataset")
+        if not data.pids:
+            print "[Error] The database is empty, run without --no-load first"
+            sys.exit(1)
+    else:
+        load(data)
+
+    results, skipped = run(data, args.calls, args.concurrency, [x for x in args.only.split(",") if x])
+    report = {'meta': {'papers': len(data.pids), 'users': len(data.users), 'likes': data.likes,
+                       'seed': args.seed, 'calls': args.calls, 'concurrency': args.concurrency,
+                       'cache': not args.no_cache, 'time': datetime.datetime.now().isoformat()},
+              'results': results,
+              'skipped': skipped}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print "[Done] results saved to %s" % args.output
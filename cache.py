@@ -0,0 +1,288 @@
+"""
+Result cache for read APIs of functions.py.
+
+A read API is wrapped with @cached(ttl) and a write API with @invalidates(name, ...).
+Every cached API has its own key namespace with a version number kept in the backend;
+invalidating an API bumps its version, so all of its entries are dropped at once without
+having to know their arguments, and other processes sharing the backend see it too.
+Single items, e.g. the rendered card of a paper (fragments.py), are versioned the same way
+with get_item_versions and bump_items.
+
+Two backends are provided:
+    LocalCache      In process, TTL plus LRU eviction. The default. Invalidations only
+                    reach the process making them: other workers keep serving their own
+                    results for up to CACHE_TTL seconds after a write.
+    DjangoCache     Any cache configured in Django's CACHES (memcached, redis, ...), shared
+                    by all workers. LocMemCache can stand in for it in tests.
+"""
+
+import copy
+import functools
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from constants import *
+
+
+class LocalCache(object):
+    """
+    A thread safe in process cache with per entry TTL and LRU eviction
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> (expire time, value), least recently used first
+        self._data = OrderedDict()
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return default
+            if item[0] is not None and item[0] < time.time():
+                return default
+            self._data[key] = item
+            return copy.deepcopy(item[1])
+
+    def get_many(self, keys):
+        res = dict()
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                res[key] = value
+        return res
+
+    def set(self, key, value, timeout=None):
+        expire = time.time() + timeout if timeout else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expire, copy.deepcopy(value))
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def set_many(self, data, timeout=None):
+        for key, value in data.items():
+            self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DjangoCache(object):
+    """
+    Adapter to a cache of Django's cache framework, shared across processes
+    """
+
+    def __init__(self, alias=CACHE_DJANGO_ALIAS):
+        from django.core.cache import caches
+        self._cache = caches[alias]
+
+    def get(self, key, default=None):
+        return self._cache.get(key, default)
+
+    def get_many(self, keys):
+        return self._cache.get_many(keys)
+
+    def set(self, key, value, timeout=None):
+        self._cache.set(key, value, timeout)
+
+    def set_many(self, data, timeout=None):
+        self._cache.set_many(data, timeout)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+    def clear(self):
+        self._cache.clear()
+
+
+BACKENDS = {
+    'local': LocalCache,
+    'django': DjangoCache,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+_stats_lock = threading.Lock()
+# api name -> [hits, misses]
+_stats = {}
+
+
+def get_backend():
+    """
+    Get the cache backend selected by CACHE_BACKEND
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = BACKENDS[CACHE_BACKEND]()
+        return _backend
+
+
+def set_backend(backend):
+    """
+    Use the given backend from now on, e.g. a DjangoCache or a LocalCache in tests
+    """
+    global _backend
+    with _backend_lock:
+        _backend = backend
+
+
+def _version_key(name):
+    return "paper:version:%s" % name
+
+
+def _get_version(backend, name):
+    version = backend.get(_version_key(name))
+    if version is None:
+        # Start from the current time so that a restarted local cache never reuses a version
+        version = int(time.time() * 1000)
+        backend.set(_version_key(name), version)
+    return version
+
+
+def _count(name, hit):
+    with _stats_lock:
+        counts = _stats.setdefault(name, [0, 0])
+        counts[0 if hit else 1] += 1
+
+
+def _maybe_stale(conn, version):
+    """
+    Tell if a result read from a replica may miss the change that set $version, a time in
+    milliseconds: it would then be cached under the new version for the whole TTL
+    """
+    return getattr(conn, 'replica', False) and time.time() * 1000 - version < DB_REPLICA_MAX_LAG * 1000
+
+
+def cached(ttl=CACHE_TTL):
+    """
+    Cache the (0, res) results of an API for $ttl seconds, keyed by its arguments.
+    Failures are never cached, nor results of a replica that may predate the latest invalidation.
+    """
+    def decorator(func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(conn, *args, **kwargs):
+            if not CACHE_ENABLED:
+                return func(conn, *args, **kwargs)
+            backend = get_backend()
+            version = _get_version(backend, name)
+            key = "paper:%s:%s:%s" % (name, version, hashlib.md5(repr((args, sorted(kwargs.items())))).hexdigest())
+            res = backend.get(key)
+            if res is not None:
+                _count(name, True)
+                return SUCCESS, res
+            _count(name, False)
+            status, res = func(conn, *args, **kwargs)
+            if status == SUCCESS and res is not None and not _maybe_stale(conn, version):
+                backend.set(key, res, ttl)
+            return status, res
+        return wrapper
+    return decorator
+
+
+def invalidate(*names):
+    """
+    Drop every cached result of the given APIs. The new version is also the time of the
+    change in milliseconds, see get_change_token.
+    """
+    backend = get_backend()
+    for name in names:
+        backend.set(_version_key(name), max(_get_version(backend, name) + 1, int(time.time() * 1000)))
+
+
+def get_change_token(names):
+    """
+    Get a token that changes whenever one of the given APIs is invalidated, and the time of
+    the latest change, e.g. to validate a page showing their results without computing it.
+    A local backend does not see the invalidations of other processes, so its token also
+    changes every CACHE_TTL seconds, as its cached results do.
+
+    :return: (token, seconds since the epoch)
+    """
+    backend = get_backend()
+    versions = [_get_version(backend, name) for name in names]
+    changed = max(versions) / 1000.0 if versions else 0.0
+    if isinstance(backend, LocalCache):
+        bucket = int(time.time() // CACHE_TTL) * CACHE_TTL
+        versions.append(bucket)
+        changed = max(changed, bucket)
+    return hashlib.md5(repr(versions)).hexdigest(), changed
+
+
+def invalidates(*names):
+    """
+    Invalidate the given APIs after a successful call of the decorated write API
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(conn, *args, **kwargs):
+            status, res = func(conn, *args, **kwargs)
+            if status == SUCCESS and CACHE_ENABLED:
+                invalidate(*names)
+            return status, res
+        return wrapper
+    return decorator
+
+
+def _new_item_version():
+    return uuid.uuid4().hex[:16]
+
+
+def _item_version_key(namespace, key):
+    return "paper:version:%s:%s" % (namespace, key)
+
+
+def get_item_versions(namespace, keys):
+    """
+    Get the version of every item of a namespace, e.g. of every paper of a page,
+    in one round trip to the backend
+
+    :return: A dict of key -> version
+    """
+    backend = get_backend()
+    version_keys = dict((_item_version_key(namespace, key), key) for key in keys)
+    found = backend.get_many(list(version_keys))
+    res = dict((version_keys[version_key], version) for version_key, version in found.items())
+    missing = dict((version_key, _new_item_version()) for version_key in version_keys
+                   if version_key not in found)
+    if missing:
+        backend.set_many(missing)
+        res.update((version_keys[version_key], version) for version_key, version in missing.items())
+    return res
+
+
+def bump_items(namespace, keys):
+    """
+    Drop everything cached for the given items of a namespace by giving them new versions.
+    Versions are only compared for equality, so concurrent bumps need not read them first.
+    """
+    if not CACHE_ENABLED or not keys:
+        return
+    get_backend().set_many(dict((_item_version_key(namespace, key), _new_item_version()) for key in keys))
+
+
+def get_cache_stats():
+    """
+    Get the hits, misses and hit ratio of every cached API
+    """
+    with _stats_lock:
+        res = dict()
+        for name, (hits, misses) in _stats.items():
+            total = hits + misses
+            res[name] = {'hits': hits, 'misses': misses,
+                         'hit_ratio': float(hits) / total if total else 0.0}
+        return res
@@ -11,7 +11,31 @@ COOKIE_USERNAME_FLAG = "uname"
 DB_FILE = os.path.abspath(os.getcwd()) + "/hw7.db"
 
 # Postgres
-DB_DESC = "dbname=%s user=%s" % (DBNAME, DBNAME)
+DB_DESC = os.environ.get("DB_DESC", "dbname=%s user=%s" % (DBNAME, DBNAME))
+# Read replicas of DB_DESC, libpq connection strings separated by ";", see database_wrapper.py
+DB_REPLICA_DESCS = [desc.strip() for desc in os.environ.get("DB_REPLICA_DESCS", "").split(";") if desc.strip()]
+# Replicas further behind the primary than this many seconds are not read from
+DB_REPLICA_MAX_LAG = float(os.environ.get("DB_REPLICA_MAX_LAG", 5))
+# Seconds between two lag checks of a replica, and that a failed replica is left out
+DB_REPLICA_CHECK_INTERVAL = float(os.environ.get("DB_REPLICA_CHECK_INTERVAL", 1))
+# Seconds a user keeps reading from the primary after a write of their own
+DB_READ_YOUR_WRITES_SECONDS = float(os.environ.get("DB_READ_YOUR_WRITES_SECONDS", 10))
+DB_PRIMARY_COOKIE = "db_primary_until"
+
+# Connection pool
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 20))
+# Seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5))
+# Idle connections older than this many seconds are pinged on checkout
+DB_POOL_CHECK_INTERVAL = float(os.environ.get("DB_POOL_CHECK_INTERVAL", 30))
+# Run the hot queries through statements prepared once per pooled connection, see statements.py
+PREPARED_STATEMENTS_ENABLED = os.environ.get("PREPARED_STATEMENTS_ENABLED", "1") == "1"
+# Threads running the independent queries of a page at the same time
+DB_CONCURRENT_CALLS = int(os.environ.get("DB_CONCURRENT_CALLS", 8))
+
+# Longest tag, tagnames.tagname is a VARCHAR(50)
+TAG_MAX_LENGTH = 50
 
 # Error prompt
 err_internal = "Internal error, refresh page to try again"
@@ -22,4 +46,87 @@ err_invalid_input =  "Invalid input"
 SUCCESS = 0
 FAILURE = 1
 DB_ERROR = -1
-DB_CONNECTION_ERROR = -2
\ No newline at end of file
+DB_CONNECTION_ERROR = -2
+
+# PDF text extraction
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", 2))
+EXTRACT_MAX_ATTEMPTS = int(os.environ.get("EXTRACT_MAX_ATTEMPTS", 3))
+EXTRACT_PENDING = "extracting"
+EXTRACT_DONE = "done"
+EXTRACT_FAILED = "failed"
+# Jobs pending longer than this many seconds are taken over, their process most likely exited
+EXTRACT_STALE_SECONDS = float(os.environ.get("EXTRACT_STALE_SECONDS", 1800))
+# Seconds between two looks for stale jobs by each web process
+EXTRACT_RESUME_INTERVAL = float(os.environ.get("EXTRACT_RESUME_INTERVAL", 300))
+
+# Cache of extracted text by pdf content, see text_cache.py
+TEXT_CACHE_ENABLED = os.environ.get("TEXT_CACHE_ENABLED", "1") == "1"
+# Directory of the cache, media/text_cache if empty
+TEXT_CACHE_DIR = os.environ.get("TEXT_CACHE_DIR", "")
+# Disk budget in bytes of the compressed entries; the least recently used go first
+TEXT_CACHE_MAX_BYTES = int(os.environ.get("TEXT_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# Share of the budget left after an eviction, so that it does not run on every write
+TEXT_CACHE_LOW_WATER = 0.9
+# A process scans the directory after this many writes or seconds, to see the writes of the others
+TEXT_CACHE_RESCAN_WRITES = int(os.environ.get("TEXT_CACHE_RESCAN_WRITES", 100))
+TEXT_CACHE_RESCAN_SECONDS = float(os.environ.get("TEXT_CACHE_RESCAN_SECONDS", 60))
+TEXT_CACHE_LEVEL = 6
+
+# Serving uploaded files
+FILE_CHUNK_SIZE = 64 * 1024
+INVALID_RANGE = -1
+
+# Result cache of read APIs, see cache.py
+CACHE_ENABLED = os.environ.get("CACHE_ENABLED", "1") == "1"
+# 'local' (in process) or 'django' (the Django cache named by CACHE_DJANGO_ALIAS)
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "local")
+CACHE_DJANGO_ALIAS = "default"
+CACHE_TTL = 60
+CACHE_MAX_ENTRIES = 1024
+
+# Conditional GET of the list pages: seconds the browser may reuse a page before revalidating
+# it with its ETag
+LIST_PAGE_MAX_AGE = 0
+
+# Rendered paper cards, see fragments.py; they use the cache backend above
+FRAGMENT_CACHE_ENABLED = os.environ.get("FRAGMENT_CACHE_ENABLED", "1") == "1"
+FRAGMENT_CACHE_TTL = 600
+# Item namespace of the card versions, bumped by writes to a paper
+CARD_NAMESPACE = "card"
+
+# Write-behind buffer of likes, see like_buffer.py
+LIKE_WRITE_BEHIND = os.environ.get("LIKE_WRITE_BEHIND", "0") == "1"
+# Seconds between two flushes of the buffer
+LIKE_FLUSH_INTERVAL = float(os.environ.get("LIKE_FLUSH_INTERVAL", 1.0))
+# Number of pending likes that triggers a flush before the interval is over
+LIKE_BUFFER_SIZE = 500
+
+# Recommendations
+# Number of most similar users whose likes are recommended
+RECOMMEND_COHORT_SIZE = 20
+# Number of recommendations kept per user
+RECOMMEND_TOP_K = 50
+# Papers with more likers do not count towards the similarity of users, see track_co_likes.
+# reset_db writes it into the database as similarity_max_likers(), which the triggers and
+# rebuild_user_similarity read; CreateTable.sql has the default
+SIMILARITY_MAX_LIKERS = int(os.environ.get("SIMILARITY_MAX_LIKERS", 100))
+
+# Instrumentation of db API calls, see instrumentation.py
+QUERY_STATS_ENABLED = os.environ.get("QUERY_STATS_ENABLED", "1") == "1"
+# Upper bounds in seconds of the latency histogram buckets
+QUERY_HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Calls slower than this many seconds get their slowest statement explained
+SLOW_CALL_THRESHOLD = float(os.environ.get("SLOW_CALL_THRESHOLD", 0.5))
+# Json lines file the slow call captures are appended to, none if empty
+SLOW_CALL_LOG = os.environ.get("SLOW_CALL_LOG", "")
+# Number of slow call captures kept in memory
+SLOW_CALL_KEEP = 50
+
+# Logging, see log.py
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+# File the records are appended to, stderr if empty
+LOG_FILE = os.environ.get("LOG_FILE", "")
+# Share of requests whose DEBUG records are kept
+LOG_DEBUG_SAMPLE = float(os.environ.get("LOG_DEBUG_SAMPLE", 0.01))
+# Records waiting to be written, more are dropped
+LOG_QUEUE_SIZE = 10000
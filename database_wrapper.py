@@ -1,60 +1,550 @@
+"""
+Access to the database: pooled connections to the primary (DB_DESC) and to its read replicas
+(DB_REPLICA_DESCS), and helpers to call the APIs of functions.py with them.
+
+Reads that may be a little behind go to a replica, get_db_connection(replica=True), unless
+the current user just wrote. Add "paper.database_wrapper.ReadYourWritesMiddleware" to
+MIDDLEWARE for that: it keeps the reads of a user on the primary for
+DB_READ_YOUR_WRITES_SECONDS after their own write (stick_to_primary), across requests and
+worker processes; it also keeps the list pages from answering 304 to a user who just wrote.
+Without it stick_to_primary does nothing and every read may go to a replica.
+"""
+
+import os
+import random
+import threading
+import time
+
 import psycopg2 as psy
+import psycopg2.extensions as psy_ext
+import psycopg2.pool
+from multiprocessing.pool import ThreadPool
 
 from constants import *
+import functions
+import instrumentation
+import log
+import statements
+
+
+class ConnectionPool(object):
+    """
+    A thread safe pool of postgres connections.
+
+    Connections are health checked when they are handed out and rolled back when they are
+    returned, so a caller always gets a usable connection with no transaction in progress.
+    """
+
+    replica = False
+
+    def __init__(self, dsn, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                 timeout=DB_POOL_TIMEOUT, check_interval=DB_POOL_CHECK_INTERVAL):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.pid = os.getpid()
+        self._cond = threading.Condition(threading.Lock())
+        # (conn, time it was returned) of connections ready to be handed out
+        self._idle = []
+        self._in_use = set()
+        # New connections being made, they count toward max_size
+        self._connecting = 0
+        self._stats = {'checkouts': 0, 'waits': 0, 'timeouts': 0, 'connects': 0,
+                       'health_check_failures': 0, 'resets': 0, 'discards': 0}
+        for i in range(min(self.min_size, self.max_size)):
+            try:
+                self._idle.append((self._connect(), time.time()))
+                self._stats['connects'] += 1
+            except psy.DatabaseError:
+                break
+
+    def _connect(self):
+        conn = psy.connect(self.dsn, connection_factory=statements.PreparingConnection,
+                           cursor_factory=instrumentation.TimedCursor)
+        # Where the connection goes back to, and whether its reads may be behind, see cache.cached
+        conn.pool_dsn = self.dsn
+        conn.replica = self.replica
+        return conn
+
+    def _healthy(self, conn, idle_since):
+        """
+        Make sure a connection taken from the idle list still works
+        """
+        if conn.closed:
+            return False
+        if time.time() - idle_since < self.check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            conn.rollback()
+            return True
+        except psy.DatabaseError:
+            return False
+
+    def _discard(self, conn):
+        with self._cond:
+            self._stats['discards'] += 1
+        try:
+            conn.close()
+        except:
+            pass
+
+    def _reserve(self, deadline):
+        """
+        Take an idle connection or a free slot, waiting until $deadline for one.
+        Must be called with self._cond held.
+
+        :return: (conn, time it was returned) of an idle connection, (None, None) for a slot
+        """
+        waited = False
+        while True:
+            if self._idle:
+                conn, idle_since = self._idle.pop()
+                self._in_use.add(conn)
+                return conn, idle_since
+            if len(self._in_use) + self._connecting < self.max_size:
+                self._connecting += 1
+                return None, None
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self._stats['timeouts'] += 1
+                raise psy.pool.PoolError("connection pool exhausted")
+            if not waited:
+                self._stats['waits'] += 1
+                waited = True
+            self._cond.wait(remaining)
+
+    def getconn(self):
+        """
+        Check out a connection. Wait at most self.timeout seconds for one to be returned
+        when the pool is exhausted.
+        The lock is only held to take an idle connection or a slot: health checks and new
+        connections are made without it, so they do not hold up other checkouts.
+        """
+        deadline = time.time() + self.timeout
+        while True:
+            with self._cond:
+                conn, idle_since = self._reserve(deadline)
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except:
+                    with self._cond:
+                        self._connecting -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._connecting -= 1
+                    self._in_use.add(conn)
+                    self._stats['connects'] += 1
+                    self._stats['checkouts'] += 1
+                return conn
+            if self._healthy(conn, idle_since):
+                with self._cond:
+                    self._stats['checkouts'] += 1
+                return conn
+            with self._cond:
+                self._in_use.discard(conn)
+                self._stats['health_check_failures'] += 1
+                self._cond.notify()
+            self._discard(conn)
+
+    def putconn(self, conn):
+        """
+        Return a connection. Any open transaction is rolled back and session settings are
+        reset before the connection is reused; broken connections are dropped.
+        The connection keeps its slot while it is rolled back, outside the lock.
+        """
+        with self._cond:
+            owned = conn in self._in_use
+            # Returned twice, or checked out of another pool (e.g. before a fork)
+            stray = not owned and all(c is not conn for c, idle_since in self._idle)
+        if not owned:
+            if stray:
+                self._discard(conn)
+            return
+        reset = False
+        try:
+            if conn.closed:
+                raise psy.InterfaceError("connection already closed")
+            if conn.get_transaction_status() != psy_ext.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+                reset = True
+            if conn.autocommit:
+                conn.autocommit = False
+            usable = True
+        except psy.DatabaseError:
+            usable = False
+        with self._cond:
+            self._in_use.discard(conn)
+            if reset:
+                self._stats['resets'] += 1
+            if usable and len(self._idle) < self.max_size:
+                self._idle.append((conn, time.time()))
+                conn = None
+            self._cond.notify()
+        if conn is not None:
+            self._discard(conn)
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, idle_since in idle:
+            self._discard(conn)
+
+    def stats(self):
+        """
+        Get a snapshot of the pool counters
+        """
+        with self._cond:
+            res = dict(self._stats)
+            res['idle'] = len(self._idle)
+            res['in_use'] = len(self._in_use)
+            res['connecting'] = self._connecting
+            res['max_size'] = self.max_size
+            return res
+
+
+class ReplicaPool(ConnectionPool):
+    """
+    A pool of connections to a read replica, which also keeps how far the replica is behind
+    its primary.
+
+    The lag is measured on a connection being checked out, at most every
+    DB_REPLICA_CHECK_INTERVAL seconds. A replica that can not be reached, or whose lag is
+    unknown, is left out until the next check. A server that is not in recovery, e.g. a
+    second instance used in tests, counts as caught up. A replica that has replayed all it
+    received is only caught up while its WAL receiver is streaming from the primary,
+    otherwise its lag is unknown; the role of DB_REPLICA_DESCS needs pg_read_all_stats
+    to see the receiver status.
+    """
+
+    replica = True
+    LAG_QUERY = """SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0
+                               WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver
+                                                WHERE status = 'streaming') THEN NULL
+                               WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                               ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END;"""
+
+    def __init__(self, dsn, **kwargs):
+        # Seconds behind the primary, None if unknown
+        self.lag = None
+        self.lag_interval = DB_REPLICA_CHECK_INTERVAL
+        self.checked = 0.0
+        self.down_until = 0.0
+        super(ReplicaPool, self).__init__(dsn, **kwargs)
+        self._stats.update({'lag_checks': 0, 'failures': 0, 'too_far_behind': 0})
+
+    def usable(self):
+        """
+        Tell if the replica may be tried, it is up and was close enough at the last check
+        """
+        now = time.time()
+        if now < self.down_until:
+            return False
+        return now - self.checked >= self.lag_interval or \
+            (self.lag is not None and self.lag <= DB_REPLICA_MAX_LAG)
+
+    def getconn(self):
+        """
+        Check out a connection, measuring the lag with it when it is due
+
+        :return: A connection, None if the replica is too far behind
+        """
+        try:
+            conn = super(ReplicaPool, self).getconn()
+        except (psy.DatabaseError, psy.pool.PoolError), e:
+            self._fail(e)
+            return None
+        if time.time() - self.checked >= self.lag_interval:
+            try:
+                cur = conn.cursor()
+                cur.execute(self.LAG_QUERY)
+                lag = cur.fetchone()[0]
+                conn.rollback()
+            except psy.DatabaseError, e:
+                self.putconn(conn)
+                self._fail(e)
+                return None
+            with self._cond:
+                self._stats['lag_checks'] += 1
+                self.lag = float(lag) if lag is not None else None
+                self.checked = time.time()
+        if self.lag is None or self.lag > DB_REPLICA_MAX_LAG:
+            with self._cond:
+                self._stats['too_far_behind'] += 1
+            self.putconn(conn)
+            return None
+        return conn
+
+    def _fail(self, error):
+        with self._cond:
+            self._stats['failures'] += 1
+            self.lag = None
+            self.checked = 0.0
+            self.down_until = time.time() + self.lag_interval
+        logger.warning("replica left out", error=str(error).strip())
+
+    def stats(self):
+        res = super(ReplicaPool, self).stats()
+        res['lag'] = self.lag
+        res['usable'] = self.usable()
+        return res
+
+
+logger = log.get_logger(__name__)
+_pool = None
+_pool_lock = threading.Lock()
+_replica_pools = None
+_replica_pools_pid = None
+_route_lock = threading.Lock()
+_route_stats = {'replica_reads': 0, 'primary_reads': 0, 'fallbacks': 0, 'sticky_reads': 0}
+# Time until which the reads of this thread's request go to the primary, and whether the
+# request is seen by ReadYourWritesMiddleware
+_local = threading.local()
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Get the process wide connection pool. A forked worker gets its own pool instead of
+    sharing the parent's sockets.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = ConnectionPool(DB_DESC)
+        return _pool
+
+
+def get_replica_pools():
+    """
+    Get the connection pools of this process to the DB_REPLICA_DESCS replicas
+    """
+    global _replica_pools, _replica_pools_pid
+    with _pool_lock:
+        if _replica_pools is None or _replica_pools_pid != os.getpid():
+            _replica_pools = [ReplicaPool(desc) for desc in DB_REPLICA_DESCS]
+            _replica_pools_pid = os.getpid()
+        return _replica_pools
 
 
-def get_db_connection():
+def get_pool_stats():
     """
-    Get a postgres database connection
+    Get the counters (checkouts, waits, timeouts, ...) of the connection pool, with the
+    pools of the replicas and how reads were routed
+    """
+    res = get_pool().stats()
+    if DB_REPLICA_DESCS:
+        res['replicas'] = [pool.stats() for pool in get_replica_pools()]
+        with _route_lock:
+            res['routing'] = dict(_route_stats)
+    return res
+
+
+def _count_route(key):
+    with _route_lock:
+        _route_stats[key] += 1
+
+
+def get_primary_until():
+    return getattr(_local, 'primary_until', 0.0)
+
+
+def set_primary_until(until):
+    """
+    Send the reads of this thread to the primary until the time $until, 0 to stop
+    """
+    _local.primary_until = until
+
+
+def stick_to_primary():
+    """
+    Read from the primary after a write of the current user, for the rest of the request
+    and their next DB_READ_YOUR_WRITES_SECONDS seconds; list pages skip their validators
+    meanwhile, see views.get_list_page_validators. Only in a request seen by
+    ReadYourWritesMiddleware, which resets the thread at the end of the request: otherwise
+    the thread would keep sending the reads of other users to the primary.
+    """
+    if getattr(_local, 'tracked', False):
+        set_primary_until(time.time() + DB_READ_YOUR_WRITES_SECONDS)
+        _local.wrote = True
+
+
+def _get_replica_connection():
+    """
+    Check out a connection to a random replica that is close enough to the primary
+
+    :return: A connection, None if no replica can serve reads now
+    """
+    pools = [pool for pool in get_replica_pools() if pool.usable()]
+    random.shuffle(pools)
+    for pool in pools:
+        conn = pool.getconn()
+        if conn is not None:
+            return conn
+    return None
+
+
+def get_db_connection(replica = False):
+    """
+    Get a postgres database connection from the pool.
+    Give it back with close_db_connection.
+
+    :param replica: True if the connection is only read from; it then goes to a replica
+                    unless the current user just wrote, or no replica is close enough
     """
     try:
-        conn = psy.connect(DB_DESC)
+        if replica and DB_REPLICA_DESCS:
+            if time.time() < get_primary_until():
+                _count_route('sticky_reads')
+            else:
+                conn = _get_replica_connection()
+                if conn is not None:
+                    _count_route('replica_reads')
+                    return SUCCESS, conn
+                _count_route('fallbacks')
+            _count_route('primary_reads')
+        conn = get_pool().getconn()
         return SUCCESS, conn
-    except psy.DatabaseError, e:
-        print "Error %s" % e
+    except (psy.DatabaseError, psy.pool.PoolError), e:
+        logger.error("can not get a db connection", error=str(e))
         return DB_CONNECTION_ERROR, None
 
 
 def call_db_with_conn(conn, function_name, argdict):
     """
-    Call a db API via the given connection
+    Call a db API via the given connection. The call is timed, see instrumentation.py.
     """
+    call = instrumentation.start_call(function_name)
+    status = DB_ERROR
     try:
-        return function_name(conn, **argdict)
+        res = function_name(conn, **argdict)
+        status = res[0]
+        return res
     except psy.DatabaseError, e:
-        print "Error %s: " % e.args[0]
+        logger.error("db error", api=function_name.__name__, error=str(e.args[0]))
         conn.rollback()
         return DB_ERROR, None
+    finally:
+        instrumentation.end_call(call, status)
 
 
 def close_db_connection(conn):
     """
-    Safely close a database connection. Ignore any error.
+    Return a database connection to the pool. Ignore any error.
     """
     try:
-        conn.close()
+        if getattr(conn, 'replica', False):
+            for pool in get_replica_pools():
+                if pool.dsn == conn.pool_dsn:
+                    pool.putconn(conn)
+                    return
+            conn.close()
+        else:
+            get_pool().putconn(conn)
     except:
         pass
 
 
 def call_db(function_name, argdict):
     """
-    Make a one shot request to the database. Ignore any error when closing the connection.
+    Make a one shot request to the database with a pooled connection. The APIs listed in
+    functions.REPLICA_APIS are sent to a replica, see get_db_connection.
+    The call is timed, including the wait for a connection, see instrumentation.py.
     """
     conn = None
+    call = instrumentation.start_call(function_name)
+    status = DB_ERROR
     try:
-        res, conn = get_db_connection()
+        res, conn = get_db_connection(function_name.__name__ in functions.REPLICA_APIS)
         if res != SUCCESS:
+            status = res
             return res, None
-        return function_name(conn, **argdict)
+        res = function_name(conn, **argdict)
+        status = res[0]
+        return res
     except psy.DatabaseError, e:
-        print "Error %s: " % e.args[0]
+        logger.error("db error", api=function_name.__name__, error=str(e.args[0]))
         conn.rollback()
         return DB_ERROR, None
     finally:
         if conn:
-            try:
-                conn.close()
-            except:
-                pass
-                
\ No newline at end of file
+            close_db_connection(conn)
+        instrumentation.end_call(call, status)
+
+
+def get_executor():
+    """
+    Get the thread pool of this process that runs concurrent db calls
+    """
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPool(DB_CONCURRENT_CALLS)
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def call_db_concurrently(calls):
+    """
+    Make independent one shot requests to the database at the same time, each with its own
+    pooled connection, and wait for all of them. The page then waits for its slowest query
+    instead of the sum of all of them.
+
+    :param calls: A list of (function_name, argdict)
+    :return: A list of the (status, res) of every call, in the same order
+    """
+    if len(calls) <= 1:
+        return [call_db(function_name, argdict) for function_name, argdict in calls]
+    request_id = log.get_request_id()
+    primary_until = get_primary_until()
+
+    def run(call):
+        # Log records and the routing of the calls belong to the request
+        log.set_request_id(request_id)
+        set_primary_until(primary_until)
+        try:
+            return call_db(*call)
+        finally:
+            log.set_request_id(None)
+            set_primary_until(0)
+    return get_executor().map(run, calls)
+
+
+class ReadYourWritesMiddleware(object):
+    """
+    Keep sending the reads of a user to the primary for DB_READ_YOUR_WRITES_SECONDS after
+    their own like or upload (stick_to_primary), so that a replica behind the primary never
+    hides it from them. The deadline is kept in a cookie, so every worker process follows it.
+    """
+
+    def __init__(self, get_response = None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        self.process_request(request)
+        return self.process_response(request, self.get_response(request))
+
+    def process_request(self, request):
+        _local.tracked = True
+        _local.wrote = False
+        try:
+            set_primary_until(float(request.COOKIES.get(DB_PRIMARY_COOKIE, 0)))
+        except ValueError:
+            set_primary_until(0)
+
+    def process_response(self, request, response):
+        if getattr(_local, 'wrote', False):
+            response.set_cookie(DB_PRIMARY_COOKIE, "%.3f" % get_primary_until(),
+                                max_age=int(DB_READ_YOUR_WRITES_SECONDS) + 1, httponly=True)
+        _local.tracked = False
+        _local.wrote = False
+        set_primary_until(0)
+        return response
@@ -0,0 +1,171 @@
+"""
+Background text extraction of uploaded pdf files.
+
+Extraction is CPU bound, so it runs in a pool of worker processes. The web request only
+queues a job (see functions.add_new_paper) and returns; the text is written to the paper
+when the worker is done. Files that were extracted before are served from the text cache,
+see text_cache.py.
+
+Jobs live in the database, the queue of the pool only in memory: the jobs of a process that
+exits are left pending. Once a process has queued a job, it looks for such stale jobs every
+EXTRACT_RESUME_INTERVAL seconds and takes them over, see resume_pending. A job whose worker
+died counts as a failed attempt, so a pdf that crashes textract is given up after
+EXTRACT_MAX_ATTEMPTS runs.
+"""
+
+import os
+import threading
+import time
+import multiprocessing
+
+import textract
+
+from constants import *
+from log import get_logger
+from database_wrapper import call_db
+import functions
+import text_cache
+
+
+logger = get_logger(__name__)
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_resumer = None
+_resumer_pid = None
+
+
+def extract_text(file_path):
+    """
+    Run in a worker process. Python 2 pools have no error callback, so failures are
+    returned instead of raised. The text of a file that was extracted before comes from
+    the text cache, failures are never cached.
+
+    :return: (ok, text or error, hit) where hit tells if the text came from the cache
+    """
+    try:
+        cache = text_cache.get_text_cache()
+        key = text_cache.file_key(file_path) if cache is not None else None
+        if key is not None:
+            text = cache.get(key)
+            if text is not None:
+                return True, text, True
+        text = textract.process(file_path)
+        if key is not None:
+            cache.put(key, text)
+        return True, text, False
+    except Exception, e:
+        return False, "%s: %s" % (type(e).__name__, e), False
+
+
+def record_lookup(file_path, hit):
+    """
+    Count the text cache lookup of an extraction, in the process collecting the results
+    """
+    try:
+        size = os.path.getsize(file_path) if hit else 0
+    except OSError:
+        size = 0
+    text_cache.record(hit, size)
+
+
+def get_worker_pool():
+    """
+    Get the extraction worker pool of this process
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = multiprocessing.Pool(EXTRACT_WORKERS, maxtasksperchild=100)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _on_result(pid, file_path, result):
+    """
+    Store the outcome of a job. Called in the pool's result thread.
+    """
+    try:
+        ok, value, hit = result
+        if ok:
+            record_lookup(file_path, hit)
+            status, res = call_db(functions.finish_extract_job, {'pid':pid, 'text':value})
+            if status != SUCCESS:
+                logger.error("can not store extracted text", pid=pid)
+            return
+
+        logger.warning("can not extract text", pid=pid, error=value)
+        status, attempts = call_db(functions.fail_extract_job, {'pid':pid, 'error':value})
+        if status == SUCCESS and attempts < EXTRACT_MAX_ATTEMPTS:
+            retry(pid)
+    except:
+        logger.exception("can not handle an extraction result", pid=pid)
+
+
+def submit(pid, file_path):
+    """
+    Queue the extraction of a pdf whose job is already recorded as pending
+    """
+    start_resumer()
+    get_worker_pool().apply_async(extract_text, (file_path, ),
+                                  callback=lambda result: _on_result(pid, file_path, result))
+
+
+def retry(pid):
+    """
+    Queue a failed job again, using the pdf that is already on disk
+
+    :return: SUCCESS if the job has been queued
+    """
+    status, file_path = call_db(functions.retry_extract_job, {'pid':pid})
+    if status == SUCCESS:
+        submit(pid, file_path)
+    return status
+
+
+def resume_pending():
+    """
+    Queue every job left pending for more than EXTRACT_STALE_SECONDS, e.g. by a worker that
+    was restarted, and fail those that used up their attempts
+
+    :return: The number of jobs queued
+    """
+    status, jobs = call_db(functions.resume_stale_extract_jobs, {})
+    if status != SUCCESS:
+        return 0
+    queued = 0
+    for pid, file_path, exhausted in jobs:
+        if exhausted:
+            logger.error("giving up stale extraction", pid=pid)
+            call_db(functions.fail_extract_job, {'pid':pid, 'error':"worker lost before finishing"})
+            continue
+        logger.info("resuming stale extraction", pid=pid)
+        submit(pid, file_path)
+        queued += 1
+    return queued
+
+
+def _resume_loop():
+    while True:
+        try:
+            resume_pending()
+        except:
+            logger.exception("can not resume extractions")
+        time.sleep(EXTRACT_RESUME_INTERVAL)
+
+
+def start_resumer():
+    """
+    Start the thread of this process taking over stale jobs, again in a forked child.
+    Called by submit, so that processes which never extract anything, e.g. management
+    commands, do not poll the database.
+    """
+    global _resumer, _resumer_pid
+    if _resumer is not None and _resumer_pid == os.getpid():
+        return
+    with _pool_lock:
+        if _resumer is None or _resumer_pid != os.getpid():
+            _resumer = threading.Thread(target=_resume_loop, name="extraction resumer")
+            _resumer.daemon = True
+            _resumer.start()
+            _resumer_pid = os.getpid()
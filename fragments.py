@@ -0,0 +1,103 @@
+"""
+Cache of the rendered cards of papers, the part of base_paper_list.html repeated for every paper
+(title, author, description, tags and like count).
+
+The same cards show up on the home page, the popular papers, the tag pages and the search
+results, so a card is rendered once with CARD_TEMPLATE and then shared by every list. It is
+cached under the paper's pid and version (cache.get_item_versions), a digest of the paper
+data it is rendered from (like count and tags included), plus the variant of the card: the
+page it links back to, whether the viewer owns the paper and whether they like it. The
+digest ties a card to the data of the page showing it, so a page built from older data,
+e.g. a cached result or a lagging replica, never stores its card for newer data.
+functions.py also bumps the version of a paper when it is liked, unliked or deleted.
+
+render_cards sets post['card'] on every paper of a page, fetching all of the versions and
+cached cards in one round trip each to the cache backend. The list template prints it with
+{{ post.card }}. If CARD_TEMPLATE can not be found, cards are turned off and post['card'] is
+left unset, so the list template has to keep rendering a paper without it.
+"""
+
+import hashlib
+import threading
+import time
+
+from django.template import TemplateDoesNotExist
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from constants import *
+from log import get_logger
+import cache
+
+
+logger = get_logger(__name__)
+CARD_TEMPLATE = 'paper/paper_card.html'
+_enabled = FRAGMENT_CACHE_ENABLED
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'render_seconds': 0.0}
+
+
+def _card_key(post, version, source, own, liked):
+    digest = hashlib.md5(repr(sorted((key, value) for key, value in post.items() if key != 'card'))).hexdigest()
+    return "paper:card:%s:%s:%s:%s:%d:%s" % (post['pid'], version, digest, source, own, liked)
+
+
+def render_cards(posts, source, uname, liked = None):
+    """
+    Set post['card'] to the rendered card of every paper, from the cache when possible
+
+    :param posts: A list of paper dicts, see views.get_paper_dict, with 'like' and 'tags'
+    :param source: The page the cards link back to, 'home' or 'popular'
+    :param uname: The viewer
+    :param liked: The set of pids the viewer likes among $posts, None if unknown
+    """
+    global _enabled
+    if not _enabled or not CACHE_ENABLED or not posts:
+        return
+    backend = cache.get_backend()
+    versions = cache.get_item_versions(CARD_NAMESPACE, set(post['pid'] for post in posts))
+    # 1 or 0 if the viewer likes the paper or not, '?' if it is not known
+    likes = [('?' if liked is None else int(post['pid'] in liked)) for post in posts]
+    keys = [_card_key(post, versions[post['pid']], source, post['username'] == uname, like)
+            for post, like in zip(posts, likes)]
+    cards = backend.get_many(list(set(keys)))
+
+    rendered = dict()
+    start = time.time()
+    for post, key, like in zip(posts, keys, likes):
+        card = cards.get(key) or rendered.get(key)
+        if card is None:
+            try:
+                card = render_to_string(CARD_TEMPLATE, {'post': post, 'source': source,
+                                                        'own': post['username'] == uname,
+                                                        'liked': None if like == '?' else bool(like)})
+            except TemplateDoesNotExist:
+                logger.error("no card template, page fragments are off", template=CARD_TEMPLATE)
+                _enabled = False
+                return
+            rendered[key] = card
+        post['card'] = mark_safe(card)
+    if rendered:
+        backend.set_many(rendered, FRAGMENT_CACHE_TTL)
+
+    with _stats_lock:
+        _stats['hits'] += len(posts) - len(rendered)
+        _stats['misses'] += len(rendered)
+        _stats['render_seconds'] += time.time() - start
+
+
+def bump(pids):
+    """
+    Drop the cached cards of papers
+    """
+    cache.bump_items(CARD_NAMESPACE, pids)
+
+
+def get_fragment_stats():
+    """
+    Get the number of cards served from the cache and rendered, and the time spent rendering
+    """
+    with _stats_lock:
+        total = _stats['hits'] + _stats['misses']
+        return dict(_stats, enabled=_enabled,
+                    hit_ratio=float(_stats['hits']) / total if total else 0.0)
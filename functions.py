@@ -8,13 +8,23 @@ import psycopg2 as psy
 from datetime import datetime
 from pytz import timezone
 from constants import *
-import traceback
 import datetime
+import cStringIO
+import csv
+import base64
+import json
+import time
+import cache
+import instrumentation
+import statements
+from log import get_logger
 
 import sys
 reload(sys)
 sys.setdefaultencoding('utf8')
 
+logger = get_logger(__name__)
+
 
 """
 General rules:
@@ -75,11 +85,28 @@ def example_select_current_time(conn):
         return 1, None
 
 
+# Cached read APIs (see cache.py) whose results depend on the set of papers and tags
+CACHED_PAPER_APIS = ('get_timeline_all', 'get_most_popular_papers', 'get_most_active_users',
+                     'get_most_popular_tags', 'get_most_popular_tag_pairs')
+# Cached read APIs whose results depend on likes
+CACHED_LIKE_APIS = ('get_most_popular_papers', )
+# Read APIs that database_wrapper.call_db may run on a replica, DB_REPLICA_MAX_LAG seconds
+# behind at most. Reads right after a write of the caller (logins, extraction jobs, blobs)
+# stay on the primary.
+REPLICA_APIS = ('get_paper_tags', 'get_likes', 'get_likes_tags_batch', 'get_timeline', 'get_timeline_all',
+                'get_most_popular_papers', 'get_recommend_papers', 'get_papers_by_tag',
+                'get_papers_by_keyword', 'get_papers_by_liked', 'get_most_active_users',
+                'get_most_popular_tags', 'get_most_popular_tag_pairs', 'get_related_tags',
+                'get_number_papers_user', 'get_number_liked_user', 'get_number_tags_user',
+                'get_user_stats', 'home_page_bundle')
+
+
 # Admin APIs
 
 
 
 # T.1
+@cache.invalidates(*CACHED_PAPER_APIS)
 def reset_db(conn):
     """
     Reset the entire database.
@@ -90,10 +117,11 @@ def reset_db(conn):
         (0, None)   Success
         (1, None)   Failure
     """
-    print("[BEGIN] reset_db")
+    logger.debug("begin", api="reset_db")
     commands = (
         """
-        DROP TABLE IF EXISTS tags, tagnames, likes, papers, users
+        DROP TABLE IF EXISTS user_tags, user_stats, recommendation_queue, recommendations, user_similarity,
+            import_sources, extract_jobs, tag_pairs, tags, tagnames, likes, papers, blobs, users
         """,
         """
         CREATE TABLE IF NOT EXISTS users(
@@ -103,6 +131,15 @@ def reset_db(conn):
         )
         """,
         """
+        CREATE TABLE IF NOT EXISTS blobs(
+            sha256 CHAR(64) NOT NULL,
+            size BIGINT NOT NULL,
+            ref_count INT NOT NULL DEFAULT 0,
+            data TEXT,
+            PRIMARY KEY(sha256)
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS papers(
             pid  SERIAL PRIMARY KEY,
             username VARCHAR(50) NOT NULL,
@@ -110,15 +147,59 @@ def reset_db(conn):
             begin_time TIMESTAMP NOT NULL,
             description VARCHAR(500),
             data TEXT,
-            FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
+            like_count INT NOT NULL DEFAULT 0,
+            search_vector tsvector GENERATED ALWAYS AS (
+                setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+                setweight(to_tsvector('english', coalesce(description, '')), 'B') ||
+                setweight(to_tsvector('english', coalesce(data, '')), 'C')
+            ) STORED,
+            blob CHAR(64),
+            FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE,
+            FOREIGN KEY(blob) REFERENCES blobs
         );
         """,
         """
-        CREATE INDEX paper_text_idx ON papers USING gin(to_tsvector('english', data))
+        CREATE INDEX paper_search_idx ON papers USING gin(search_vector)
+        """,
+        """
+        CREATE INDEX paper_like_count_idx ON papers(like_count DESC, pid ASC, begin_time) WHERE like_count > 0
+        """,
+        """
+        CREATE INDEX paper_time_idx ON papers(begin_time DESC, pid ASC)
+        """,
+        """
+        CREATE INDEX paper_user_time_idx ON papers(username, begin_time DESC, pid ASC)
+        """,
+        """
+        CREATE INDEX paper_blob_idx ON papers(blob) WHERE blob IS NOT NULL
+        """,
+        """
+        CREATE OR REPLACE FUNCTION count_blob_refs() RETURNS trigger AS $$
+        DECLARE
+            delta INT := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+        BEGIN
+            UPDATE blobs b SET ref_count = b.ref_count + delta * c.count_papers
+            FROM (SELECT c.blob, COUNT(*) AS count_papers FROM changed_papers c
+                  WHERE c.blob IS NOT NULL GROUP BY c.blob) c
+            WHERE b.sha256 = c.blob;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER papers_insert_blob_trigger AFTER INSERT ON papers
+            REFERENCING NEW TABLE AS changed_papers
+            FOR EACH STATEMENT EXECUTE PROCEDURE count_blob_refs()
+        """,
+        """
+        CREATE TRIGGER papers_delete_blob_trigger AFTER DELETE ON papers
+            REFERENCING OLD TABLE AS changed_papers
+            FOR EACH STATEMENT EXECUTE PROCEDURE count_blob_refs()
         """,
         """
         CREATE TABLE IF NOT EXISTS tagnames(
             tagname VARCHAR(50) NOT NULL,
+            paper_count INT NOT NULL DEFAULT 0,
             PRIMARY KEY(tagname)
         );
         """,
@@ -133,6 +214,158 @@ def reset_db(conn):
         );
         """,
         """
+        CREATE INDEX like_user_idx ON likes(username, pid)
+        """,
+        """
+        CREATE OR REPLACE FUNCTION count_likes() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE papers SET like_count = like_count + 1 WHERE pid = NEW.pid;
+            ELSE
+                UPDATE papers SET like_count = like_count - 1 WHERE pid = OLD.pid;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER likes_count_trigger AFTER INSERT OR DELETE ON likes
+            FOR EACH ROW EXECUTE PROCEDURE count_likes()
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_similarity(
+            username VARCHAR(50) NOT NULL,
+            other VARCHAR(50) NOT NULL,
+            score INT NOT NULL,
+            PRIMARY KEY(username, other)
+        )
+        """,
+        """
+        CREATE INDEX user_similarity_score_idx ON user_similarity(username, score DESC, other ASC)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS recommendations(
+            username VARCHAR(50) NOT NULL,
+            pid INT NOT NULL,
+            score INT NOT NULL,
+            PRIMARY KEY(username, pid),
+            FOREIGN KEY(pid) REFERENCES papers ON DELETE CASCADE,
+            FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE INDEX recommendations_score_idx ON recommendations(username, score DESC, pid ASC)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS recommendation_queue(
+            username VARCHAR(50) NOT NULL,
+            PRIMARY KEY(username)
+        )
+        """,
+        """
+        CREATE OR REPLACE FUNCTION similarity_max_likers() RETURNS INT AS $$
+            SELECT %d;
+        $$ LANGUAGE sql IMMUTABLE
+        """ % SIMILARITY_MAX_LIKERS,
+        """
+        CREATE OR REPLACE FUNCTION track_co_likes() RETURNS trigger AS $$
+        DECLARE
+            -- A paper liked by more users says little about their tastes and would pair almost all of
+            -- them, so it does not count
+            max_likers CONSTANT INT := similarity_max_likers();
+            -- Changed papers with at most max_likers likes on both sides of the change, updated pair by pair
+            small INT[];
+            -- Changed papers crossing the limit, which add or take back all of their pairs
+            crossed INT[];
+        BEGIN
+            -- One transaction at a time counts the changes of a paper, seeing the likes committed before
+            PERFORM pg_advisory_xact_lock(hashtext('track_co_likes'), c.pid)
+            FROM (SELECT DISTINCT l.pid FROM changed_likes l ORDER BY l.pid) c;
+
+            -- papers.like_count is already updated; a paper deleted with its likes has none left
+            SELECT array_agg(c.pid) FILTER (WHERE GREATEST(c.after, c.before) <= max_likers),
+                   array_agg(c.pid) FILTER (WHERE LEAST(c.after, c.before) <= max_likers AND
+                                                  GREATEST(c.after, c.before) > max_likers)
+            INTO small, crossed
+            FROM (
+                SELECT c.pid, COALESCE(MAX(p.like_count), 0) AS after,
+                    COALESCE(MAX(p.like_count), 0) + (CASE WHEN TG_OP = 'INSERT' THEN -1 ELSE 1 END) * COUNT(*) AS before
+                FROM changed_likes c LEFT JOIN papers p ON p.pid = c.pid
+                GROUP BY c.pid
+            ) c;
+
+            IF TG_OP = 'INSERT' THEN
+                -- Pairs of users sharing a paper through at least one new like
+                INSERT INTO user_similarity (username, other, score)
+                    SELECT a.username, b.username, COUNT(*)
+                    FROM likes a JOIN likes b ON a.pid = b.pid AND a.username != b.username
+                    WHERE a.pid = ANY(small) AND
+                        ((a.pid, a.username) IN (SELECT c.pid, c.username FROM changed_likes c) OR
+                         (b.pid, b.username) IN (SELECT c.pid, c.username FROM changed_likes c))
+                    GROUP BY a.username, b.username
+                    ORDER BY a.username, b.username
+                ON CONFLICT (username, other) DO UPDATE SET score = user_similarity.score + EXCLUDED.score;
+                -- Papers grown too popular take back the pairs of their previous likers
+                INSERT INTO user_similarity (username, other, score)
+                    SELECT a.username, b.username, -COUNT(*)
+                    FROM likes a JOIN likes b ON a.pid = b.pid AND a.username != b.username
+                    WHERE a.pid = ANY(crossed) AND
+                        (a.pid, a.username) NOT IN (SELECT c.pid, c.username FROM changed_likes c) AND
+                        (b.pid, b.username) NOT IN (SELECT c.pid, c.username FROM changed_likes c)
+                    GROUP BY a.username, b.username
+                    ORDER BY a.username, b.username
+                ON CONFLICT (username, other) DO UPDATE SET score = user_similarity.score + EXCLUDED.score;
+            ELSE
+                -- Same pairs, among the likes as they were before the delete
+                WITH before AS (
+                    SELECT l.pid, l.username FROM likes l WHERE l.pid = ANY(small)
+                    UNION ALL
+                    SELECT c.pid, c.username FROM changed_likes c WHERE c.pid = ANY(small)
+                )
+                INSERT INTO user_similarity (username, other, score)
+                    SELECT a.username, b.username, -COUNT(*)
+                    FROM before a JOIN before b ON a.pid = b.pid AND a.username != b.username
+                    WHERE (a.pid, a.username) IN (SELECT c.pid, c.username FROM changed_likes c) OR
+                        (b.pid, b.username) IN (SELECT c.pid, c.username FROM changed_likes c)
+                    GROUP BY a.username, b.username
+                    ORDER BY a.username, b.username
+                ON CONFLICT (username, other) DO UPDATE SET score = user_similarity.score + EXCLUDED.score;
+                -- Papers back under the limit give the pairs of their remaining likers
+                INSERT INTO user_similarity (username, other, score)
+                    SELECT a.username, b.username, COUNT(*)
+                    FROM likes a JOIN likes b ON a.pid = b.pid AND a.username != b.username
+                    WHERE a.pid = ANY(crossed)
+                    GROUP BY a.username, b.username
+                    ORDER BY a.username, b.username
+                ON CONFLICT (username, other) DO UPDATE SET score = user_similarity.score + EXCLUDED.score;
+            END IF;
+            -- Pairs are symmetric, so every emptied pair has one of these users on its left
+            DELETE FROM user_similarity s
+            WHERE s.score <= 0 AND s.username IN (
+                SELECT c.username FROM changed_likes c
+                UNION
+                SELECT l.username FROM likes l WHERE l.pid = ANY(small) OR l.pid = ANY(crossed));
+            -- The likers and everyone whose pairs changed, at most max_likers per paper
+            INSERT INTO recommendation_queue (username)
+                SELECT c.username FROM changed_likes c
+                UNION
+                SELECT l.username FROM likes l WHERE l.pid = ANY(small) OR l.pid = ANY(crossed)
+            ON CONFLICT DO NOTHING;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER likes_insert_similarity_trigger AFTER INSERT ON likes
+            REFERENCING NEW TABLE AS changed_likes
+            FOR EACH STATEMENT EXECUTE PROCEDURE track_co_likes()
+        """,
+        """
+        CREATE TRIGGER likes_delete_similarity_trigger AFTER DELETE ON likes
+            REFERENCING OLD TABLE AS changed_likes
+            FOR EACH STATEMENT EXECUTE PROCEDURE track_co_likes()
+        """,
+        """
         CREATE TABLE IF NOT EXISTS tags(
             pid INT NOT NULL,
             tagname VARCHAR(50) NOT NULL,
@@ -141,6 +374,228 @@ def reset_db(conn):
             FOREIGN KEY(tagname) REFERENCES tagnames ON DELETE CASCADE
         );
         """,
+        """
+        CREATE INDEX tag_name_idx ON tags(tagname, pid)
+        """,
+        """
+        CREATE INDEX tagname_count_idx ON tagnames(paper_count DESC, tagname ASC) WHERE paper_count > 0
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS tag_pairs(
+            tag1 VARCHAR(50) NOT NULL,
+            tag2 VARCHAR(50) NOT NULL,
+            paper_count INT NOT NULL,
+            PRIMARY KEY(tag1, tag2),
+            CHECK(tag1 < tag2)
+        )
+        """,
+        """
+        CREATE INDEX tag_pairs_count_idx ON tag_pairs(paper_count DESC, tag1 ASC, tag2 ASC)
+        """,
+        """
+        CREATE INDEX tag_pairs_tag2_idx ON tag_pairs(tag2, tag1)
+        """,
+        """
+        CREATE OR REPLACE FUNCTION track_tags() RETURNS trigger AS $$
+        DECLARE
+            delta INT := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+        BEGIN
+            -- Concurrent uploads and imports sharing tags lock their rows in the same order
+            PERFORM 1 FROM tagnames n WHERE n.tagname IN (SELECT c.tagname FROM changed_tags c)
+            ORDER BY n.tagname FOR NO KEY UPDATE;
+
+            UPDATE tagnames n SET paper_count = n.paper_count + delta * c.count_papers
+            FROM (SELECT c.tagname, COUNT(*) AS count_papers FROM changed_tags c GROUP BY c.tagname) c
+            WHERE n.tagname = c.tagname;
+
+            -- Pairs of tags on the changed papers with at least one changed tag, counted once,
+            -- among the tags as they are after an insert or as they were before a delete
+            WITH paper_tags AS (
+                SELECT t.pid, t.tagname FROM tags t WHERE t.pid IN (SELECT c.pid FROM changed_tags c)
+                UNION ALL
+                SELECT c.pid, c.tagname FROM changed_tags c WHERE TG_OP = 'DELETE'
+            ), changed_pairs AS (
+                SELECT a.tagname AS tag1, b.tagname AS tag2, COUNT(*) AS count_papers
+                FROM paper_tags a JOIN paper_tags b ON a.pid = b.pid AND a.tagname < b.tagname
+                WHERE (a.pid, a.tagname) IN (SELECT c.pid, c.tagname FROM changed_tags c) OR
+                    (b.pid, b.tagname) IN (SELECT c.pid, c.tagname FROM changed_tags c)
+                GROUP BY a.tagname, b.tagname
+            )
+            INSERT INTO tag_pairs (tag1, tag2, paper_count)
+                SELECT p.tag1, p.tag2, delta * p.count_papers FROM changed_pairs p ORDER BY p.tag1, p.tag2
+            ON CONFLICT (tag1, tag2) DO UPDATE SET paper_count = tag_pairs.paper_count + EXCLUDED.paper_count;
+
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM tag_pairs p
+                WHERE p.paper_count <= 0 AND (p.tag1 IN (SELECT c.tagname FROM changed_tags c) OR
+                                              p.tag2 IN (SELECT c.tagname FROM changed_tags c));
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER tags_insert_count_trigger AFTER INSERT ON tags
+            REFERENCING NEW TABLE AS changed_tags
+            FOR EACH STATEMENT EXECUTE PROCEDURE track_tags()
+        """,
+        """
+        CREATE TRIGGER tags_delete_count_trigger AFTER DELETE ON tags
+            REFERENCING OLD TABLE AS changed_tags
+            FOR EACH STATEMENT EXECUTE PROCEDURE track_tags()
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS extract_jobs(
+            pid INT NOT NULL,
+            file_path TEXT NOT NULL,
+            state VARCHAR(16) NOT NULL,
+            attempts INT NOT NULL DEFAULT 0,
+            error TEXT,
+            update_time TIMESTAMP NOT NULL,
+            PRIMARY KEY(pid),
+            FOREIGN KEY(pid) REFERENCES papers ON DELETE CASCADE
+        );
+        """,
+        """
+        CREATE INDEX extract_jobs_state_idx ON extract_jobs(state)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS import_sources(
+            source TEXT NOT NULL,
+            pid INT NOT NULL,
+            PRIMARY KEY(source),
+            FOREIGN KEY(pid) REFERENCES papers ON DELETE CASCADE
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_stats(
+            username VARCHAR(50) NOT NULL,
+            paper_count INT NOT NULL DEFAULT 0,
+            like_count INT NOT NULL DEFAULT 0,
+            tag_count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY(username),
+            FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE INDEX user_stats_paper_count_idx ON user_stats(paper_count DESC, username ASC) WHERE paper_count > 0
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_tags(
+            username VARCHAR(50) NOT NULL,
+            tagname VARCHAR(50) NOT NULL,
+            paper_count INT NOT NULL,
+            PRIMARY KEY(username, tagname),
+            FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE OR REPLACE FUNCTION track_user_papers() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO user_stats (username, paper_count)
+                    SELECT c.username, COUNT(*) FROM changed_papers c GROUP BY c.username
+                ON CONFLICT (username) DO UPDATE SET paper_count = user_stats.paper_count + EXCLUDED.paper_count;
+            ELSE
+                UPDATE user_stats s SET paper_count = s.paper_count - c.count_papers
+                FROM (SELECT c.username, COUNT(*) AS count_papers FROM changed_papers c GROUP BY c.username) c
+                WHERE s.username = c.username;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER papers_insert_stats_trigger AFTER INSERT ON papers
+            REFERENCING NEW TABLE AS changed_papers
+            FOR EACH STATEMENT EXECUTE PROCEDURE track_user_papers()
+        """,
+        """
+        CREATE TRIGGER papers_delete_stats_trigger AFTER DELETE ON papers
+            REFERENCING OLD TABLE AS changed_papers
+            FOR EACH STATEMENT EXECUTE PROCEDURE track_user_papers()
+        """,
+        """
+        CREATE OR REPLACE FUNCTION uncount_paper_tags() RETURNS trigger AS $$
+        BEGIN
+            -- The tags of the paper are still there, the cascade deletes them after the paper
+            UPDATE user_tags u SET paper_count = u.paper_count - 1
+            WHERE u.username = OLD.username AND u.tagname IN (SELECT t.tagname FROM tags t WHERE t.pid = OLD.pid);
+            DELETE FROM user_tags u WHERE u.username = OLD.username AND u.paper_count <= 0;
+            UPDATE user_stats s SET tag_count = (SELECT COUNT(*) FROM user_tags u WHERE u.username = s.username)
+            WHERE s.username = OLD.username;
+            RETURN OLD;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER papers_delete_tags_trigger BEFORE DELETE ON papers
+            FOR EACH ROW EXECUTE PROCEDURE uncount_paper_tags()
+        """,
+        """
+        CREATE OR REPLACE FUNCTION track_user_likes() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO user_stats (username, like_count)
+                    SELECT c.username, COUNT(*) FROM changed_likes c GROUP BY c.username
+                ON CONFLICT (username) DO UPDATE SET like_count = user_stats.like_count + EXCLUDED.like_count;
+            ELSE
+                UPDATE user_stats s SET like_count = s.like_count - c.count_likes
+                FROM (SELECT c.username, COUNT(*) AS count_likes FROM changed_likes c GROUP BY c.username) c
+                WHERE s.username = c.username;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER likes_insert_stats_trigger AFTER INSERT ON likes
+            REFERENCING NEW TABLE AS changed_likes
+            FOR EACH STATEMENT EXECUTE PROCEDURE track_user_likes()
+        """,
+        """
+        CREATE TRIGGER likes_delete_stats_trigger AFTER DELETE ON likes
+            REFERENCING OLD TABLE AS changed_likes
+            FOR EACH STATEMENT EXECUTE PROCEDURE track_user_likes()
+        """,
+        """
+        CREATE OR REPLACE FUNCTION track_user_tags() RETURNS trigger AS $$
+        DECLARE
+            delta INT := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+            owners VARCHAR(50)[];
+        BEGIN
+            -- Only tags of papers that still exist, uncount_paper_tags handles a deleted paper
+            SELECT array_agg(DISTINCT p.username) INTO owners
+            FROM changed_tags c JOIN papers p ON p.pid = c.pid;
+            IF owners IS NULL THEN
+                RETURN NULL;
+            END IF;
+
+            INSERT INTO user_tags (username, tagname, paper_count)
+                SELECT p.username, c.tagname, delta * COUNT(*)
+                FROM changed_tags c JOIN papers p ON p.pid = c.pid
+                GROUP BY p.username, c.tagname
+            ON CONFLICT (username, tagname) DO UPDATE SET paper_count = user_tags.paper_count + EXCLUDED.paper_count;
+            DELETE FROM user_tags u WHERE u.username = ANY(owners) AND u.paper_count <= 0;
+
+            INSERT INTO user_stats (username, tag_count)
+                SELECT o.username, (SELECT COUNT(*) FROM user_tags u WHERE u.username = o.username)
+                FROM unnest(owners) AS o(username)
+            ON CONFLICT (username) DO UPDATE SET tag_count = EXCLUDED.tag_count;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER tags_insert_stats_trigger AFTER INSERT ON tags
+            REFERENCING NEW TABLE AS changed_tags
+            FOR EACH STATEMENT EXECUTE PROCEDURE track_user_tags()
+        """,
+        """
+        CREATE TRIGGER tags_delete_stats_trigger AFTER DELETE ON tags
+            REFERENCING OLD TABLE AS changed_tags
+            FOR EACH STATEMENT EXECUTE PROCEDURE track_user_tags()
+        """,
     )
     cur = conn.cursor()
     for command in commands:
@@ -151,9 +606,15 @@ def reset_db(conn):
 
 # Basic APIs
 
+# Tables created by reset_db
+ALL_TABLES = ('users', 'papers', 'tagnames', 'likes', 'tags', 'extract_jobs', 'import_sources',
+              'user_similarity', 'recommendations', 'recommendation_queue', 'tag_pairs', 'user_stats',
+              'user_tags', 'blobs')
+
+
 # Check whether tables have been created
 def check_tables(conn):
-    print("[BEGIN] check_tables")
+    logger.debug("begin", api="check_tables")
 
     # Set autocommit as false
     conn.autocommit = False
@@ -162,19 +623,13 @@ def check_tables(conn):
         cur = conn.cursor()
         cur.execute("""SELECT COUNT(*) 
                        FROM information_schema.tables 
-                       WHERE table_name = 'users' OR 
-                             table_name = 'papers' OR 
-                             table_name = 'tagnames' OR 
-                             table_name = 'likes' OR 
-                             table_name = 'tags';""")
+                       WHERE table_name IN %s;""", (ALL_TABLES, ))
         res = cur.fetchone()[0]
 
-        print(res)
-
-        if res != 5:
+        if res != len(ALL_TABLES):
             reset_db(conn)
     except psy.DatabaseError, e:
-        traceback.print_exc()
+        logger.exception("db error", api="check_tables")
 
 
 # T.2
@@ -192,7 +647,7 @@ def signup(conn, uname, pwd):
         (1, None)   Failure -- Username is used
         (2, None)   Failure -- Other errors
     """
-    print("[BEGIN] signup")
+    logger.debug("begin", api="signup")
 
     # Check table exists or not
     check_tables(conn)
@@ -206,7 +661,7 @@ def signup(conn, uname, pwd):
             return 1, None
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="signup")
         conn.rollback()
         return 2, None
 
@@ -214,7 +669,7 @@ def signup(conn, uname, pwd):
         cur.execute("""INSERT INTO users (username, password) VALUES (%s, %s);""", (uname, pwd, ))
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="signup")
         conn.rollback()
         return 2, None
 
@@ -237,33 +692,34 @@ def login(conn, uname, pwd):
         (2, None)   Failure -- Password incorrect
         (3, None)   Failure -- Other errors
     """
-    print("[BEGIN] login")
+    logger.debug("begin", api="login")
 
     # Check table exists or not
     check_tables(conn)
     
     try:
         cur = conn.cursor()
-        cur.execute("""SELECT * FROM users WHERE username = %s;""", (uname, ))
+        statements.execute(cur, "login", """SELECT * FROM users WHERE username = %s;""", (uname, ))
         init_record = cur.fetchall()
         if len(init_record) == 0:
             # username does not exist
             return 1, None
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="login")
         conn.rollback()
         return 3, None
 
     try:
-        cur.execute("""SELECT * FROM users WHERE username = %s AND password = %s;""", (uname, pwd, ))
+        statements.execute(cur, "login",
+                           """SELECT * FROM users WHERE username = %s AND password = %s;""", (uname, pwd, ))
         init_record = cur.fetchall()
         if len(init_record) == 0:
             # password incorrect
             return 2, None
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="login")
         conn.rollback()
         return 3, None
 
@@ -276,7 +732,7 @@ def login(conn, uname, pwd):
 
 # If a tag in tags contain any non-alphanumeric characters, then remove it
 def check_tags(tags):
-    print("[BEGIN] check_tags")
+    logger.debug("begin", api="check_tags")
     res = []
 
     for tag in tags:
@@ -290,8 +746,17 @@ def check_tags(tags):
     return res;
 
 
+# Clean up tags with check_tags and cut them to the length of tagnames.tagname, then drop empty and
+# duplicated ones, keeping the given order
+def normalize_tags(tags):
+    checked_tags = [tag[:TAG_MAX_LENGTH] for tag in check_tags(tags)]
+    return [tag for i, tag in enumerate(checked_tags) if tag and tag not in checked_tags[:i]]
+
+
 # T.4
-def add_new_paper(conn, uname, title, desc, text, tags):
+@cache.invalidates('get_timeline_all', 'get_most_active_users', 'get_most_popular_tags',
+                   'get_most_popular_tag_pairs')
+def add_new_paper(conn, uname, title, desc, text, tags, blob = None, extract_path = None):
     """
     Create a new paper with  tags.
     Note that this API should touch multiple tables.
@@ -304,83 +769,208 @@ def add_new_paper(conn, uname, title, desc, text, tags):
     :param desc: A string of the description of the paper
     :param text: A string of the text content of the uploaded pdf file
     :param tags: A list of string, each element is a tag associate to the paper
+    :param blob: (sha256, size) of the stored pdf file, see storage.py, or None
+    :param extract_path: The pdf to extract the text from, or None; its extraction job is
+                         queued with the paper, see add_extract_job
     :return: (status, retval)
         (0, pid)    Success
                     Return the pid of the newly inserted paper in the res field of the return value
         (1, None)   Failure
     """
-    print("[BEGIN] add_new_paper")
+    logger.debug("begin", api="add_new_paper")
 
-    pid = 0;
+    tags = normalize_tags(tags)
+    sha256, size = blob if blob is not None else (None, None)
 
-    # First, create the paper
+    # Create the blob if it is new, the paper, its missing tagnames, its tags and its extraction job
+    # in one statement.
+    # The pid comes back from the insert itself, so concurrent uploads can not mix it up.
+    # An existing blob is updated rather than skipped to wait for a collect_blob removing it.
     try:
         cur = conn.cursor()
         curr_time = str(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"))
-        print(curr_time)
-        print(uname + "\t" + title + "\t" + curr_time + "\t" + desc)
-        cur.execute("""INSERT INTO papers (username, title, begin_time, description, data) 
-                     VALUES (%s, %s, %s, %s, %s);""", (uname, title, curr_time, desc, text, ))
+        cur.execute("""WITH new_blob AS (
+                          INSERT INTO blobs (sha256, size)
+                          SELECT %s, %s WHERE %s IS NOT NULL
+                          ON CONFLICT (sha256) DO UPDATE SET size = EXCLUDED.size
+                       ), new_paper AS (
+                          INSERT INTO papers (username, title, begin_time, description, data, blob)
+                          VALUES (%s, %s, %s, %s, %s, %s)
+                          RETURNING pid
+                       ), new_tagnames AS (
+                          INSERT INTO tagnames (tagname)
+                          SELECT t.tagname FROM unnest(%s::varchar[]) AS t(tagname) ORDER BY t.tagname
+                          ON CONFLICT DO NOTHING
+                       ), new_tags AS (
+                          INSERT INTO tags (pid, tagname)
+                          SELECT p.pid, t.tagname
+                          FROM new_paper p, unnest(%s::varchar[]) AS t(tagname)
+                       ), new_job AS (
+                          INSERT INTO extract_jobs (pid, file_path, state, attempts, error, update_time)
+                          SELECT p.pid, %s, %s, 0, NULL, %s
+                          FROM new_paper p
+                          WHERE %s IS NOT NULL
+                       )
+                       SELECT pid FROM new_paper;""", (sha256, size, sha256, uname, title, curr_time, desc, text,
+                                                       sha256, tags, tags, extract_path, EXTRACT_PENDING,
+                                                       curr_time, extract_path, ))
+        pid = cur.fetchone()[0]
+
+        logger.info("paper added", pid=pid, uname=uname)
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="add_new_paper")
         conn.rollback()
         return 1, None
 
-    # Second, get the most recent created paper
-    try:
-        cur.execute("""SELECT pid FROM papers WHERE username = %s ORDER BY begin_time DESC LIMIT 1;""", (uname, ))
-        # It returns a tupe, so need to clairify the index as 0
-        pid = cur.fetchone()[0]
+    # Success
+    conn.commit()
+    return 0, pid
+
+
+# Bulk import
+
+def copy_rows(cur, table, columns, rows):
+    """
+    Load rows into a table with COPY ... FROM STDIN in csv format
+    """
+    buf = cStringIO.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(["" if v is None else v for v in row])
+    buf.seek(0)
+    cur.copy_expert("COPY %s (%s) FROM STDIN WITH (FORMAT csv)" % (table, ", ".join(columns)), buf)
+
+
+def reserve_paper_ids(conn, count):
+    """
+    Draw $count pids from the papers sequence, so that rows can be bulk loaded with known pids
 
-        print(pid)
+    :param conn: A postgres database connection object
+    :param count: An integer
+    :return: (status, retval)
+        (0, [pid1, pid2, ...])  Success
+        (1, None)               Failure
+    """
+    logger.debug("begin", api="reserve_paper_ids")
+
+    try:
+        cur = conn.cursor()
+        cur.execute("""SELECT nextval(pg_get_serial_sequence('papers', 'pid'))
+                       FROM generate_series(1, %s);""", (count, ))
+        res = [item[0] for item in cur.fetchall()]
     except psy.DatabaseError, e:
         # Other errors
+        logger.exception("db error", api="reserve_paper_ids")
         conn.rollback()
-        traceback.print_exc()
         return 1, None
 
-    # Third, create tags
-    tags = check_tags(tags)
-    
-    for tag in tags:
-        # Check whether this tagname exists or not
-        try:
-            cur.execute("""SELECT * FROM tagnames WHERE tagname = %s;""", (tag, ))
-            init_record = cur.fetchall()
-            # If does not exist, then create the new tagname
-            if len(init_record) == 0:
-                try:
-                    cur.execute("""INSERT INTO tagnames (tagname) VALUES (%s);""", (tag, ))
-                except psy.DatabaseError, e:
-                    # Other errors
-                    conn.rollback()
-                    traceback.print_exc()
-                    return 1, None
-        except psy.DatabaseError, e:
-            # Other errors
-            conn.rollback()
-            traceback.print_exc()
-            return 1, None
+    # Success
+    return 0, res
 
-        # Insert into tags
-        try:
-            print(tag)
-            cur.execute("""INSERT INTO tags (pid, tagname) VALUES (%s, %s);""", (pid, tag, ))
-        except psy.DatabaseError, e:
-            # Other errors
-            conn.rollback()
-            traceback.print_exc()
-            return 1, None
+
+@cache.invalidates('get_timeline_all', 'get_most_active_users', 'get_most_popular_tags',
+                   'get_most_popular_tag_pairs')
+def bulk_add_papers(conn, papers):
+    """
+    Load many papers, their tags and where they were imported from in one transaction.
+    Papers, tags and sources are loaded with COPY; tagnames go through a temporary table so
+    that existing ones are skipped.
+
+    :param conn: A postgres database connection object
+    :param papers: A list of (pid, source, uname, title, begin_time, desc, text, tags).
+                   pid comes from reserve_paper_ids, source is a string identifying the imported
+                   file and tags is a list of string
+    :return: (status, retval)
+        (0, None)   Success
+        (1, None)   Failure -- Nothing is loaded
+    """
+    logger.debug("begin", api="bulk_add_papers")
+
+    paper_rows = []
+    tag_rows = []
+    for pid, source, uname, title, begin_time, desc, text, tags in papers:
+        # postgres text can not hold NUL characters
+        text = text.replace("\x00", "") if text is not None else None
+        paper_rows.append((pid, uname, title, begin_time, desc, text))
+        for tag in normalize_tags(tags):
+            tag_rows.append((pid, tag))
+
+    try:
+        cur = conn.cursor()
+        copy_rows(cur, "papers", ("pid", "username", "title", "begin_time", "description", "data"), paper_rows)
+        cur.execute("""CREATE TEMP TABLE import_tagnames(tagname VARCHAR(50)) ON COMMIT DROP;""")
+        copy_rows(cur, "import_tagnames", ("tagname", ), set((tag, ) for pid, tag in tag_rows))
+        cur.execute("""INSERT INTO tagnames (tagname)
+                       SELECT tagname FROM import_tagnames ORDER BY tagname
+                       ON CONFLICT DO NOTHING;""")
+        copy_rows(cur, "tags", ("pid", "tagname"), tag_rows)
+        copy_rows(cur, "import_sources", ("source", "pid"), [(p[1], p[0]) for p in papers])
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="bulk_add_papers")
+        conn.rollback()
+        return 1, None
 
     # Success
     conn.commit()
-    return 0, pid
+    return 0, None
+
+
+def get_imported_sources(conn):
+    """
+    Get the sources of all papers loaded by bulk_add_papers
+
+    :param conn: A postgres database connection object
+    :return: (status, retval)
+        (0, set([source1, source2, ...]))   Success
+        (1, None)                           Failure
+    """
+    logger.debug("begin", api="get_imported_sources")
+
+    try:
+        cur = conn.cursor()
+        cur.execute("""SELECT s.source FROM import_sources s;""")
+        res = set(item[0] for item in cur.fetchall())
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="get_imported_sources")
+        return 1, None
+
+    # Success
+    return 0, res
+
+
+def get_existing_users(conn, unames):
+    """
+    Tell which of the given usernames have an account, e.g. before bulk loading their papers
+
+    :param conn: A postgres database connection object
+    :param unames: A list of string
+    :return: (status, retval)
+        (0, set([uname1, uname2, ...]))     Success
+        (1, None)                           Failure
+    """
+    logger.debug("begin", api="get_existing_users")
+
+    try:
+        cur = conn.cursor()
+        cur.execute("""SELECT u.username FROM users u WHERE u.username = ANY(%s::varchar[]);""",
+                    (list(set(unames)), ))
+        res = set(item[0] for item in cur.fetchall())
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="get_existing_users")
+        return 1, None
+
+    # Success
+    return 0, res
 
 
 # T.5
 # It cannot delete a paper who doesn't have a local file, as in views.py
 # it will throw an exception when trying os.remove(filename)
+@cache.invalidates(*CACHED_PAPER_APIS)
 def delete_paper(conn, pid):
     """
     Delete a paper by the given pid.
@@ -388,10 +978,11 @@ def delete_paper(conn, pid):
     :param conn: A postgres database connection object
     :param pid: An int of pid
     :return: (status, retval)
-        (0, None)   Success
+        (0, blob)   Success, retval is the sha256 of the paper's pdf file, None if it is stored by pid.
+                    Pass it to collect_blob once the paper is gone.
         (1, None)   Failure
     """
-    print("[BEGIN] delete_paper")
+    logger.debug("begin", api="delete_paper")
 
     init_record = []
 
@@ -406,22 +997,154 @@ def delete_paper(conn, pid):
             return 1, None
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="delete_paper")
         return 1, None
 
     # Second, if doesn't exist, then delete
     try:
-        cur.execute("""DELETE FROM papers WHERE pid = %s;""", (pid, ))
+        cur.execute("""DELETE FROM papers WHERE pid = %s RETURNING blob;""", (pid, ))
+        blob = cur.fetchone()[0]
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="delete_paper")
         conn.rollback()
         return 1, None
 
-    print("Success")
+    logger.info("paper deleted", pid=pid)
 
     # Success
-    return 0, None
+    conn.commit()
+    cache.bump_items(CARD_NAMESPACE, [pid])
+    return 0, blob
+
+
+# Pdf storage, see storage.py
+
+def get_paper_blob(conn, pid):
+    """
+    Get the sha256 of the pdf file of a paper
+
+    :param conn: A postgres database connection object
+    :param pid: An int of pid
+    :return: (status, retval)
+        (0, sha256) Success, None if the file is stored by pid
+        (1, None)   Failure -- No such paper
+    """
+    logger.debug("begin", api="get_paper_blob")
+
+    try:
+        cur = conn.cursor()
+        statements.execute(cur, "get_paper_blob", """SELECT p.blob FROM papers p WHERE p.pid = %s;""", (pid, ))
+        item = cur.fetchone()
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="get_paper_blob")
+        return 1, None
+
+    if item is None:
+        return 1, None
+
+    # Success
+    return 0, item[0]
+
+
+def get_blob_text(conn, sha256):
+    """
+    Get the text extracted from a stored pdf file
+
+    :param conn: A postgres database connection object
+    :param sha256: A string of the sha256 of the file
+    :return: (status, retval)
+        (0, text)   Success, None if the file is unknown or its text is not extracted yet
+        (1, None)   Failure
+    """
+    logger.debug("begin", api="get_blob_text")
+
+    try:
+        cur = conn.cursor()
+        statements.execute(cur, "get_blob_text", """SELECT b.data FROM blobs b WHERE b.sha256 = %s;""", (sha256, ))
+        item = cur.fetchone()
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="get_blob_text")
+        return 1, None
+
+    # Success
+    return 0, item[0] if item is not None else None
+
+
+def collect_blob(conn, sha256, remove):
+    """
+    Forget a stored pdf file that no paper references anymore.
+    The blob row is deleted first, so that a paper still referencing it (a drifted ref_count)
+    makes the delete fail on its foreign key before anything is lost. remove(sha256) then
+    deletes the file before the commit, while the row is locked, so that an upload of the
+    same file waits in add_new_paper until the file is gone and then stores it again.
+
+    :param conn: A postgres database connection object
+    :param sha256: A string of the sha256 of the file
+    :param remove: A function removing the file of a sha256
+    :return: (status, retval)
+        (0, True)   Success, the file is removed
+        (0, False)  Success, the file is still referenced
+        (1, None)   Failure
+    """
+    logger.debug("begin", api="collect_blob")
+
+    try:
+        cur = conn.cursor()
+        cur.execute("""SELECT b.sha256 FROM blobs b
+                       WHERE b.sha256 = %s AND b.ref_count <= 0
+                       FOR UPDATE;""", (sha256, ))
+        if cur.fetchone() is None:
+            conn.rollback()
+            return 0, False
+        cur.execute("""DELETE FROM blobs WHERE sha256 = %s;""", (sha256, ))
+        remove(sha256)
+    except (IOError, OSError), e:
+        # The file is still there, keep its row
+        logger.exception("can not remove blob", sha256=sha256)
+        conn.rollback()
+        return 1, None
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="collect_blob")
+        conn.rollback()
+        return 1, None
+
+    # Success
+    conn.commit()
+    return 0, True
+
+
+def repair_blob_counts(conn):
+    """
+    Recompute blobs.ref_count from the papers table
+
+    :param conn: A postgres database connection object
+    :return: (status, retval)
+        (0, fixed)  Success, retval is the number of blobs whose count was wrong
+        (1, None)   Failure
+    """
+    logger.debug("begin", api="repair_blob_counts")
+
+    try:
+        cur = conn.cursor()
+        cur.execute("""UPDATE blobs b SET ref_count = c.ref_count
+                       FROM (SELECT b.sha256, COUNT(p.pid) AS ref_count
+                             FROM blobs b LEFT JOIN papers p ON p.blob = b.sha256
+                             GROUP BY b.sha256) c
+                       WHERE b.sha256 = c.sha256 AND b.ref_count != c.ref_count;""")
+        fixed = cur.rowcount
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="repair_blob_counts")
+        conn.rollback()
+        return 1, None
+
+    # Success
+    conn.commit()
+    return 0, fixed
 
 
 # T.10
@@ -440,102 +1163,327 @@ def get_paper_tags(conn, pid):
 
         (1, None)                   Failure
     """
-    print("[BEGIN] get_paper_tags")
+    logger.debug("begin", api="get_paper_tags")
     res = []
 
     # Get all the tags
     try:
         cur = conn.cursor()
-        cur.execute("""SELECT * 
-                       FROM tags 
-                       WHERE pid = %s 
-                       ORDER BY tagname ASC;""", (pid, ))
+        statements.execute(cur, "get_paper_tags",
+                           """SELECT * 
+                              FROM tags 
+                              WHERE pid = %s 
+                              ORDER BY tagname ASC;""", (pid, ))
         items = cur.fetchall()
 
         for item in items:
             res.append(item[1])
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="get_paper_tags")
         return 1, None
-
-    print(res)
     
     # Success
     return 0, res
 
-# Vote related
+# Extraction related
 
 
-# T.11 - Like
-def like_paper(conn, uname, pid):
+def add_extract_job(conn, pid, file_path):
     """
-    Record a like for a paper. Timestamped the like with the current timestamp
-
-    You need to ensure that (1) a user should not like his/her own paper, (2) a user can not like a paper twice.
+    Queue the text extraction of a paper's pdf. The paper keeps an empty data field
+    until finish_extract_job is called. Re-adding an existing job resets it.
 
     :param conn: A postgres database connection object
-    :param uname: A string of username
     :param pid: An int of pid
+    :param file_path: A string of the path of the uploaded pdf file
     :return: (status, retval)
         (0, None)   Success
         (1, None)   Failure
     """
-    print("[BEGIN] like_paper")
+    logger.debug("begin", api="add_extract_job")
 
-    # First, check whether it is his paper
     try:
         cur = conn.cursor()
-        cur.execute("""SELECT pid FROM papers WHERE pid = %s AND username != %s;""", (pid, uname, ))
-        init_record = cur.fetchall()
+        curr_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        cur.execute("""INSERT INTO extract_jobs (pid, file_path, state, attempts, error, update_time)
+                       VALUES (%s, %s, %s, 0, NULL, %s)
+                       ON CONFLICT (pid) DO UPDATE
+                       SET file_path = EXCLUDED.file_path, state = EXCLUDED.state,
+                          attempts = 0, error = NULL, update_time = EXCLUDED.update_time;""",
+                    (pid, file_path, EXTRACT_PENDING, curr_time, ))
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="add_extract_job")
+        conn.rollback()
+        return 1, None
+
+    # Success
+    conn.commit()
+    return 0, None
 
-        print(init_record)
 
-        # If it is his paper, then fail
-        if len(init_record) == 0:
-            print("1, None")
-            return 1, None
+def get_extract_job(conn, pid):
+    """
+    Get the extraction job of a paper
+
+    :param conn: A postgres database connection object
+    :param pid: An int of pid
+    :return: (status, retval)
+        (0, (pid, file_path, state, attempts, error, update_time))
+            Success, state is one of EXTRACT_PENDING, EXTRACT_DONE and EXTRACT_FAILED
+        (1, None)   Failure -- No such job
+    """
+    logger.debug("begin", api="get_extract_job")
+
+    try:
+        cur = conn.cursor()
+        statements.execute(cur, "get_extract_job",
+                           """SELECT j.pid, j.file_path, j.state, j.attempts, j.error, j.update_time
+                              FROM extract_jobs j
+                              WHERE j.pid = %s;""", (pid, ))
+        res = cur.fetchone()
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
-        print("11, None")
+        logger.exception("db error", api="get_extract_job")
+        return 1, None
+
+    if res is None:
         return 1, None
 
-    # Second, whether the user has liked the paper
+    # Success
+    return 0, res
+
+
+def get_extract_jobs_by_state(conn, state):
+    """
+    Get the pids and file paths of all extraction jobs in a given state, oldest first
+
+    :param conn: A postgres database connection object
+    :param state: A string of job state
+    :return: (status, retval)
+        (0, [(pid, file_path), (...), ...])     Success
+        (1, None)                               Failure
+    """
+    logger.debug("begin", api="get_extract_jobs_by_state")
+
     try:
-        cur.execute("""SELECT * FROM likes WHERE pid = %s AND username = %s;""", (pid, uname, ))
-        init_record = cur.fetchall()
+        cur = conn.cursor()
+        cur.execute("""SELECT j.pid, j.file_path
+                       FROM extract_jobs j
+                       WHERE j.state = %s
+                       ORDER BY j.update_time ASC, j.pid ASC;""", (state, ))
+        res = cur.fetchall()
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="get_extract_jobs_by_state")
+        return 1, None
 
-        print(init_record)
+    # Success
+    return 0, res
 
-        # If the user has liked the paper, then fail
-        if len(init_record) > 0:
-            print("111, None")
+
+def resume_stale_extract_jobs(conn):
+    """
+    Take over the extraction jobs pending for more than EXTRACT_STALE_SECONDS, whose process
+    most likely exited before finishing them. They are marked as pending again right away,
+    so concurrent callers never get the same job.
+    The lost run counts as an attempt: a pdf that kills its worker every time must not be
+    queued forever. A job whose attempts are used up is returned as exhausted, without
+    counting it here, and should be recorded with fail_extract_job instead of queued.
+
+    :param conn: A postgres database connection object
+    :return: (status, retval)
+        (0, [(pid, file_path, exhausted), (...), ...])  Success
+        (1, None)                                       Failure
+    """
+    logger.debug("begin", api="resume_stale_extract_jobs")
+
+    try:
+        cur = conn.cursor()
+        now = datetime.datetime.now()
+        curr_time = now.strftime("%Y-%m-%d %H:%M:%S.%f")
+        stale_time = (now - datetime.timedelta(seconds=EXTRACT_STALE_SECONDS)).strftime("%Y-%m-%d %H:%M:%S.%f")
+        cur.execute("""UPDATE extract_jobs
+                       SET update_time = %s,
+                           attempts = attempts + CASE WHEN attempts + 1 < %s THEN 1 ELSE 0 END
+                       WHERE state = %s AND update_time < %s
+                       RETURNING pid, file_path, attempts + 1 >= %s;""",
+                    (curr_time, EXTRACT_MAX_ATTEMPTS, EXTRACT_PENDING, stale_time, EXTRACT_MAX_ATTEMPTS, ))
+        res = cur.fetchall()
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="resume_stale_extract_jobs")
+        conn.rollback()
+        return 1, None
+
+    # Success
+    conn.commit()
+    return 0, res
+
+
+def finish_extract_job(conn, pid, text):
+    """
+    Store the extracted text of a paper and mark its job as done
+
+    :param conn: A postgres database connection object
+    :param pid: An int of pid
+    :param text: A string of the text content of the pdf file
+    :return: (status, retval)
+        (0, None)   Success
+        (1, None)   Failure -- The paper or the job is gone
+    """
+    logger.debug("begin", api="finish_extract_job")
+
+    try:
+        cur = conn.cursor()
+        curr_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        cur.execute("""UPDATE extract_jobs
+                       SET state = %s, attempts = attempts + 1, error = NULL, update_time = %s
+                       WHERE pid = %s;""", (EXTRACT_DONE, curr_time, pid, ))
+        if cur.rowcount == 0:
+            conn.rollback()
             return 1, None
+        cur.execute("""UPDATE papers SET data = %s WHERE pid = %s;""", (text, pid, ))
+        # Keep the text for later uploads of the same file
+        cur.execute("""UPDATE blobs b SET data = %s
+                       FROM papers p
+                       WHERE p.pid = %s AND b.sha256 = p.blob;""", (text, pid, ))
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
-        print("1111, None")
+        logger.exception("db error", api="finish_extract_job")
+        conn.rollback()
         return 1, None
 
-    # Third, like it
+    # Success
+    conn.commit()
+    return 0, None
+
+
+def fail_extract_job(conn, pid, error):
+    """
+    Record a failed extraction attempt
+
+    :param conn: A postgres database connection object
+    :param pid: An int of pid
+    :param error: A string describing the error
+    :return: (status, retval)
+        (0, attempts)   Success, retval is the number of attempts made so far
+        (1, None)       Failure -- The job is gone
+    """
+    logger.debug("begin", api="fail_extract_job")
+
     try:
+        cur = conn.cursor()
         curr_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-        cur.execute("""INSERT INTO likes (username, pid, like_time) VALUES (%s, %s, %s);""", (uname, pid, curr_time, ))
+        cur.execute("""UPDATE extract_jobs
+                       SET state = %s, attempts = attempts + 1, error = %s, update_time = %s
+                       WHERE pid = %s
+                       RETURNING attempts;""", (EXTRACT_FAILED, error, curr_time, pid, ))
+        res = cur.fetchone()
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="fail_extract_job")
+        conn.rollback()
+        return 1, None
+
+    if res is None:
+        conn.rollback()
+        return 1, None
+
+    # Success
+    conn.commit()
+    return 0, res[0]
+
+
+def retry_extract_job(conn, pid):
+    """
+    Move a failed extraction job back to the pending state. A job pending for more than
+    EXTRACT_STALE_SECONDS, e.g. queued by a process that was restarted, is taken over too.
+
+    :param conn: A postgres database connection object
+    :param pid: An int of pid
+    :return: (status, retval)
+        (0, file_path)  Success, retval is the pdf to extract again
+        (1, None)       Failure -- No such job or the job has neither failed nor stalled
+    """
+    logger.debug("begin", api="retry_extract_job")
+
+    try:
+        cur = conn.cursor()
+        now = datetime.datetime.now()
+        curr_time = now.strftime("%Y-%m-%d %H:%M:%S.%f")
+        stale_time = (now - datetime.timedelta(seconds=EXTRACT_STALE_SECONDS)).strftime("%Y-%m-%d %H:%M:%S.%f")
+        cur.execute("""UPDATE extract_jobs
+                       SET state = %s, update_time = %s
+                       WHERE pid = %s AND (state = %s OR (state = %s AND update_time < %s))
+                       RETURNING file_path;""", (EXTRACT_PENDING, curr_time, pid, EXTRACT_FAILED,
+                                                 EXTRACT_PENDING, stale_time, ))
+        res = cur.fetchone()
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="retry_extract_job")
+        conn.rollback()
+        return 1, None
+
+    if res is None:
         conn.rollback()
-        print("11111, None")
         return 1, None
 
     # Success
     conn.commit()
-    print("0, None")
+    return 0, res[0]
+
+# Vote related
+
+
+# T.11 - Like
+@cache.invalidates(*CACHED_LIKE_APIS)
+def like_paper(conn, uname, pid):
+    """
+    Record a like for a paper. Timestamped the like with the current timestamp
+
+    You need to ensure that (1) a user should not like his/her own paper, (2) a user can not like a paper twice.
+
+    :param conn: A postgres database connection object
+    :param uname: A string of username
+    :param pid: An int of pid
+    :return: (status, retval)
+        (0, None)   Success
+        (1, None)   Failure
+    """
+    logger.debug("begin", api="like_paper")
+
+    # Insert the like only if the paper exists and is not the user's, and only once.
+    # Checking and inserting in one statement also keeps concurrent likes from racing.
+    try:
+        cur = conn.cursor()
+        curr_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        statements.execute(cur, "like_paper",
+                           """INSERT INTO likes (username, pid, like_time)
+                              SELECT %s::varchar, p.pid, %s::timestamp FROM papers p
+                              WHERE p.pid = %s AND p.username != %s
+                              ON CONFLICT DO NOTHING
+                              RETURNING pid;""", (uname, curr_time, pid, uname, ))
+        if cur.fetchone() is None:
+            conn.rollback()
+            return 1, None
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="like_paper")
+        conn.rollback()
+        return 1, None
+
+    # Success
+    conn.commit()
+    cache.bump_items(CARD_NAMESPACE, [pid])
+    # The user and the others sharing the paper are queued by the trigger on likes, see
+    # refresh_queued_recommendations
     return 0, None
 
 
 # T.11 - Unlike
+@cache.invalidates(*CACHED_LIKE_APIS)
 def unlike_paper(conn, uname, pid):
     """
     Record an unlike for a paper
@@ -549,81 +1497,298 @@ def unlike_paper(conn, uname, pid):
         (0, None)   Success
         (1, None)   Failure
     """
-    print("[BEGIN] unlike_paper")
+    logger.debug("begin", api="unlike_paper")
 
-    # First, check whether it is his paper
+    # A user never has a like on his own paper, so deleting the like is the whole check
     try:
         cur = conn.cursor()
-        cur.execute("""SELECT pid FROM papers WHERE pid = %s AND username != %s;""", (pid, uname, ))
-        init_record = cur.fetchall()
-        # If it is his paper, then fail
-        if len(init_record) == 0:
+        statements.execute(cur, "unlike_paper",
+                           """DELETE FROM likes WHERE pid = %s AND username = %s RETURNING pid;""", (pid, uname, ))
+        if cur.fetchone() is None:
+            conn.rollback()
             return 1, None
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="unlike_paper")
+        conn.rollback()
         return 1, None
 
-    # Second, whether the user has liked the paper
+    # Success
+    conn.commit()
+    cache.bump_items(CARD_NAMESPACE, [pid])
+    # The user and the others sharing the paper are queued by the trigger on likes, see
+    # refresh_queued_recommendations
+    return 0, None
+
+
+# T.11 - Batched
+@cache.invalidates(*CACHED_LIKE_APIS)
+def apply_likes(conn, likes, unlikes):
+    """
+    Record many likes and unlikes in one transaction, e.g. the events buffered by like_buffer.py.
+    Likes of missing papers, of the user's own papers or that already exist are skipped, and so
+    are unlikes of likes that do not exist.
+    Concurrent batches, e.g. of the flushers of several processes, must not deadlock: the
+    papers and the user_stats rows the triggers update are locked first, in pid and username
+    order, and the events are written in (pid, uname) order.
+
+    :param conn: A postgres database connection object
+    :param likes: A list of (uname, pid) to like
+    :param unlikes: A list of (uname, pid) to unlike, none of them in likes
+    :return: (status, retval)
+        (0, (liked, unliked))   Success, retval is the number of likes added and removed
+        (1, None)               Failure -- Nothing is recorded
+    """
+    logger.debug("begin", api="apply_likes")
+
+    likes = sorted(likes, key=lambda item: (item[1], item[0]))
+    unlikes = sorted(unlikes, key=lambda item: (item[1], item[0]))
+    try:
+        cur = conn.cursor()
+        cur.execute("""SELECT 1 FROM papers WHERE pid = ANY(%s) ORDER BY pid FOR NO KEY UPDATE;""",
+                    (sorted(set(item[1] for item in likes + unlikes)), ))
+        cur.execute("""SELECT 1 FROM user_stats WHERE username = ANY(%s) ORDER BY username
+                       FOR NO KEY UPDATE;""",
+                    (sorted(set(item[0] for item in likes + unlikes)), ))
+        cur.execute("""DELETE FROM likes l
+                       USING unnest(%s::varchar[], %s::int[]) AS u(username, pid)
+                       WHERE l.username = u.username AND l.pid = u.pid
+                       RETURNING l.username;""",
+                    ([item[0] for item in unlikes], [item[1] for item in unlikes], ))
+        unliked = [item[0] for item in cur.fetchall()]
+        curr_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        cur.execute("""INSERT INTO likes (username, pid, like_time)
+                       SELECT n.username, n.pid, %s
+                       FROM unnest(%s::varchar[], %s::int[]) AS n(username, pid)
+                       JOIN papers p ON p.pid = n.pid AND p.username != n.username
+                       JOIN users u ON u.username = n.username
+                       ORDER BY n.pid, n.username
+                       ON CONFLICT DO NOTHING
+                       RETURNING username;""",
+                    (curr_time, [item[0] for item in likes], [item[1] for item in likes], ))
+        liked = [item[0] for item in cur.fetchall()]
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="apply_likes")
+        conn.rollback()
+        return 1, None
+
+    # Success
+    conn.commit()
+    cache.bump_items(CARD_NAMESPACE, set(item[1] for item in likes + unlikes))
+    return 0, (len(liked), len(unliked))
+
+
+# T.12
+def get_likes(conn, pid):
+    """
+    Get the number of likes of a paper
+
+    :param conn: A postgres database connection object
+    :param pid: An int of pid
+    :return: (status, retval)
+        (0, like_count)     Success, retval should be an integer of like count
+        (1, None)           Failure
+    """
+    logger.debug("begin", api="get_likes")
+    count = 0
+
+    try:
+        cur = conn.cursor()
+        statements.execute(cur, "get_likes", """SELECT p.like_count FROM papers p WHERE p.pid = %s;""", (pid, ))
+        item = cur.fetchone()
+        count = item[0] if item else 0
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="get_likes")
+        return 1, None
+
+    # Success
+    return 0, count
+
+
+# T.12 - Like state
+def get_like_state(conn, uname, pid):
+    """
+    Get whether a user likes a paper, its number of likes and whether it is the user's own,
+    e.g. to answer a like that is repeated or an unlike of a like that is already gone
+
+    :param conn: A postgres database connection object
+    :param uname: A string of username
+    :param pid: An int of pid
+    :return: (status, retval)
+        (0, (liked, like_count, own))   Success
+        (1, None)                       Failure, or the paper does not exist
+    """
+    logger.debug("begin", api="get_like_state")
+
     try:
-        cur.execute("""SELECT * FROM likes WHERE pid = %s AND username = %s;""", (pid, uname, ))
-        init_record = cur.fetchall()
-        # If the user hasn't liked the paper, then fail
-        if len(init_record) == 0:
-            return 1, None
+        cur = conn.cursor()
+        cur.execute("""SELECT EXISTS (SELECT 1 FROM likes l WHERE l.pid = p.pid AND l.username = %s),
+                              p.like_count, p.username = %s
+                       FROM papers p WHERE p.pid = %s;""", (uname, uname, pid, ))
+        item = cur.fetchone()
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="get_like_state")
+        return 1, None
+
+    if item is None:
         return 1, None
+    # Success
+    return 0, tuple(item)
+
+
+# T.12 - Batched
+def get_likes_tags_batch(conn, pids):
+    """
+    Get the like counts and tags of many papers at once
+
+    Uses one lookup of the like counters and one scan over tags regardless of how many pids are given,
+    so that a page of papers can be decorated in a constant number of round trips.
+
+    :param conn: A postgres database connection object
+    :param pids: A list of int of pid
+    :return: (status, retval)
+        (0, ({pid: like_count, ...}, {pid: [tag1, tag2, ...], ...}))
+            Success, every given pid is present in both dicts. Papers without likes have a count of 0
+            and papers without tags have an empty list. Tags are sorted in a lexical ascending order.
+        (1, None)   Failure
+    """
+    logger.debug("begin", api="get_likes_tags_batch")
+    pids = list(set(int(pid) for pid in pids))
+    likes = dict((pid, 0) for pid in pids)
+    tags = dict((pid, []) for pid in pids)
+
+    if len(pids) == 0:
+        return 0, (likes, tags)
 
-    # Third, unlike it
     try:
-        curr_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-        cur.execute("""DELETE FROM likes WHERE pid = %s AND username = %s;""", (pid, uname, ))
+        cur = conn.cursor()
+        statements.execute(cur, "get_likes_tags_batch",
+                           """SELECT p.pid, p.like_count
+                              FROM papers p
+                              WHERE p.pid = ANY(%s);""", (pids, ))
+        for item in cur.fetchall():
+            likes[item[0]] = int(item[1])
+
+        statements.execute(cur, "get_likes_tags_batch",
+                           """SELECT t.pid, t.tagname
+                              FROM tags t
+                              WHERE t.pid = ANY(%s)
+                              ORDER BY t.pid ASC, t.tagname ASC;""", (pids, ))
+        for item in cur.fetchall():
+            tags[item[0]].append(item[1])
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
-        conn.rollback()
+        logger.exception("db error", api="get_likes_tags_batch")
         return 1, None
 
     # Success
-    conn.commit()
-    return 0, None
+    return 0, (likes, tags)
 
 
-# T.12
-def get_likes(conn, pid):
+def repair_like_counts(conn):
     """
-    Get the number of likes of a paper
+    Recompute every paper's like counter from the likes table, fixing drifted ones
 
     :param conn: A postgres database connection object
-    :param pid: An int of pid
     :return: (status, retval)
-        (0, like_count)     Success, retval should be an integer of like count
-        (1, None)           Failure
+        (0, fixed)  Success, retval is the number of papers whose counter was wrong
+        (1, None)   Failure
     """
-    print("[BEGIN] get_likes")
-    count = 0
+    logger.debug("begin", api="repair_like_counts")
 
     try:
         cur = conn.cursor()
-        cur.execute("""SELECT COUNT(*) FROM likes WHERE pid = %s;""", (pid, ))
-        count = cur.fetchone()[0]
+        cur.execute("""UPDATE papers p
+                       SET like_count = c.count_likes
+                       FROM (
+                          SELECT p2.pid, COUNT(l.pid) AS count_likes
+                          FROM papers p2 LEFT JOIN likes l ON p2.pid = l.pid
+                          GROUP BY p2.pid
+                       ) c
+                       WHERE p.pid = c.pid AND p.like_count != c.count_likes;""")
+        fixed = cur.rowcount
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="repair_like_counts")
+        conn.rollback()
         return 1, None
 
-    print(count)
-
     # Success
-    return 0, count
+    conn.commit()
+    return 0, fixed
 
 # Search related
 
+class Page(list):
+    """
+    A page of a paper list, as returned by the list APIs below.
+    next_cursor is an opaque string to pass as $cursor to get the following page,
+    or None on the last page.
+    """
+    next_cursor = None
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+# Check of the sort value of a cursor, by the cast keyset_condition applies to it
+CURSOR_VALUE_CHECKS = {
+    "::timestamp": lambda value: isinstance(value, basestring) and
+                                 bool(datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f")),
+    "::int": lambda value: isinstance(value, (int, long)) and not isinstance(value, bool),
+    "::real": lambda value: isinstance(value, (int, long, float)) and not isinstance(value, bool),
+}
+
+
+def decode_cursor(cursor, size):
+    """
+    Decode a cursor made by encode_cursor. Raise ValueError if it is malformed.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except TypeError:
+        raise ValueError("malformed cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("malformed cursor")
+    return values
+
+
+def keyset_condition(cursor, expr, cast):
+    """
+    Build the SQL condition selecting the rows after a cursor, for lists ordered by
+    $expr descending, then pid ascending. Return the condition and its parameters.
+    The leading $expr <= value is a range bound postgres can start a (expr DESC, pid ASC)
+    index scan from, so page N costs the same as page 1; the rest only drops the ties
+    already shown. Raise ValueError if the cursor does not hold a value of type $cast.
+    """
+    if cursor is None:
+        return "TRUE", ()
+    value, pid = decode_cursor(cursor, 2)
+    if not isinstance(pid, (int, long)) or isinstance(pid, bool) or not CURSOR_VALUE_CHECKS[cast](value):
+        raise ValueError("malformed cursor")
+    return ("%s <= %%s%s AND (%s < %%s%s OR (%s = %%s%s AND p.pid > %%s))" % (expr, cast, expr, cast, expr, cast),
+            (value, value, value, pid))
+
+
+def make_page(items, count, key = lambda item: item[3].strftime("%Y-%m-%d %H:%M:%S.%f")):
+    """
+    Build a Page from up to $count + 1 fetched rows. Only the quintuples of the first
+    $count rows are kept; the extra row only tells that there is a following page.
+    $key gives the sort value of a row, by default its begin_time.
+    """
+    page = Page(tuple(item[:5]) for item in items[:count])
+    if len(items) > count and count > 0:
+        page.next_cursor = encode_cursor([key(items[count - 1]), items[count - 1][0]])
+    return page
+
+
 
 # T.6
-def get_timeline(conn, uname, count = 10):
+def get_timeline(conn, uname, count = 10, cursor = None):
     """
     Get timeline of a user.
 
@@ -633,9 +1798,11 @@ def get_timeline(conn, uname, count = 10):
     :param conn: A postgres database connection object
     :param uname: A string of username
     :param count: An int indicating the maximum number of papers you can return
+    :param cursor: The next_cursor of the previous page, None for the first page
     :return: (status, retval)
         (0, [(pid, username, title, begin_time, description), (...), ...])
-          Success, retval is a list of quintuple. Each element of the quintuple is of the following type:
+          Success, retval is a Page (a list with a next_cursor) of quintuple. Each element of the quintuple is of
+          the following type:
             pid --  Integer
             username, title, description -- String
             begin_time  -- A datetime.datetime object
@@ -652,31 +1819,34 @@ def get_timeline(conn, uname, count = 10):
         (1, None)
             Failure
     """
-    print("[BEGIN] get_timeline")
+    logger.debug("begin", api="get_timeline")
     res = []
 
     try:
+        after, after_args = keyset_condition(cursor, "p.begin_time", "::timestamp")
         cur = conn.cursor()
-        cur.execute("""SELECT p.pid, p.username, p.title, p.begin_time, p.description 
-                       FROM papers p
-                       WHERE p.username = %s
-                       GROUP BY p.pid, p.username, p.title, p.begin_time, p.description
-                       ORDER BY p.begin_time DESC, p.pid ASC
-                       LIMIT %s;""", (uname, count, ))
-        res = cur.fetchall()
+        statements.execute(cur, "get_timeline",
+                           """SELECT p.pid, p.username, p.title, p.begin_time, p.description 
+                              FROM papers p
+                              WHERE p.username = %s AND """ + after + """
+                              ORDER BY p.begin_time DESC, p.pid ASC
+                              LIMIT %s;""", (uname, ) + after_args + (count + 1, ))
+        res = make_page(cur.fetchall(), count)
+    except ValueError:
+        # Malformed cursor
+        return 1, None
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="get_timeline")
         return 1, None
 
-    print(res)
-
     # Success
     return 0, res
 
 
 # T.7
-def get_timeline_all(conn, count = 10):
+@cache.cached()
+def get_timeline_all(conn, count = 10, cursor = None):
     """
     Get at most $count recent papers
 
@@ -684,37 +1854,42 @@ def get_timeline_all(conn, count = 10):
 
     :param conn: A postgres database connection object
     :param count: An int indicating the maximum number of papers you can return
+    :param cursor: The next_cursor of the previous page, None for the first page
     :return: (status, retval)
         (0, [pid, username, title, begin_time, description), (...), ...])
-            Success, retval is a list of quintuple. Please refer to the format defined in get_timeline()'s return value
+            Success, retval is a Page (a list) of quintuple. Please refer to the format defined in get_timeline()'s return value
 
         (1, None)
             Failure
     """
-    print("[BEGIN] get_timeline_all")
+    logger.debug("begin", api="get_timeline_all")
     res = []
 
     try:
+        after, after_args = keyset_condition(cursor, "p.begin_time", "::timestamp")
         cur = conn.cursor()
-        cur.execute("""SELECT p.pid, p.username, p.title, p.begin_time, p.description 
-                       FROM papers p
-                       GROUP BY p.pid, p.username, p.title, p.begin_time, p.description
-                       ORDER BY p.begin_time DESC, p.pid ASC
-                       LIMIT %s;""", (count, ))
-        res = cur.fetchall()
+        statements.execute(cur, "get_timeline_all",
+                           """SELECT p.pid, p.username, p.title, p.begin_time, p.description 
+                              FROM papers p
+                              WHERE """ + after + """
+                              ORDER BY p.begin_time DESC, p.pid ASC
+                              LIMIT %s;""", after_args + (count + 1, ))
+        res = make_page(cur.fetchall(), count)
+    except ValueError:
+        # Malformed cursor
+        return 1, None
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="get_timeline_all")
         return 1, None
 
-    print(res)
-
     # Success
     return 0, res
 
 
 # T.14
-def get_most_popular_papers(conn, begin_time, count = 10):
+@cache.cached()
+def get_most_popular_papers(conn, begin_time, count = 10, cursor = None):
     """
     Get at most $count papers posted after $begin_time according that have the most likes.
 
@@ -724,45 +1899,36 @@ def get_most_popular_papers(conn, begin_time, count = 10):
     :param conn: A postgres database connection object
     :param begin_time: A datetime.datetime object
     :param count:   An integer
+    :param cursor: The next_cursor of the previous page, None for the first page
     :return: (status, retval)
         (0, [pid, username, title, begin_time, description), (...), ...])
-            Success, retval is a list of quintuple. Please refer to the format defined in get_timeline()'s return value
+            Success, retval is a Page (a list) of quintuple. Please refer to the format defined in get_timeline()'s return value
 
         (1, None)
             Failure
     """
-    print("[BEGIN] get_most_popular_papers")
+    logger.debug("begin", api="get_most_popular_papers")
     res = []
 
     try:
         cur = conn.cursor()
-        cur.execute("""WITH paper_leftjoin_like AS (
-                       SELECT p.pid, p.username, p.title, p.begin_time, p.description, l.username AS l_username
-                       FROM papers p LEFT JOIN likes l ON p.pid = l.pid
-                       )
-                       SELECT p.pid, p.username, p.title, p.begin_time, p.description,
-                          SUM(CASE WHEN l_username IS NOT NULL THEN 1 ELSE 0 END) AS count_likes
-                       FROM paper_leftjoin_like p
-                       WHERE p.begin_time > %s
-                       GROUP BY p.pid, p.username, p.title, p.begin_time, p.description
-                       ORDER BY count_likes DESC, p.pid ASC
-                       LIMIT %s;""", (begin_time, count, ))
-        items = cur.fetchall()
-
-        # Remove number of likes
-        for item in items:
-            # Remove papers with 0 likes
-            if int(item[5]) == 0:
-                break
-            temp = (item[0], item[1], item[2], item[3], item[4])
-            res.append(temp)
+        after, after_args = keyset_condition(cursor, "p.like_count", "::int")
+        # Walks paper_like_count_idx, papers with 0 like are not in it
+        statements.execute(cur, "get_most_popular_papers",
+                           """SELECT p.pid, p.username, p.title, p.begin_time, p.description, p.like_count
+                              FROM papers p
+                              WHERE p.like_count > 0 AND p.begin_time > %s AND """ + after + """
+                              ORDER BY p.like_count DESC, p.pid ASC
+                              LIMIT %s;""", (begin_time, ) + after_args + (count + 1, ))
+        res = make_page(cur.fetchall(), count, lambda item: item[5])
+    except ValueError:
+        # Malformed cursor
+        return 1, None
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="get_most_popular_papers")
         return 1, None
 
-    print(res)
-
     # Success
     return 0, res
 
@@ -773,6 +1939,8 @@ def get_recommend_papers(conn, uname, count = 10):
     Recommended at most $count papers for a user.
 
     Check T.15 in the project writeup for detailed description of this API.
+    Recommendations are precomputed by refresh_recommendations, so this is a single lookup
+    on recommendations_score_idx; at most RECOMMEND_TOP_K papers are kept per user.
 
     :param conn: A postgres database connection object
     :param uname: A string of username
@@ -784,51 +1952,153 @@ def get_recommend_papers(conn, uname, count = 10):
         (1, None)
             Failure
     """
-    print("[BEGIN] get_recommend_papers")
+    logger.debug("begin", api="get_recommend_papers")
     res = []
 
     try:
         cur = conn.cursor()
-        cur.execute("""WITH cohort_users AS (
-                       SELECT u2.username
-                       FROM users u1, users u2, likes l1, likes l2
-                       WHERE u1.username = %s AND
-                          u1.username != u2.username AND
-                          u1.username = l1.username AND
-                          l1.pid = l2.pid AND
-                          u2.username = l2.username
-                       GROUP BY u2.username
-                       ORDER BY COUNT(*) DESC, u2.username ASC
-                       LIMIT 20
-                       )
-                       SELECT p.pid, p.title, p.username, p.begin_time, p.description, 
-                          COUNT(l.username) AS count_cohort_users
-                       FROM cohort_users u, papers p, likes l
-                       WHERE p.pid = l.pid AND
-                       l.username = u.username AND
-                       l.pid NOT IN (
-                          SELECT l2.pid FROM likes l2 WHERE l2.username = %s
-                       )
-                       GROUP BY p.pid, p.title, p.username, p.begin_time, p.description
-                       ORDER BY count_cohort_users DESC, p.pid ASC
-                       LIMIT %s;""", (uname, uname, count, ))
-        items = cur.fetchall()
-
-        # Remove count
-        for item in items:
-            temp = (item[0], item[1], item[2], item[3], item[4])
-            res.append(temp)
+        statements.execute(cur, "get_recommend_papers",
+                           """SELECT p.pid, p.username, p.title, p.begin_time, p.description
+                              FROM recommendations r, papers p
+                              WHERE r.username = %s AND p.pid = r.pid
+                              ORDER BY r.score DESC, r.pid ASC
+                              LIMIT %s;""", (uname, count, ))
+        res = cur.fetchall()
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="get_recommend_papers")
         return 1, None
 
     # Success
     return 0, res
 
 
+def refresh_recommendations(conn, unames):
+    """
+    Recompute the recommendations of the given users from user_similarity.
+
+    A user's cohort is the RECOMMEND_COHORT_SIZE users sharing the most liked papers with
+    them (ties by username). Papers liked by the cohort and not by the user are ranked by
+    how many cohort users like them (ties by pid), and the top RECOMMEND_TOP_K are kept.
+
+    :param conn: A postgres database connection object
+    :param unames: A list of string of username
+    :return: (status, retval)
+        (0, None)   Success
+        (1, None)   Failure
+    """
+    logger.debug("begin", api="refresh_recommendations")
+
+    unames = list(unames)
+    if len(unames) == 0:
+        return 0, None
+
+    try:
+        cur = conn.cursor()
+        # Dequeue first, so that a like arriving meanwhile queues the user again
+        cur.execute("""DELETE FROM recommendation_queue WHERE username = ANY(%s);""", (unames, ))
+        cur.execute("""DELETE FROM recommendations WHERE username = ANY(%s);""", (unames, ))
+        cur.execute("""INSERT INTO recommendations (username, pid, score)
+                       SELECT ranked.username, ranked.pid, ranked.score
+                       FROM (
+                          SELECT c.username, l.pid, COUNT(*) AS score,
+                             row_number() OVER (PARTITION BY c.username ORDER BY COUNT(*) DESC, l.pid ASC) AS r
+                          FROM (
+                             SELECT s.username, s.other,
+                                row_number() OVER (PARTITION BY s.username ORDER BY s.score DESC, s.other ASC) AS r
+                             FROM user_similarity s
+                             WHERE s.username = ANY(%s)
+                          ) c JOIN likes l ON l.username = c.other
+                          WHERE c.r <= %s AND NOT EXISTS (
+                             SELECT 1 FROM likes l2 WHERE l2.username = c.username AND l2.pid = l.pid
+                          )
+                          GROUP BY c.username, l.pid
+                       ) ranked
+                       WHERE ranked.r <= %s;""", (unames, RECOMMEND_COHORT_SIZE, RECOMMEND_TOP_K, ))
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="refresh_recommendations")
+        conn.rollback()
+        return 1, None
+
+    # Success
+    conn.commit()
+    return 0, None
+
+
+def refresh_queued_recommendations(conn, count = 500):
+    """
+    Refresh the recommendations of at most $count users queued by likes and unlikes.
+    Concurrent refreshers take different users.
+
+    :param conn: A postgres database connection object
+    :param count: An integer
+    :return: (status, retval)
+        (0, refreshed)  Success, retval is the number of users refreshed, 0 once the queue is empty
+        (1, None)       Failure
+    """
+    logger.debug("begin", api="refresh_queued_recommendations")
+
+    try:
+        cur = conn.cursor()
+        cur.execute("""SELECT q.username FROM recommendation_queue q
+                       ORDER BY q.username
+                       LIMIT %s
+                       FOR UPDATE SKIP LOCKED;""", (count, ))
+        unames = [item[0] for item in cur.fetchall()]
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="refresh_queued_recommendations")
+        conn.rollback()
+        return 1, None
+
+    status, res = refresh_recommendations(conn, unames)
+    if status != 0:
+        return status, None
+
+    # Success
+    return 0, len(unames)
+
+
+def rebuild_user_similarity(conn):
+    """
+    Recompute every co-like count from the likes table, over the papers with at most
+    similarity_max_likers() likes, the limit of the triggers, and queue every user for a
+    refresh of their recommendations.
+    Offline counterpart of the triggers on likes.
+
+    :param conn: A postgres database connection object
+    :return: (status, retval)
+        (0, pairs)  Success, retval is the number of similar user pairs
+        (1, None)   Failure
+    """
+    logger.debug("begin", api="rebuild_user_similarity")
+
+    try:
+        cur = conn.cursor()
+        cur.execute("""DELETE FROM user_similarity;""")
+        cur.execute("""INSERT INTO user_similarity (username, other, score)
+                       SELECT a.username, b.username, COUNT(*)
+                       FROM likes a JOIN likes b ON a.pid = b.pid AND a.username != b.username
+                       JOIN papers p ON p.pid = a.pid AND p.like_count <= similarity_max_likers()
+                       GROUP BY a.username, b.username;""")
+        pairs = cur.rowcount
+        cur.execute("""INSERT INTO recommendation_queue (username)
+                       SELECT u.username FROM users u
+                       ON CONFLICT DO NOTHING;""")
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="rebuild_user_similarity")
+        conn.rollback()
+        return 1, None
+
+    # Success
+    conn.commit()
+    return 0, pairs
+
+
 # T.9
-def get_papers_by_tag(conn, tag, count = 10):
+def get_papers_by_tag(conn, tag, count = 10, cursor = None):
     """
     Get at most $count papers that have the given tag
 
@@ -837,14 +2107,15 @@ def get_papers_by_tag(conn, tag, count = 10):
     :param conn: A postgres database connection object
     :param tag: A string of tag
     :param count: An integer
+    :param cursor: The next_cursor of the previous page, None for the first page
     :return:    (status, retval)
         (0, [pid, username, title, begin_time, description), (...), ...])
-            Success, retval is a list of quintuple. Please refer to the format defined in get_timeline()'s return value
+            Success, retval is a Page (a list) of quintuple. Please refer to the format defined in get_timeline()'s return value
 
         (1, None)
             Failure
     """
-    print("[BEGIN] get_papers_by_tag")
+    logger.debug("begin", api="get_papers_by_tag")
 
     if len(tag) <= 0:
         return 1, None
@@ -852,66 +2123,83 @@ def get_papers_by_tag(conn, tag, count = 10):
     res = []
 
     try:
+        after, after_args = keyset_condition(cursor, "p.begin_time", "::timestamp")
         cur = conn.cursor()
-        cur.execute("""SELECT p.pid, p.username, p.title, p.begin_time, p.description
-                       FROM papers p, tags t
-                       WHERE p.pid = t.pid AND t.tagname = %s
-                       GROUP BY p.pid, p.username, p.title, p.begin_time, p.description
-                       ORDER BY p.begin_time DESC, p.pid ASC
-                       LIMIT %s;""", (tag, count, ))
-        res = cur.fetchall()
+        statements.execute(cur, "get_papers_by_tag",
+                           """SELECT p.pid, p.username, p.title, p.begin_time, p.description
+                              FROM papers p, tags t
+                              WHERE p.pid = t.pid AND t.tagname = %s AND """ + after + """
+                              ORDER BY p.begin_time DESC, p.pid ASC
+                              LIMIT %s;""", (tag, ) + after_args + (count + 1, ))
+        res = make_page(cur.fetchall(), count)
+    except ValueError:
+        # Malformed cursor
+        return 1, None
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="get_papers_by_tag")
         return 1, None
 
-    print(res)
-
     # Success
     return 0, res
 
 
 # T.8
-def get_papers_by_keyword(conn, keyword, count = 10):
+def get_papers_by_keyword(conn, keyword, count = 10, rank = False, cursor = None):
     """
     Get at most $count papers that match a keyword in its title, description *or* text field
 
     The result should first be ordered by begin time (newest first). Break ties by pid (ascending).
+    With $rank, papers are ordered by relevance instead: title matches weigh more than
+    description matches, which weigh more than matches in the text.
+
+    The keyword is parsed with websearch_to_tsquery, so it can hold several words,
+    "quoted phrases", "or" and -excluded words.
 
     :param conn: A postgres database connection object
     :param keyword: A string of keyword, e.g. "database"
     :param count: An integer
+    :param rank: A boolean, order by relevance (ts_rank) instead of time
+    :param cursor: The next_cursor of the previous page, None for the first page
     :return:    (status, retval)
         (0, [(pid, username, title, begin_time, description), (...), ...])
-            Success, retval is a list of quintuple. Please refer to the format defined in get_timeline()'s return value
+            Success, retval is a Page (a list) of quintuple. Please refer to the format defined in get_timeline()'s return value
 
         (1, None)
             Failure
     """
-    print("[BEGIN] get_papers_by_keyword")
+    logger.debug("begin", api="get_papers_by_keyword")
 
     # If keyword is null, then return all papers
-    if not keyword or len(keyword) <= 0:
-        return get_timeline_all(conn, count)
+    if not keyword or len(keyword.strip()) <= 0:
+        return get_timeline_all(conn, count, cursor)
 
     res = []
 
-    keyword = '%' + keyword + '%'
+    if rank:
+        order_expr, cast = "ts_rank(p.search_vector, q.query)", "::real"
+    else:
+        order_expr, cast = "p.begin_time", "::timestamp"
 
     try:
+        after, after_args = keyset_condition(cursor, order_expr, cast)
         cur = conn.cursor()
-        cur.execute("""SELECT p.pid, p.username, p.title, p.begin_time, p.description
-                       FROM papers p
-                       WHERE p.title @@ to_tsquery(%s) OR
-                          p.data @@ to_tsquery(%s) OR 
-                          p.description @@ to_tsquery(%s)
-                       GROUP BY p.pid, p.username, p.title, p.begin_time, p.description
-                       ORDER BY p.begin_time DESC, p.pid ASC
-                       LIMIT %s;""", (keyword, keyword, keyword, count, ))
-        res = cur.fetchall()
+        # Uses paper_search_idx on the stored, weighted search_vector
+        cur.execute("""SELECT p.pid, p.username, p.title, p.begin_time, p.description, """ + order_expr + """
+                       FROM papers p, websearch_to_tsquery('english', %s) q(query)
+                       WHERE p.search_vector @@ q.query AND """ + after + """
+                       ORDER BY """ + order_expr + """ DESC, p.pid ASC
+                       LIMIT %s;""", (keyword, ) + after_args + (count + 1, ))
+        if rank:
+            res = make_page(cur.fetchall(), count, lambda item: item[5])
+        else:
+            res = make_page(cur.fetchall(), count)
+    except ValueError:
+        # Malformed cursor
+        return 1, None
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="get_papers_by_keyword")
         return 1, None
 
     # Success
@@ -919,7 +2207,7 @@ def get_papers_by_keyword(conn, keyword, count = 10):
 
 
 # T.13
-def get_papers_by_liked(conn, uname, count = 10):
+def get_papers_by_liked(conn, uname, count = 10, cursor = None):
     """
     Get at most $count papers that liked by the given user.
 
@@ -928,33 +2216,36 @@ def get_papers_by_liked(conn, uname, count = 10):
     :param conn: A postgres database connection object
     :param uname: A string of username
     :param count: An integer
+    :param cursor: The next_cursor of the previous page, None for the first page
     :return:    (status, retval)
         (0, [(pid, username, title, begin_time, description), (...), ...])
-            Success, retval is a list of quintuple. Please refer to the format defined in get_timeline()'s return value
+            Success, retval is a Page (a list) of quintuple. Please refer to the format defined in get_timeline()'s return value
 
         (1, None)
             Failure
     """
-    print("[BEGIN] get_papers_by_liked")
+    logger.debug("begin", api="get_papers_by_liked")
 
     res = []
 
     try:
+        after, after_args = keyset_condition(cursor, "p.begin_time", "::timestamp")
         cur = conn.cursor()
-        cur.execute("""SELECT p.pid, p.username, p.title, p.begin_time, p.description
-                       FROM papers p, likes l
-                       WHERE l.username = %s AND p.pid = l.pid
-                       GROUP BY p.pid, p.username, p.title, p.begin_time, p.description
-                       ORDER BY p.begin_time DESC, p.pid ASC
-                       LIMIT %s;""", (uname, count, ))
-        res = cur.fetchall()
+        statements.execute(cur, "get_papers_by_liked",
+                           """SELECT p.pid, p.username, p.title, p.begin_time, p.description
+                              FROM papers p, likes l
+                              WHERE l.username = %s AND p.pid = l.pid AND """ + after + """
+                              ORDER BY p.begin_time DESC, p.pid ASC
+                              LIMIT %s;""", (uname, ) + after_args + (count + 1, ))
+        res = make_page(cur.fetchall(), count)
+    except ValueError:
+        # Malformed cursor
+        return 1, None
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="get_papers_by_liked")
         return 1, None
 
-    print(res)
-
     # Success
     return 0, res
 
@@ -963,6 +2254,7 @@ def get_papers_by_liked(conn, uname, count = 10):
 
 
 # T.17(a)
+@cache.cached()
 def get_most_active_users(conn, count = 1):
     """
     Get at most $count users that post most papers.
@@ -979,31 +2271,28 @@ def get_most_active_users(conn, count = 1):
         (1, None)
             Failure
     """
-    print("[BEGIN] get_most_active_users")
+    logger.debug("begin", api="get_most_active_users")
 
     res = []
 
     try:
         cur = conn.cursor()
-        cur.execute("""SELECT u.username FROM users u, papers p WHERE p.username = u.username
-                       GROUP BY u.username ORDER BY COUNT(p.pid) DESC, u.username ASC LIMIT %s;""", (count, ))
-        fetch = cur.fetchall()
-        if fetch and len(fetch) > 0:
-            for item in fetch[0]:
-                if item:
-                    res.append(item)
+        # Walks user_stats_paper_count_idx, the counters are maintained by triggers
+        statements.execute(cur, "get_most_active_users",
+                           """SELECT s.username FROM user_stats s WHERE s.paper_count > 0
+                              ORDER BY s.paper_count DESC, s.username ASC LIMIT %s;""", (count, ))
+        res = [item[0] for item in cur.fetchall()]
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="get_most_active_users")
         return 1, None
 
-    print(res)
-
     # Success
     return 0, res
 
 
 # T.17(b)
+@cache.cached()
 def get_most_popular_tags(conn, count = 1):
     """
     Get at most $count many tags that gets most used among all papers
@@ -1020,13 +2309,15 @@ def get_most_popular_tags(conn, count = 1):
         (1, None)
             Failure
     """
-    print("[BEGIN] get_most_popular_tags")
+    logger.debug("begin", api="get_most_popular_tags")
     res = []
 
     try:
         cur = conn.cursor()
-        cur.execute("""SELECT t.tagname, COUNT(t.pid) FROM tags t GROUP BY t.tagname
-                       ORDER BY COUNT(t.pid) DESC, t.tagname ASC LIMIT %s;""", (count, ))
+        # Walks tagname_count_idx, the counters are maintained by a trigger on tags
+        statements.execute(cur, "get_most_popular_tags",
+                           """SELECT n.tagname, n.paper_count FROM tagnames n WHERE n.paper_count > 0
+                              ORDER BY n.paper_count DESC, n.tagname ASC LIMIT %s;""", (count, ))
         items = cur.fetchall()
 
         # Convert long to integer
@@ -1035,16 +2326,15 @@ def get_most_popular_tags(conn, count = 1):
             res.append(temp)
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="get_most_popular_tags")
         return 1, None
 
-    print(res)
-
     # Success
     return 0, res
 
 
 # T.17(c)
+@cache.cached()
 def get_most_popular_tag_pairs(conn, count = 1):
     """
     Get at most $count many tag pairs that have been used together.
@@ -1062,26 +2352,108 @@ def get_most_popular_tag_pairs(conn, count = 1):
         (1, None)
             Failure
     """
-    print("[BEGIN] get_most_popular_tag_pairs")
+    logger.debug("begin", api="get_most_popular_tag_pairs")
     res = []
 
     try:
         cur = conn.cursor()
-        cur.execute("""SELECT t1.tagname, t2.tagname, COUNT(*) FROM tags t1, tags t2
-                       WHERE t1.tagname < t2.tagname AND t1.pid = t2.pid GROUP BY t1.tagname, t2.tagname
-                       ORDER BY COUNT(*) DESC, t1.tagname ASC, t2.tagname ASC LIMIT %s;""", (count, ))
+        # Walks tag_pairs_count_idx, the pairs are maintained by a trigger on tags
+        statements.execute(cur, "get_most_popular_tag_pairs",
+                           """SELECT p.tag1, p.tag2, p.paper_count FROM tag_pairs p
+                              ORDER BY p.paper_count DESC, p.tag1 ASC, p.tag2 ASC LIMIT %s;""", (count, ))
         res = list(cur.fetchall())
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="get_most_popular_tag_pairs")
         return 1, None
 
-    print(res)
+    # Success
+    return 0, res
+
+
+def get_related_tags(conn, tag, count = 5):
+    """
+    Get at most $count tags used together with a given tag, most often first.
+    Break ties by tag name (lexically ascending).
+
+    :param conn: A postgres database connection object
+    :param tag: A string of tag
+    :param count: An integer
+    :return:
+        (0, [(tagname1, count1), (tagname2, count2), ...])
+            Success, each count is the number of papers having both tags
+        (1, None)
+            Failure
+    """
+    logger.debug("begin", api="get_related_tags")
+    res = []
+
+    try:
+        cur = conn.cursor()
+        statements.execute(cur, "get_related_tags",
+                           """SELECT r.tagname, r.paper_count FROM (
+                                 SELECT p.tag2 AS tagname, p.paper_count FROM tag_pairs p WHERE p.tag1 = %s
+                                 UNION ALL
+                                 SELECT p.tag1 AS tagname, p.paper_count FROM tag_pairs p WHERE p.tag2 = %s
+                              ) r
+                              ORDER BY r.paper_count DESC, r.tagname ASC LIMIT %s;""", (tag, tag, count, ))
+        res = list(cur.fetchall())
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="get_related_tags")
+        return 1, None
 
     # Success
     return 0, res
 
 
+def repair_tag_counts(conn):
+    """
+    Recompute the paper count of every tagname and every tag pair from the tags table
+
+    :param conn: A postgres database connection object
+    :return: (status, retval)
+        (0, fixed)  Success, retval is the number of tagnames and tag pairs that were wrong
+        (1, None)   Failure
+    """
+    logger.debug("begin", api="repair_tag_counts")
+
+    try:
+        cur = conn.cursor()
+        cur.execute("""UPDATE tagnames n
+                       SET paper_count = c.count_papers
+                       FROM (
+                          SELECT n2.tagname, COUNT(t.pid) AS count_papers
+                          FROM tagnames n2 LEFT JOIN tags t ON n2.tagname = t.tagname
+                          GROUP BY n2.tagname
+                       ) c
+                       WHERE n.tagname = c.tagname AND n.paper_count != c.count_papers;""")
+        fixed = cur.rowcount
+        cur.execute("""CREATE TEMP TABLE expected_tag_pairs ON COMMIT DROP AS
+                       SELECT t1.tagname AS tag1, t2.tagname AS tag2, COUNT(*) AS paper_count
+                       FROM tags t1, tags t2
+                       WHERE t1.tagname < t2.tagname AND t1.pid = t2.pid
+                       GROUP BY t1.tagname, t2.tagname;""")
+        cur.execute("""DELETE FROM tag_pairs p
+                       WHERE NOT EXISTS (SELECT 1 FROM expected_tag_pairs e
+                                         WHERE e.tag1 = p.tag1 AND e.tag2 = p.tag2);""")
+        fixed += cur.rowcount
+        cur.execute("""INSERT INTO tag_pairs (tag1, tag2, paper_count)
+                       SELECT e.tag1, e.tag2, e.paper_count FROM expected_tag_pairs e
+                       ON CONFLICT (tag1, tag2) DO UPDATE SET paper_count = EXCLUDED.paper_count
+                       WHERE tag_pairs.paper_count != EXCLUDED.paper_count;""")
+        fixed += cur.rowcount
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="repair_tag_counts")
+        conn.rollback()
+        return 1, None
+
+    # Success
+    conn.commit()
+    return 0, fixed
+
+
 # T.16(a)
 def get_number_papers_user(conn, uname):
     """
@@ -1095,20 +2467,20 @@ def get_number_papers_user(conn, uname):
         (1, None)
             Failure
     """
-    print("[BEGIN] get_number_papers_user")
+    logger.debug("begin", api="get_number_papers_user")
     count = 0
 
     try:
         cur = conn.cursor()
-        cur.execute("""SELECT COUNT(p.pid) FROM papers p WHERE p.username = %s;""", (uname, ))
-        count = cur.fetchone()[0]
+        statements.execute(cur, "get_number_papers_user",
+                           """SELECT s.paper_count FROM user_stats s WHERE s.username = %s;""", (uname, ))
+        fetch = cur.fetchone()
+        count = fetch[0] if fetch else 0
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="get_number_papers_user")
         return 1, None
 
-    print("16(a)\t" + str(count))
-
     # Success
     return 0, count
 
@@ -1126,20 +2498,20 @@ def get_number_liked_user(conn, uname):
         (1, None)
             Failure
     """
-    print("[BEGIN] get_number_liked_user")
+    logger.debug("begin", api="get_number_liked_user")
     count = 0
 
     try:
         cur = conn.cursor()
-        cur.execute("""SELECT COUNT(l.pid) FROM likes l WHERE l.username = %s;""", (uname, ))
-        count = cur.fetchone()[0]
+        statements.execute(cur, "get_number_liked_user",
+                           """SELECT s.like_count FROM user_stats s WHERE s.username = %s;""", (uname, ))
+        fetch = cur.fetchone()
+        count = fetch[0] if fetch else 0
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="get_number_liked_user")
         return 1, None
 
-    print("16(b)\t" + str(count))
-
     # Success
     return 0, count
 
@@ -1159,20 +2531,207 @@ def get_number_tags_user(conn, uname):
         (1, None)
             Failure
     """
-    print("[BEGIN] get_number_tags_user")
+    logger.debug("begin", api="get_number_tags_user")
     count = 0
 
     try:
         cur = conn.cursor()
-        cur.execute("""SELECT COUNT(DISTINCT(t.tagname)) FROM papers p, tags t 
-                       WHERE p.username = %s AND t.pid = p.pid;""", (uname, ))
-        count = cur.fetchone()[0]
+        statements.execute(cur, "get_number_tags_user",
+                           """SELECT s.tag_count FROM user_stats s WHERE s.username = %s;""", (uname, ))
+        fetch = cur.fetchone()
+        count = fetch[0] if fetch else 0
     except psy.DatabaseError, e:
         # Other errors
-        traceback.print_exc()
+        logger.exception("db error", api="get_number_tags_user")
         return 1, None
 
-    print("16(c)\t" + str(count))
-
     # Success
     return 0, count
+
+
+# T.16 - All at once
+def get_user_stats(conn, uname):
+    """
+    Get the number of papers posted, papers liked and distinct tagnames used by the user in one lookup.
+
+    :param conn: A postgres database connection object
+    :param uname:  A string of username
+    :return:
+        (0, (count_papers, count_liked, count_tags))
+            Success, all zero for a user who has done nothing yet
+        (1, None)
+            Failure
+    """
+    logger.debug("begin", api="get_user_stats")
+
+    try:
+        cur = conn.cursor()
+        statements.execute(cur, "get_user_stats",
+                           """SELECT s.paper_count, s.like_count, s.tag_count FROM user_stats s
+                              WHERE s.username = %s;""", (uname, ))
+        fetch = cur.fetchone()
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="get_user_stats")
+        return 1, None
+
+    # Success
+    return 0, tuple(fetch) if fetch else (0, 0, 0)
+
+
+def repair_user_stats(conn):
+    """
+    Recompute user_stats and user_tags from the papers, likes and tags tables
+
+    :param conn: A postgres database connection object
+    :return: (status, retval)
+        (0, fixed)  Success, retval is the number of user_tags and user_stats rows that were wrong
+        (1, None)   Failure
+    """
+    logger.debug("begin", api="repair_user_stats")
+
+    try:
+        cur = conn.cursor()
+        cur.execute("""CREATE TEMP TABLE expected_user_tags ON COMMIT DROP AS
+                       SELECT p.username, t.tagname, COUNT(*) AS paper_count
+                       FROM papers p, tags t
+                       WHERE p.pid = t.pid
+                       GROUP BY p.username, t.tagname;""")
+        cur.execute("""DELETE FROM user_tags u
+                       WHERE NOT EXISTS (SELECT 1 FROM expected_user_tags e
+                                         WHERE e.username = u.username AND e.tagname = u.tagname);""")
+        fixed = cur.rowcount
+        cur.execute("""INSERT INTO user_tags (username, tagname, paper_count)
+                       SELECT e.username, e.tagname, e.paper_count FROM expected_user_tags e
+                       ON CONFLICT (username, tagname) DO UPDATE SET paper_count = EXCLUDED.paper_count
+                       WHERE user_tags.paper_count != EXCLUDED.paper_count;""")
+        fixed += cur.rowcount
+        cur.execute("""INSERT INTO user_stats (username, paper_count, like_count, tag_count)
+                       SELECT c.username, c.paper_count, c.like_count, c.tag_count FROM (
+                          SELECT u.username,
+                              (SELECT COUNT(*) FROM papers p WHERE p.username = u.username) AS paper_count,
+                              (SELECT COUNT(*) FROM likes l WHERE l.username = u.username) AS like_count,
+                              (SELECT COUNT(*) FROM user_tags t WHERE t.username = u.username) AS tag_count
+                          FROM users u
+                       ) c
+                       WHERE c.paper_count > 0 OR c.like_count > 0 OR c.tag_count > 0 OR
+                           EXISTS (SELECT 1 FROM user_stats s WHERE s.username = c.username)
+                       ON CONFLICT (username) DO UPDATE
+                       SET paper_count = EXCLUDED.paper_count, like_count = EXCLUDED.like_count,
+                           tag_count = EXCLUDED.tag_count
+                       WHERE (user_stats.paper_count, user_stats.like_count, user_stats.tag_count) !=
+                           (EXCLUDED.paper_count, EXCLUDED.like_count, EXCLUDED.tag_count);""")
+        fixed += cur.rowcount
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="repair_user_stats")
+        conn.rollback()
+        return 1, None
+
+    # Success
+    conn.commit()
+    return 0, fixed
+
+
+# Page bundles
+def home_page_bundle(conn, uname, count = 10, cursor = None):
+    """
+    Get everything the home page of a user shows with a single query: the first page of the timeline
+    (see get_timeline), the liked papers (see get_papers_by_liked), the recommended papers (see
+    get_recommend_papers), the like counts and tags of all of them and the user statistics (see get_user_stats).
+
+    Its sections are timed and reported through instrumentation.report_timings as 'query' (the round trip)
+    and 'decode'.
+
+    :param conn: A postgres database connection object
+    :param uname: A string of username
+    :param count: An integer, the size of each list
+    :param cursor: The next_cursor of the previous timeline page, None for the first page
+    :return:    (status, retval)
+        (0, {'timeline': Page, 'liked': Page, 'recommend': [...], 'likes': {pid: like_count, ...},
+             'tags': {pid: [tag1, tag2, ...], ...}, 'stats': (count_papers, count_liked, count_tags)})
+            Success, the lists hold quintuples in the format of get_timeline()'s return value
+        (1, None)
+            Failure
+    """
+    logger.debug("begin", api="home_page_bundle")
+    timings = dict()
+
+    try:
+        start = time.time()
+        after, after_args = keyset_condition(cursor, "p.begin_time", "::timestamp")
+        cur = conn.cursor()
+        # One row per paper of each section, in section order, all carrying the user statistics;
+        # a single row with a NULL section when there are no papers at all
+        statements.execute(cur, "home_page_bundle",
+                           """SELECT b.section, b.pid, b.username, b.title, b.begin_time, b.description, b.like_count,
+                                     ARRAY(SELECT t.tagname FROM tags t WHERE t.pid = b.pid ORDER BY t.tagname ASC),
+                                     s.paper_count, s.like_count, s.tag_count
+                              FROM (
+                                 SELECT COALESCE(MAX(s.paper_count), 0) AS paper_count,
+                                     COALESCE(MAX(s.like_count), 0) AS like_count,
+                                     COALESCE(MAX(s.tag_count), 0) AS tag_count
+                                 FROM user_stats s WHERE s.username = %s
+                              ) s LEFT JOIN (
+                                 SELECT 1 AS section, row_number() OVER (ORDER BY p.begin_time DESC, p.pid ASC) AS position,
+                                     p.pid, p.username, p.title, p.begin_time, p.description, p.like_count
+                                 FROM (
+                                    SELECT p.pid, p.username, p.title, p.begin_time, p.description, p.like_count FROM papers p
+                                    WHERE p.username = %s AND """ + after + """
+                                    ORDER BY p.begin_time DESC, p.pid ASC
+                                    LIMIT %s
+                                 ) p
+                                 UNION ALL
+                                 SELECT 2, row_number() OVER (ORDER BY p.begin_time DESC, p.pid ASC),
+                                     p.pid, p.username, p.title, p.begin_time, p.description, p.like_count
+                                 FROM (
+                                    SELECT p.pid, p.username, p.title, p.begin_time, p.description, p.like_count FROM papers p, likes l
+                                    WHERE l.username = %s AND p.pid = l.pid
+                                    ORDER BY p.begin_time DESC, p.pid ASC
+                                    LIMIT %s
+                                 ) p
+                                 UNION ALL
+                                 SELECT 3, row_number() OVER (ORDER BY p.score DESC, p.pid ASC),
+                                     p.pid, p.username, p.title, p.begin_time, p.description, p.like_count
+                                 FROM (
+                                    SELECT p.pid, p.username, p.title, p.begin_time, p.description, p.like_count, r.score
+                                    FROM recommendations r, papers p
+                                    WHERE r.username = %s AND p.pid = r.pid
+                                    ORDER BY r.score DESC, r.pid ASC
+                                    LIMIT %s
+                                 ) p
+                              ) b ON TRUE
+                              ORDER BY b.section, b.position;""",
+                           (uname, uname) + after_args + (count + 1, uname, count + 1, uname, count, ))
+        rows = cur.fetchall()
+        timings['query'] = time.time() - start
+
+        start = time.time()
+        sections = {1: [], 2: [], 3: []}
+        likes = dict()
+        tags = dict()
+        for row in rows:
+            if row[0] is None:
+                continue
+            sections[row[0]].append(row[1:6])
+            likes[row[1]] = int(row[6])
+            tags[row[1]] = list(row[7])
+        res = {'timeline': make_page(sections[1], count),
+               'liked': make_page(sections[2], count),
+               'recommend': sections[3],
+               'likes': likes,
+               'tags': tags,
+               'stats': tuple(int(x) for x in rows[0][8:11])}
+        timings['decode'] = time.time() - start
+    except ValueError:
+        # Malformed cursor
+        return 1, None
+    except psy.DatabaseError, e:
+        # Other errors
+        logger.exception("db error", api="home_page_bundle")
+        return 1, None
+
+    instrumentation.report_timings('home_page_bundle', timings)
+
+    # Success
+    return 0, res
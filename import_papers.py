@@ -0,0 +1,239 @@
+"""
+Bulk import of pdf papers, e.g. to backfill a department's archive.
+
+Usage:
+    python -m paper.import_papers --dir ARCHIVE_DIR --user USERNAME [--tags tag1,tag2]
+    python -m paper.import_papers --manifest MANIFEST.jsonl
+
+Each manifest line is a json object with the keys "path", "username", "title",
+"description" and "tags" (a list); relative paths are resolved against the manifest's
+directory. Text is extracted in parallel on all cores, or taken from the text cache for
+files that were extracted before, then papers are loaded in batches with COPY. Every
+imported file is recorded in the import_sources table in the same transaction as its
+paper, so an interrupted import can simply be run again: files that are already imported
+are skipped. Items of unknown users and repeated files are left out before loading, as one
+bad row would fail its whole batch; tags are cut to TAG_MAX_LENGTH.
+"""
+
+# Import necessary packages
+import paper.database_wrapper as db_wrapper
+import paper.functions as funcs
+import paper.extraction as extraction
+import paper.text_cache as text_cache
+from paper.constants import *
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import shutil
+import time
+
+
+"""
+Import constants
+"""
+
+BATCH_SIZE = 500
+REPORT_EVERY = 1000
+MEDIA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'media')
+
+
+def items_from_dir(path, uname, tags):
+    """
+    Describe every pdf under a directory as an import item
+    """
+    items = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.lower().endswith(".pdf"):
+                continue
+            file_path = os.path.abspath(os.path.join(root, name))
+            items.append({'source': file_path, 'path': file_path, 'username': uname,
+                          'title': os.path.splitext(name)[0], 'description': "", 'tags': tags})
+    return items
+
+
+def items_from_manifest(path):
+    """
+    Read the import items of a json lines manifest
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    items = []
+    with open(path) as manifest:
+        for line in manifest:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            file_path = os.path.abspath(os.path.join(base, entry['path']))
+            items.append({'source': file_path, 'path': file_path, 'username': entry['username'],
+                          'title': entry.get('title') or os.path.splitext(os.path.basename(file_path))[0],
+                          'description': entry.get('description', ""), 'tags': entry.get('tags', [])})
+    return items
+
+
+def extract_item(item):
+    """
+    Run in a worker process: extract the text of one item
+    """
+    ok, value, hit = extraction.extract_text(item['path'])
+    try:
+        size = os.path.getsize(item['path'])
+    except OSError:
+        size = 0
+    return item, ok, value, size, hit
+
+
+def load_batch(batch, media_dir):
+    """
+    Copy the files of a batch into the media directory and load its papers with COPY.
+    Nothing of the batch is kept if loading fails.
+
+    :return: SUCCESS if the batch is loaded
+    """
+    status, conn = db_wrapper.get_db_connection()
+    if status != SUCCESS:
+        return status
+    copied = []
+    try:
+        status, pids = db_wrapper.call_db_with_conn(conn, funcs.reserve_paper_ids, {'count':len(batch)})
+        if status != SUCCESS:
+            return status
+        begin_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        rows = []
+        for pid, item in zip(pids, batch):
+            target = os.path.join(media_dir, "%d.pdf" % pid)
+            shutil.copyfile(item['path'], target)
+            copied.append(target)
+            rows.append((pid, item['source'], item['username'], item['title'][:50], begin_time,
+                         item['description'][:500], item['text'], item['tags']))
+        status, res = db_wrapper.call_db_with_conn(conn, funcs.bulk_add_papers, {'papers':rows})
+        return status
+    except (IOError, OSError), e:
+        print "[Error] Can not copy file: %s" % e
+        conn.rollback()
+        status = FAILURE
+        return status
+    finally:
+        if status != SUCCESS:
+            for target in copied:
+                try:
+                    os.remove(target)
+                except OSError:
+                    pass
+        db_wrapper.close_db_connection(conn)
+
+
+class ImportReport(object):
+    """
+    Throughput counters of an import
+    """
+
+    def __init__(self, total, skipped):
+        self.total = total
+        self.skipped = skipped
+        self.imported = 0
+        self.failed = 0
+        self.cached = 0
+        self.bytes = 0
+        self.start = time.time()
+
+    def add(self, count, size):
+        self.imported += count
+        self.bytes += size
+
+    def summary(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        mb = self.bytes / (1024.0 * 1024.0)
+        return ("%d/%d imported, %d failed, %d skipped, %d from the text cache in %.1fs: "
+                "%.1f papers/s, %.2f MB/s" %
+                (self.imported, self.total, self.failed, self.skipped, self.cached, elapsed,
+                 self.imported / elapsed, mb / elapsed))
+
+
+def run_import(items, media_dir = MEDIA_DIR, workers = None, batch_size = BATCH_SIZE,
+               report_every = REPORT_EVERY):
+    """
+    Import items that have not been imported yet
+
+    :return: The ImportReport of the run
+    """
+    status, done = db_wrapper.call_db(funcs.get_imported_sources, {})
+    if status != SUCCESS:
+        raise RuntimeError("Can not read the import checkpoint")
+    status, users = db_wrapper.call_db(funcs.get_existing_users, {'unames':[item['username'] for item in items]})
+    if status != SUCCESS:
+        raise RuntimeError("Can not read the users")
+    # One bad item would fail the whole batch it is loaded with, so leave them out now
+    todo, failed = [], 0
+    for item in items:
+        if item['source'] in done:
+            continue
+        if item['username'] not in users:
+            print "[Error] Unknown user %s for %s" % (item['username'], item['path'])
+            failed += 1
+            continue
+        done.add(item['source'])
+        todo.append(item)
+    report = ImportReport(len(items), len(items) - len(todo) - failed)
+    report.failed = failed
+    if not os.path.isdir(media_dir):
+        os.makedirs(media_dir)
+
+    def flush(batch, size):
+        if load_batch(batch, media_dir) == SUCCESS:
+            report.add(len(batch), size)
+        else:
+            report.failed += len(batch)
+            print "[Error] Can not load a batch of %d papers" % len(batch)
+
+    pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+    try:
+        batch, batch_bytes, last_report = [], 0, 0
+        for item, ok, value, size, hit in pool.imap_unordered(extract_item, todo, chunksize=4):
+            if not ok:
+                report.failed += 1
+                print "[Error] Can not extract %s: %s" % (item['path'], value)
+                continue
+            text_cache.record(hit, size)
+            report.cached += 1 if hit else 0
+            item['text'] = value
+            batch.append(item)
+            batch_bytes += size
+            if len(batch) >= batch_size:
+                flush(batch, batch_bytes)
+                batch, batch_bytes = [], 0
+            if report.imported - last_report >= report_every:
+                last_report = report.imported
+                print "[Progress] %s" % report.summary()
+        if batch:
+            flush(batch, batch_bytes)
+    finally:
+        pool.close()
+        pool.join()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import pdf papers")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--dir", help="import every pdf under this directory")
+    source.add_argument("--manifest", help="import the files listed in this json lines manifest")
+    parser.add_argument("--user", help="owner of the papers imported with --dir")
+    parser.add_argument("--tags", default="", help="comma separated tags of the papers imported with --dir")
+    parser.add_argument("--media-dir", default=MEDIA_DIR, help="where uploaded pdf files are stored")
+    parser.add_argument("--workers", type=int, default=None, help="extraction processes, default all cores")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    if args.dir:
+        if not args.user:
+            parser.error("--user is required with --dir")
+        items = items_from_dir(args.dir, args.user, [x.strip() for x in args.tags.split(',')])
+    else:
+        items = items_from_manifest(args.manifest)
+
+    report = run_import(items, args.media_dir, args.workers, args.batch_size)
+    print "[Done] %s" % report.summary()
@@ -0,0 +1,304 @@
+"""
+Timing of db API calls, see database_wrapper.call_db and call_db_with_conn.
+
+Every call records its wall time, the number of statements it ran and the rows they
+returned under the API's name. Latencies go into a histogram per API that is exported in
+the Prometheus text format (get_metrics_text, served by the metrics view, or dump_metrics
+to write it to a file).
+
+Statements are seen through TimedCursor, the cursor class of pooled connections. When a
+call takes longer than SLOW_CALL_THRESHOLD, its slowest statement is explained in the
+background on another pooled connection, with EXPLAIN (ANALYZE, BUFFERS) for a SELECT and a
+plain EXPLAIN otherwise, always in a transaction that is rolled back. The captures are kept
+in memory (get_slow_calls) and appended to SLOW_CALL_LOG if it is set. They hold the query
+with its placeholders only: the values, e.g. the password of a login, are bound for the
+EXPLAIN and then dropped.
+
+APIs and pages can also time their own sections, e.g. the round trip and the decoding of
+functions.home_page_bundle, with report_timings. Sections get a histogram per API and
+section next to those of the calls, and are handed to the hooks of TIMING_HOOKS.
+"""
+
+import collections
+import datetime
+import json
+import os
+import Queue
+import threading
+import time
+
+import psycopg2.extensions as psy_ext
+
+from constants import *
+from log import get_logger
+
+
+logger = get_logger(__name__)
+_local = threading.local()
+_lock = threading.Lock()
+# api name -> {'calls', 'errors', 'rows', 'statements', 'seconds', 'buckets'}
+_metrics = {}
+# api name -> section -> {'calls', 'seconds', 'max', 'buckets'}
+_sections = {}
+# Callables run with (api name, {section: seconds}) by report_timings
+TIMING_HOOKS = []
+_slow_calls = collections.deque(maxlen=SLOW_CALL_KEEP)
+_explain_queue = Queue.Queue(maxsize=SLOW_CALL_KEEP)
+_explain_thread = None
+
+
+class TimedCursor(psy_ext.cursor):
+    """
+    A cursor that reports every statement to the API call running in its thread
+    """
+
+    # (query, vars) of the statement an EXECUTE runs, set by statements.execute
+    prepared_source = None
+
+    def execute(self, query, vars=None):
+        start = time.time()
+        try:
+            return super(TimedCursor, self).execute(query, vars)
+        finally:
+            source, self.prepared_source = self.prepared_source, None
+            call = getattr(_local, 'call', None)
+            if call is not None:
+                call.add_statement(time.time() - start, source or (query, vars),
+                                   self.rowcount if self.description is not None else 0)
+
+
+class Call(object):
+    """
+    A db API call in progress
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.statements = 0
+        self.rows = 0
+        # (seconds, (query, vars)) of the slowest statement
+        self.slowest = (0.0, None)
+
+    def add_statement(self, seconds, query, rows):
+        self.statements += 1
+        self.rows += max(rows, 0)
+        if query is not None and seconds >= self.slowest[0]:
+            self.slowest = (seconds, query)
+
+
+def start_call(function_name):
+    """
+    Start timing a call of an API. Return None if the API is called by another timed call
+    or instrumentation is disabled.
+    """
+    if not QUERY_STATS_ENABLED or getattr(_local, 'call', None) is not None:
+        return None
+    _local.call = Call(function_name.__name__)
+    return _local.call
+
+
+def _observe(buckets, seconds):
+    """
+    Count a duration in the bucket of QUERY_HISTOGRAM_BUCKETS it falls in, nowhere if it is
+    longer than all of them. Must be called with _lock held.
+    """
+    for i, bound in enumerate(QUERY_HISTOGRAM_BUCKETS):
+        if seconds <= bound:
+            buckets[i] += 1
+            break
+
+
+def end_call(call, status):
+    """
+    Record a call started by start_call, with the status it returned
+    """
+    if call is None:
+        return
+    _local.call = None
+    seconds = time.time() - call.start
+    with _lock:
+        item = _metrics.get(call.name)
+        if item is None:
+            item = _metrics[call.name] = {'calls': 0, 'errors': 0, 'rows': 0, 'statements': 0,
+                                          'seconds': 0.0, 'buckets': [0] * len(QUERY_HISTOGRAM_BUCKETS)}
+        item['calls'] += 1
+        item['errors'] += 1 if status != SUCCESS else 0
+        item['rows'] += call.rows
+        item['statements'] += call.statements
+        item['seconds'] += seconds
+        _observe(item['buckets'], seconds)
+    logger.debug("db call", api=call.name, status=status, seconds=seconds, statements=call.statements,
+                 rows=call.rows)
+    if seconds > SLOW_CALL_THRESHOLD:
+        logger.warning("slow db call", api=call.name, status=status, seconds=seconds,
+                       statements=call.statements, rows=call.rows)
+        if call.slowest[1] is not None:
+            _queue_explain(call, seconds)
+
+
+def _log_timings(name, timings):
+    logger.debug("timings", api=name, **timings)
+
+
+TIMING_HOOKS.append(_log_timings)
+
+
+def report_timings(name, timings):
+    """
+    Record the section timings of a call of API $name, e.g. {'query': 0.01, 'decode': 0.002},
+    and hand them to every hook of TIMING_HOOKS
+    """
+    with _lock:
+        sections = _sections.setdefault(name, dict())
+        for section, seconds in timings.items():
+            item = sections.get(section)
+            if item is None:
+                item = sections[section] = {'calls': 0, 'seconds': 0.0, 'max': 0.0,
+                                            'buckets': [0] * len(QUERY_HISTOGRAM_BUCKETS)}
+            item['calls'] += 1
+            item['seconds'] += seconds
+            item['max'] = max(item['max'], seconds)
+            _observe(item['buckets'], seconds)
+    for hook in TIMING_HOOKS:
+        try:
+            hook(name, timings)
+        except:
+            logger.exception("timing hook failed", api=name)
+
+
+def _queue_explain(call, seconds):
+    global _explain_thread
+    query, vars = call.slowest[1]
+    capture = {'api': call.name, 'seconds': seconds, 'statements': call.statements, 'rows': call.rows,
+               'statement_seconds': call.slowest[0], 'query': query,
+               'captured_at': datetime.datetime.now().isoformat()}
+    with _lock:
+        if _explain_thread is None or not _explain_thread.is_alive():
+            _explain_thread = threading.Thread(target=_explain_worker, name="explain")
+            _explain_thread.daemon = True
+            _explain_thread.start()
+    try:
+        _explain_queue.put_nowait((capture, vars))
+    except Queue.Full:
+        # Already busy explaining, never hold up the request
+        pass
+
+
+def _scrub(text, cur, vars):
+    """
+    Replace the string values of a statement in a plan or an error by placeholders,
+    postgres prints them as literals, e.g. Filter: (password = 'secret'::text)
+    """
+    if not vars or cur is None:
+        return text
+    values = vars.values() if isinstance(vars, dict) else vars
+    for value in values:
+        if isinstance(value, basestring) and value:
+            text = text.replace(cur.mogrify("%s", (value, )), "'?'")
+    return text
+
+
+def _explain_worker():
+    # database_wrapper imports this module
+    import database_wrapper
+    while True:
+        capture, vars = _explain_queue.get()
+        try:
+            status, conn = database_wrapper.get_db_connection()
+            if status != SUCCESS:
+                continue
+            cur = None
+            try:
+                cur = conn.cursor()
+                # Bound here only, the values never leave this function
+                query = cur.mogrify(capture['query'], vars)
+                analyze = query.lstrip().upper().startswith("SELECT")
+                cur.execute(("EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN ") + query)
+                capture['plan'] = _scrub("\n".join(row[0] for row in cur.fetchall()), cur, vars)
+                capture['analyzed'] = analyze
+            except Exception, e:
+                capture['plan'] = None
+                capture['error'] = _scrub("%s: %s" % (type(e).__name__, e), cur, vars)
+            finally:
+                conn.rollback()
+                database_wrapper.close_db_connection(conn)
+            _slow_calls.append(capture)
+            logger.warning("slow db call explained", **capture)
+            if SLOW_CALL_LOG:
+                with open(SLOW_CALL_LOG, "a") as log:
+                    log.write(json.dumps(capture) + "\n")
+        except:
+            logger.exception("can not explain a slow db call", api=capture['api'])
+
+
+def get_slow_calls():
+    """
+    Get the latest captures of slow calls, oldest first
+    """
+    return list(_slow_calls)
+
+
+def get_call_stats():
+    """
+    Get a snapshot of the counters of every API, with the number of calls, mean and max
+    seconds of its timed sections
+    """
+    with _lock:
+        res = dict((name, {'calls': item['calls'], 'errors': item['errors'], 'rows': item['rows'],
+                           'statements': item['statements'], 'seconds': item['seconds']})
+                   for name, item in _metrics.items())
+        for name, sections in _sections.items():
+            res.setdefault(name, dict())['sections'] = dict(
+                (section, {'calls': item['calls'], 'mean': item['seconds'] / item['calls'], 'max': item['max']})
+                for section, item in sections.items())
+        return res
+
+
+def get_metrics_text():
+    """
+    Export the counters and latency histograms of every API and timed section in the
+    Prometheus text format
+    """
+    with _lock:
+        metrics = sorted((name, dict(item, buckets=list(item['buckets']))) for name, item in _metrics.items())
+        sections = sorted((name, section, dict(item, buckets=list(item['buckets'])))
+                          for name, items in _sections.items() for section, item in items.items())
+    lines = ["# HELP paper_db_call_seconds Wall time of db API calls",
+             "# TYPE paper_db_call_seconds histogram"]
+    for name, item in metrics:
+        total = 0
+        for bound, count in zip(QUERY_HISTOGRAM_BUCKETS, item['buckets']):
+            total += count
+            lines.append('paper_db_call_seconds_bucket{api="%s",le="%s"} %d' % (name, bound, total))
+        lines.append('paper_db_call_seconds_bucket{api="%s",le="+Inf"} %d' % (name, item['calls']))
+        lines.append('paper_db_call_seconds_sum{api="%s"} %f' % (name, item['seconds']))
+        lines.append('paper_db_call_seconds_count{api="%s"} %d' % (name, item['calls']))
+    for key, help in [('errors', "Calls that did not succeed"),
+                      ('statements', "Statements run by db API calls"),
+                      ('rows', "Rows returned by the statements of db API calls")]:
+        lines.append("# HELP paper_db_call_%s_total %s" % (key, help))
+        lines.append("# TYPE paper_db_call_%s_total counter" % key)
+        for name, item in metrics:
+            lines.append('paper_db_call_%s_total{api="%s"} %d' % (key, name, item[key]))
+    lines.append("# HELP paper_section_seconds Wall time of the timed sections of APIs and pages")
+    lines.append("# TYPE paper_section_seconds histogram")
+    for name, section, item in sections:
+        labels = 'api="%s",section="%s"' % (name, section)
+        total = 0
+        for bound, count in zip(QUERY_HISTOGRAM_BUCKETS, item['buckets']):
+            total += count
+            lines.append('paper_section_seconds_bucket{%s,le="%s"} %d' % (labels, bound, total))
+        lines.append('paper_section_seconds_bucket{%s,le="+Inf"} %d' % (labels, item['calls']))
+        lines.append('paper_section_seconds_sum{%s} %f' % (labels, item['seconds']))
+        lines.append('paper_section_seconds_count{%s} %d' % (labels, item['calls']))
+    return "\n".join(lines) + "\n"
+
+
+def dump_metrics(path):
+    """
+    Write get_metrics_text to a file, e.g. for the textfile collector of node_exporter
+    """
+    with open(path + ".tmp", "w") as f:
+        f.write(get_metrics_text())
+    os.rename(path + ".tmp", path)
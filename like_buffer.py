@@ -0,0 +1,120 @@
+"""
+Write-behind buffer of likes and unlikes, used by the like views when LIKE_WRITE_BEHIND is set.
+
+A like is only put in memory and the request returns at once. A background thread writes the
+pending likes every LIKE_FLUSH_INTERVAL seconds, or as soon as LIKE_BUFFER_SIZE are pending,
+with one functions.apply_likes call, so a burst of likes on a popular paper costs one
+transaction instead of one per click. Events of the same user on the same paper are
+coalesced, the latest one wins.
+
+The price is that a like is not visible, nor checked, until it is flushed, and that the
+likes pending in a process that is killed are lost. A batch that can not be written is
+retried once with the next flush, then dropped, and every dropped event is logged as an error.
+"""
+
+import atexit
+import os
+import threading
+
+from constants import *
+from log import get_logger
+from database_wrapper import call_db
+import functions
+
+
+logger = get_logger(__name__)
+_lock = threading.Lock()
+# (uname, pid) -> [True to like or False to unlike, failed flushes]
+_pending = {}
+_wake = threading.Event()
+_flusher = None
+_flusher_pid = None
+_stats = {'added': 0, 'coalesced': 0, 'flushes': 0, 'liked': 0, 'unliked': 0, 'failed': 0, 'dropped': 0}
+
+
+def add(uname, pid, like):
+    """
+    Queue a like, or an unlike if $like is False
+    """
+    _start_flusher()
+    with _lock:
+        _stats['added'] += 1
+        if (uname, pid) in _pending:
+            _stats['coalesced'] += 1
+        _pending[(uname, pid)] = [like, 0]
+        if len(_pending) >= LIKE_BUFFER_SIZE:
+            _wake.set()
+
+
+def flush():
+    """
+    Write every pending event
+
+    :return: SUCCESS if they are written
+    """
+    global _pending
+    with _lock:
+        events, _pending = _pending, {}
+    if not events:
+        return SUCCESS
+    # (pid, uname) order, so that the batches of several processes lock rows in the same order
+    keys = sorted(events, key=lambda key: (key[1], key[0]))
+    likes = [key for key in keys if events[key][0]]
+    unlikes = [key for key in keys if not events[key][0]]
+    status, res = call_db(functions.apply_likes, {'likes':likes, 'unlikes':unlikes})
+    dropped = []
+    with _lock:
+        _stats['flushes'] += 1
+        if status == SUCCESS:
+            _stats['liked'] += res[0]
+            _stats['unliked'] += res[1]
+            return status
+        _stats['failed'] += 1
+        for key, (like, failures) in events.items():
+            if failures > 0:
+                _stats['dropped'] += 1
+                dropped.append((key, like))
+            elif key not in _pending:
+                # Retry with the next flush, unless a newer event replaced it
+                _pending[key] = [like, failures + 1]
+    logger.error("can not flush likes", likes=len(likes), unlikes=len(unlikes))
+    for (uname, pid), like in dropped:
+        logger.error("like dropped", uname=uname, pid=pid, like=like)
+    return status
+
+
+def _flush_loop():
+    while True:
+        _wake.wait(LIKE_FLUSH_INTERVAL)
+        _wake.clear()
+        try:
+            flush()
+        except:
+            logger.exception("can not flush likes")
+
+
+def _start_flusher():
+    """
+    Start the flusher thread of this process, again in a forked child
+    """
+    global _flusher, _flusher_pid
+    if _flusher is not None and _flusher_pid == os.getpid():
+        return
+    with _lock:
+        if _flusher is None or _flusher_pid != os.getpid():
+            _flusher = threading.Thread(target=_flush_loop, name="like flusher")
+            _flusher.daemon = True
+            _flusher.start()
+            _flusher_pid = os.getpid()
+
+
+def get_like_buffer_stats():
+    """
+    Get the number of events queued, coalesced, written and lost, and how many are pending
+    """
+    with _lock:
+        return dict(_stats, pending=len(_pending))
+
+
+# Write what is left when the process exits normally
+atexit.register(flush)
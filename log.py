@@ -0,0 +1,217 @@
+"""
+Structured logging that never blocks a request.
+
+    from log import get_logger
+    logger = get_logger(__name__)
+    logger.info("paper added", pid=pid, uname=uname)
+
+Records are json objects with the time, level, logger name, message, the id of the request
+being served and the keyword fields of the call. Handlers only put records on a bounded queue;
+a background thread formats and writes them to LOG_FILE (stderr if empty). When the queue is
+full, records are dropped and counted instead of waiting.
+
+DEBUG records are sampled: only LOG_DEBUG_SAMPLE of the requests keep them, and all of the
+debug records of a kept request are kept together.
+
+Add "paper.log.RequestIdMiddleware" to MIDDLEWARE to tag records with the X-Request-ID header
+of the request, or a new id that is sent back in the response.
+"""
+
+import json
+import logging
+import os
+import Queue
+import random
+import sys
+import threading
+import time
+import uuid
+import zlib
+
+from constants import *
+
+
+_local = threading.local()
+_queue = Queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+_stats = {'written': 0, 'dropped': 0}
+
+
+def get_request_id():
+    return getattr(_local, 'request_id', None)
+
+
+def set_request_id(request_id):
+    """
+    Tag the records of this thread with $request_id, None to stop
+    """
+    _local.request_id = request_id
+
+
+def _sampled(request_id):
+    if LOG_DEBUG_SAMPLE >= 1.0:
+        return True
+    if request_id is None:
+        return random.random() < LOG_DEBUG_SAMPLE
+    return (zlib.crc32(request_id) & 0xffffffff) < LOG_DEBUG_SAMPLE * 0x100000000
+
+
+class ContextFilter(logging.Filter):
+    """
+    Add the request id to records and sample DEBUG records by request
+    """
+
+    def filter(self, record):
+        record.request_id = get_request_id()
+        if record.levelno <= logging.DEBUG:
+            return _sampled(record.request_id)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {'time': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) +
+                         ".%06d" % int(record.created % 1 * 1000000),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'msg': record.getMessage()}
+        if getattr(record, 'request_id', None):
+            entry['request_id'] = record.request_id
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class QueueHandler(logging.Handler):
+    """
+    Hand records to the writer thread without waiting
+    """
+
+    def emit(self, record):
+        _start_writer()
+        # Render the message and traceback now, they may change once the call returns
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            _queue.put_nowait(record)
+        except Queue.Full:
+            _stats['dropped'] += 1
+
+
+def _write_records():
+    formatter = JsonFormatter()
+    out = open(LOG_FILE, "a") if LOG_FILE else sys.stderr
+    while True:
+        # Write everything that is queued, then flush once
+        records = [_queue.get()]
+        try:
+            while True:
+                records.append(_queue.get_nowait())
+        except Queue.Empty:
+            pass
+        for record in records:
+            try:
+                out.write(formatter.format(record) + "\n")
+                _stats['written'] += 1
+            except Exception:
+                _stats['dropped'] += 1
+        out.flush()
+
+
+def _start_writer():
+    """
+    Start the writer thread of this process, again in a forked child
+    """
+    global _writer, _writer_pid
+    if _writer is not None and _writer_pid == os.getpid():
+        return
+    with _writer_lock:
+        if _writer is None or _writer_pid != os.getpid():
+            _writer = threading.Thread(target=_write_records, name="log writer")
+            _writer.daemon = True
+            _writer.start()
+            _writer_pid = os.getpid()
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    """
+    A logger whose calls take keyword fields: logger.info("msg", key=value, ...)
+    """
+
+    def __init__(self, logger):
+        logging.LoggerAdapter.__init__(self, logger, {})
+
+    def process(self, msg, kwargs):
+        fields = dict((k, kwargs.pop(k)) for k in list(kwargs) if k not in ('exc_info', 'extra'))
+        kwargs['extra'] = dict(kwargs.get('extra') or {}, fields=fields)
+        return msg, kwargs
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def debug(self, msg, *args, **kwargs):
+        # Skip building the fields of records that are filtered out anyway
+        if self.logger.isEnabledFor(logging.DEBUG):
+            logging.LoggerAdapter.debug(self, msg, *args, **kwargs)
+
+
+def get_logger(name):
+    """
+    Get the structured logger of a module, under the "paper" logger however it is imported
+    """
+    return StructuredLogger(logging.getLogger("paper." + name.split(".")[-1]))
+
+
+def get_log_stats():
+    """
+    Get the number of records written and dropped
+    """
+    return dict(_stats, queued=_queue.qsize())
+
+
+def _configure():
+    root = logging.getLogger("paper")
+    if any(isinstance(h, QueueHandler) for h in root.handlers):
+        return
+    handler = QueueHandler()
+    handler.addFilter(ContextFilter())
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, LOG_LEVEL.upper(), logging.INFO))
+    root.propagate = False
+
+
+_configure()
+
+
+class RequestIdMiddleware(object):
+    """
+    Tag the log records of a request with its X-Request-ID header, or a new id
+    """
+
+    def __init__(self, get_response = None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        self.process_request(request)
+        return self.process_response(request, self.get_response(request))
+
+    def process_request(self, request):
+        request_id = request.META.get('HTTP_X_REQUEST_ID') or uuid.uuid4().hex
+        request.request_id = request_id
+        set_request_id(request_id)
+
+    def process_response(self, request, response):
+        request_id = getattr(request, 'request_id', None)
+        if request_id:
+            response['X-Request-ID'] = request_id
+        set_request_id(None)
+        return response
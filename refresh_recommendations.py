@@ -0,0 +1,60 @@
+"""
+Refresh the precomputed recommendations of users queued by likes and unlikes.
+
+Usage:
+    python -m paper.refresh_recommendations [--watch SECONDS]
+
+Without --watch the queue is drained once. With it, the queue is drained again every
+SECONDS seconds; run it next to the web workers. Several refreshers can run at once.
+"""
+
+# Import necessary packages
+import paper.database_wrapper as db_wrapper
+import paper.functions as funcs
+from paper.constants import *
+
+import argparse
+import sys
+import time
+
+
+"""
+Refresh constants
+"""
+
+BATCH_SIZE = 500
+
+
+def drain_queue(batch_size = BATCH_SIZE):
+    """
+    Refresh queued users until the queue is empty
+
+    :return: The number of users refreshed, None on failure
+    """
+    total = 0
+    while True:
+        status, refreshed = db_wrapper.call_db(funcs.refresh_queued_recommendations, {'count':batch_size})
+        if status != SUCCESS:
+            print "[Error] Can not refresh recommendations"
+            return None
+        total += refreshed
+        if refreshed == 0:
+            return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh queued recommendations")
+    parser.add_argument("--watch", type=float, default=None, help="drain the queue every WATCH seconds")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    while True:
+        start = time.time()
+        total = drain_queue(args.batch_size)
+        if total is None and args.watch is None:
+            sys.exit(1)
+        if total:
+            print "[Refresh] %d users in %.2fs" % (total, time.time() - start)
+        if args.watch is None:
+            break
+        time.sleep(args.watch)
@@ -0,0 +1,51 @@
+"""
+Recompute the denormalized counters from the base tables.
+
+Usage:
+    python -m paper.repair_counters
+
+Counters are kept up to date on every write, so this is only needed after a manual
+change to the database or to check that they have not drifted.
+"""
+
+# Import necessary packages
+import paper.database_wrapper as db_wrapper
+import paper.functions as funcs
+from paper.constants import *
+
+import sys
+
+
+"""
+Counters to repair, with the API that recomputes them
+"""
+
+REPAIRS = [
+    ('papers.like_count', funcs.repair_like_counts),
+    ('tagnames.paper_count, tag_pairs', funcs.repair_tag_counts),
+    ('user_stats, user_tags', funcs.repair_user_stats),
+    ('blobs.ref_count', funcs.repair_blob_counts),
+    # Queues every user; run refresh_recommendations afterwards
+    ('user_similarity', funcs.rebuild_user_similarity),
+]
+
+
+def repair_all():
+    """
+    Run every repair
+
+    :return: True if all of them succeeded
+    """
+    ok = True
+    for name, func in REPAIRS:
+        status, fixed = db_wrapper.call_db(func, {})
+        if status != SUCCESS:
+            print "[Error] Can not repair %s" % name
+            ok = False
+        else:
+            print "[%s]: %d fixed" % (name, fixed)
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if repair_all() else 1)
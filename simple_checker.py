@@ -30,8 +30,12 @@ ALL_FUNCS = ['add_new_paper', 'delete_paper', 'get_paper_tags',
              'get_most_popular_papers', 'get_most_popular_tag_pairs',
              'get_most_popular_tags', 'get_number_papers_user', 'get_number_tags_user',
              'get_number_liked_user', 'get_recommend_papers', 'get_timeline',
-             'get_timeline_all', 'get_likes', 'login', 'reset_db',
-             'signup', 'unlike_paper', 'like_paper']
+             'get_timeline_all', 'get_likes', 'get_like_state', 'get_likes_tags_batch', 'login', 'reset_db',
+             'signup', 'unlike_paper', 'like_paper', 'add_extract_job', 'get_extract_job',
+             'fail_extract_job', 'retry_extract_job', 'finish_extract_job', 'repair_like_counts',
+             'refresh_queued_recommendations', 'get_related_tags', 'repair_tag_counts',
+             'get_user_stats', 'repair_user_stats', 'home_page_bundle', 'get_paper_blob',
+             'get_blob_text', 'collect_blob', 'repair_blob_counts', 'apply_likes']
 RES = {}
 VERBOSE = False
 
@@ -95,6 +99,9 @@ def db_wrapper_debug(func, argdict, verbose = VERBOSE):
 
 
 if __name__ == "__main__":
+    # Every check reads right after its writes, keep all of them on the primary
+    db_wrapper.set_primary_until(float('inf'))
+
     # Reset the database
     RES[funcs.reset_db.__name__] = True
     try:
@@ -155,12 +162,23 @@ if __name__ == "__main__":
     except TypeError:
         format_error(funcs.like_paper)
 
+    # Refresh the recommendations of users affected by the likes above
+    RES[funcs.refresh_queued_recommendations.__name__] = True
+    try:
+        status, res = db_wrapper_debug(funcs.refresh_queued_recommendations, {})
+        if status != SUCCESS:
+            status_error(funcs.refresh_queued_recommendations)
+        int(res)
+    except TypeError:
+        format_error(funcs.refresh_queued_recommendations)
+
     # Test list papers
     list_funcs_ctx = [
         (funcs.get_timeline, [5, 4, 3, 2, 1], {'uname':USERS[0]}),
         (funcs.get_timeline_all, [5, 4, 3, 2, 1], {}),
         (funcs.get_papers_by_tag, [5, 4, 3, 1], {'tag':TAGS[0]}),
         (funcs.get_papers_by_keyword, [2], {'keyword':'pineapple'}),
+        (funcs.get_papers_by_keyword, [1], {'keyword':'apple pen', 'rank':True}),
         (funcs.get_papers_by_liked, [1], {'uname':USERS[1]}),
         (funcs.get_most_popular_papers, [1, 3, 2], {'begin_time':datetime.now() + timedelta(days=-1)}),
         (funcs.get_recommend_papers, [3, 2], {'uname':USERS[1]}),
@@ -184,16 +202,60 @@ if __name__ == "__main__":
         except (TypeError, ValueError):
                 format_error(func)
 
+    # Test keyset pagination
+    try:
+        pages = []
+        cursor = None
+        for i in range(3):
+            status, res = db_wrapper_debug(funcs.get_timeline_all, {'count':2, 'cursor':cursor})
+            if status != SUCCESS:
+                status_error(funcs.get_timeline_all)
+            pages.append([paper[0] for paper in res])
+            cursor = res.next_cursor
+        if pages != [[5, 4], [3, 2], [1]] or cursor is not None:
+            error_message(funcs.get_timeline_all, "expect pages [[5, 4], [3, 2], [1]] but return %s" % pages)
+    except (TypeError, ValueError, AttributeError):
+        format_error(funcs.get_timeline_all)
+
+    # Test the home page bundle against the APIs it replaces
+    try:
+        RES[funcs.home_page_bundle.__name__] = True
+        status, res = db_wrapper_debug(funcs.home_page_bundle, {'uname':USERS[0]})
+        if status != SUCCESS:
+            status_error(funcs.home_page_bundle)
+        for key, func in [('timeline', funcs.get_timeline), ('liked', funcs.get_papers_by_liked),
+                          ('recommend', funcs.get_recommend_papers), ('stats', funcs.get_user_stats)]:
+            status, ans = db_wrapper_debug(func, {'uname':USERS[0]})
+            if key != 'stats':
+                ans = list(ans)
+            if (list(res[key]) if key != 'stats' else res[key]) != ans:
+                error_message(funcs.home_page_bundle, "expect %s %s but return %s" % (key, ans, res[key]))
+        pids = [paper[0] for paper in res['timeline'] + res['liked'] + res['recommend']]
+        status, ans = db_wrapper_debug(funcs.get_likes_tags_batch, {'pids':pids})
+        if (res['likes'], res['tags']) != ans:
+            error_message(funcs.home_page_bundle, "expect likes and tags %s but return %s" %
+                          (ans, (res['likes'], res['tags'])))
+    except (TypeError, ValueError, KeyError):
+        format_error(funcs.home_page_bundle)
+
     # Test directly test return values
     value_func_ctx = [
         (funcs.get_likes, 3, {'pid':1}),
+        (funcs.get_like_state, (False, 3, True), {'uname':USERS[0], 'pid':1}),
         (funcs.get_most_active_users, [USERS[0]], {'count':1}),
         (funcs.get_most_popular_tags, [(TAGS[0], 4)], {'count':1}),
         (funcs.get_most_popular_tag_pairs, [(TAGS[0], TAGS[1], 3)], {'count':1}),
         (funcs.get_number_papers_user, 5, {'uname':USERS[0]}),
         (funcs.get_number_tags_user, 4, {'uname':USERS[0]}),
         (funcs.get_number_liked_user, 3, {'uname':USERS[2]}),
+        (funcs.get_user_stats, (0, 3, 0), {'uname':USERS[2]}),
         (funcs.get_paper_tags, ['tag1', 'tag2', 'tag3'], {'pid':1}),
+        (funcs.get_likes_tags_batch, ({1:3, 2:1}, {1:['tag1', 'tag2', 'tag3'], 2:['tag2', 'tag3', 'tag4']}),
+            {'pids':[1, 2]}),
+        (funcs.repair_like_counts, 0, {}),
+        (funcs.get_related_tags, [(TAGS[1], 3), (TAGS[2], 3)], {'tag':TAGS[0], 'count':2}),
+        (funcs.repair_tag_counts, 0, {}),
+        (funcs.repair_user_stats, 0, {}),
     ]
 
     for func, ans, args in value_func_ctx:
@@ -208,6 +270,81 @@ if __name__ == "__main__":
         except (TypeError, ValueError):
             format_error(func)
 
+    # Test extraction jobs
+    try:
+        for func in [funcs.add_extract_job, funcs.get_extract_job, funcs.fail_extract_job,
+                     funcs.retry_extract_job, funcs.finish_extract_job]:
+            RES[func.__name__] = True
+        status, res = db_wrapper_debug(funcs.add_extract_job, {'pid':5, 'file_path':'5.pdf'})
+        if status != SUCCESS:
+            status_error(funcs.add_extract_job)
+        status, res = db_wrapper_debug(funcs.get_extract_job, {'pid':5})
+        if status != SUCCESS:
+            status_error(funcs.get_extract_job)
+        elif res[2] != EXTRACT_PENDING:
+            error_message(funcs.get_extract_job, "expect state %s but return %s" % (EXTRACT_PENDING, res[2]))
+        status, res = db_wrapper_debug(funcs.fail_extract_job, {'pid':5, 'error':'broken pdf'})
+        if status != SUCCESS:
+            status_error(funcs.fail_extract_job)
+        elif res != 1:
+            error_message(funcs.fail_extract_job, "expect 1 attempt but return %s" % res)
+        status, res = db_wrapper_debug(funcs.retry_extract_job, {'pid':5})
+        if status != SUCCESS:
+            status_error(funcs.retry_extract_job)
+        elif res != '5.pdf':
+            error_message(funcs.retry_extract_job, "expect file 5.pdf but return %s" % res)
+        status, res = db_wrapper_debug(funcs.finish_extract_job, {'pid':5, 'text':TEXTS[4]})
+        if status != SUCCESS:
+            status_error(funcs.finish_extract_job)
+        status, res = db_wrapper_debug(funcs.get_extract_job, {'pid':5})
+        if status != SUCCESS or res[2] != EXTRACT_DONE:
+            error_message(funcs.finish_extract_job, "job is not done")
+    except (TypeError, ValueError, IndexError):
+        format_error(funcs.add_extract_job)
+
+    # Test pdf storage: two papers sharing a file, which is removed with the last one
+    try:
+        for func in [funcs.get_paper_blob, funcs.get_blob_text, funcs.collect_blob, funcs.repair_blob_counts]:
+            RES[func.__name__] = True
+        blob = "ab" * 32
+        pids = []
+        for i in range(2):
+            status, res = db_wrapper_debug(funcs.add_new_paper, {'uname':USERS[0], 'title':TITLES[i],
+                                                                 'desc':DESCS[0], 'text':None, 'tags':[],
+                                                                 'blob':(blob, 3)})
+            if status != SUCCESS:
+                status_error(funcs.add_new_paper)
+            pids.append(res)
+        status, res = db_wrapper_debug(funcs.get_paper_blob, {'pid':pids[0]})
+        if status != SUCCESS:
+            status_error(funcs.get_paper_blob)
+        elif res != blob:
+            error_message(funcs.get_paper_blob, "expect %s but return %s" % (blob, res))
+        status, res = db_wrapper_debug(funcs.get_blob_text, {'sha256':blob})
+        if status != SUCCESS:
+            status_error(funcs.get_blob_text)
+        elif res is not None:
+            error_message(funcs.get_blob_text, "expect None but return %s" % res)
+        status, res = db_wrapper_debug(funcs.repair_blob_counts, {})
+        if status != SUCCESS:
+            status_error(funcs.repair_blob_counts)
+        elif res != 0:
+            error_message(funcs.repair_blob_counts, "expect 0 but return %s" % res)
+        removed = []
+        for pid, ans in zip(pids, [False, True]):
+            status, res = db_wrapper_debug(funcs.delete_paper, {'pid':pid})
+            if status != SUCCESS or res != blob:
+                error_message(funcs.delete_paper, "expect %s but return %s" % (blob, res))
+            status, res = db_wrapper_debug(funcs.collect_blob, {'sha256':blob, 'remove':removed.append})
+            if status != SUCCESS:
+                status_error(funcs.collect_blob)
+            elif res != ans:
+                error_message(funcs.collect_blob, "expect %s but return %s" % (ans, res))
+        if removed != [blob]:
+            error_message(funcs.collect_blob, "expect to remove %s but removed %s" % ([blob], removed))
+    except (TypeError, ValueError):
+        format_error(funcs.collect_blob)
+
     # Test functions with no return value
     none_func_ctx = [
         (funcs.unlike_paper, {'uname':USERS[1], 'pid':1}),
@@ -223,6 +360,43 @@ if __name__ == "__main__":
         except (TypeError, ValueError):
             format_error(func)
 
+    # Test batched likes: only new likes of other users' papers and existing likes count
+    RES[funcs.apply_likes.__name__] = True
+    try:
+        status, res = db_wrapper_debug(funcs.apply_likes, {
+            'likes':[(USERS[1], 2), (USERS[0], 2), (USERS[2], 2)], 'unlikes':[(USERS[3], 3), (USERS[4], 3)]})
+        if status != SUCCESS:
+            status_error(funcs.apply_likes)
+        elif res != (1, 1):
+            error_message(funcs.apply_likes, "expect (1, 1) but return %s" % (res, ))
+        status, res = db_wrapper_debug(funcs.get_likes, {'pid':2})
+        if status != SUCCESS or res != 2:
+            error_message(funcs.apply_likes, "expect 2 likes but return %s" % res)
+    except (TypeError, ValueError):
+        format_error(funcs.apply_likes)
+
+    # Test routing to the read replicas, with DB_REPLICA_DESCS set
+    if DB_REPLICA_DESCS:
+        func = db_wrapper.get_db_connection
+        ALL_FUNCS.append(func.__name__)
+        RES[func.__name__] = True
+        # stick_to_primary only works in a request seen by the middleware
+        middleware = db_wrapper.ReadYourWritesMiddleware()
+        request = type('Request', (object, ), {'COOKIES': {}})()
+        middleware.process_request(request)
+        for write, replica in [(False, True), (True, False)]:
+            if write:
+                db_wrapper.stick_to_primary()
+            status, conn = func(replica=True)
+            if status != SUCCESS:
+                status_error(func)
+            if conn.replica != replica:
+                error_message(func, "expect a read%s to go to the %s" % (
+                    " after a write" if write else "", "replica" if replica else "primary"), False)
+            db_wrapper.close_db_connection(conn)
+        middleware.process_response(request, type('Response', (object, ), {'set_cookie': lambda *args, **kwargs: None})())
+        db_wrapper.set_primary_until(float('inf'))
+
     # Reset database
     db_wrapper_debug(funcs.reset_db, {})
     report_result()
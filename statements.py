@@ -0,0 +1,135 @@
+"""
+Prepared statements of the hot queries of functions.py.
+
+PostgreSQL parses and plans a query every time its text is sent. An API that runs its query
+with execute(cur, name, query, vars) instead of cur.execute(query, vars) has it prepared once
+per connection: the first call sends PREPARE, every later call only EXECUTE with the values.
+After a few executions the server may also settle on a generic plan and stop planning.
+
+Only connections of the pool (PreparingConnection) remember what they prepared; on any other
+connection, or with PREPARED_STATEMENTS_ENABLED off, the query is run as is. So is a query
+the server refuses to prepare. When the type of a parameter can not be inferred, the refusal
+is remembered so that the query is tried only once; any other error, e.g. a table missing
+while reset_db runs, is tried again with the next call.
+
+Queries use the usual %s placeholders, which are turned into $1, $2, ... for PREPARE.
+"""
+
+import hashlib
+import re
+import threading
+
+import psycopg2 as psy
+import psycopg2.errorcodes as psy_errorcodes
+import psycopg2.extensions as psy_ext
+
+from constants import *
+from log import get_logger
+import instrumentation
+
+
+logger = get_logger(__name__)
+_PLACEHOLDER = re.compile(r"%%|%s")
+_lock = threading.Lock()
+# statement name -> query that the server would not prepare
+_unpreparable = {}
+# api name -> {'prepares', 'executes', 'fallbacks'}
+_stats = {}
+_stats_connections = {'connections': 0}
+
+
+class PreparingConnection(psy_ext.connection):
+    """
+    A connection remembering the statements prepared on it
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+        with _lock:
+            _stats_connections['connections'] += 1
+
+
+def to_positional(query):
+    """
+    Turn the %s placeholders of a query into $1, $2, ...
+
+    :return: (query, number of parameters)
+    """
+    count = [0]
+
+    def replace(match):
+        if match.group(0) == "%%":
+            return "%"
+        count[0] += 1
+        return "$%d" % count[0]
+    return _PLACEHOLDER.sub(replace, query), count[0]
+
+
+def statement_name(name, query):
+    """
+    Name the statement of a query of an API; APIs with several queries or variants of a
+    query get one statement each
+    """
+    return "%s_%s" % (name, hashlib.md5(query).hexdigest()[:12])
+
+
+def _count(name, key):
+    with _lock:
+        item = _stats.get(name)
+        if item is None:
+            item = _stats[name] = {'prepares': 0, 'executes': 0, 'fallbacks': 0}
+        item[key] += 1
+
+
+def _prepare(cur, statement, query):
+    """
+    Prepare a query in a savepoint, so that a refusal does not abort the caller's transaction.
+    Only a query whose parameter types can not be inferred is never prepared again.
+    """
+    cur.execute("SAVEPOINT prepare_statement")
+    try:
+        cur.execute("PREPARE %s AS %s" % (statement, to_positional(query)[0]))
+    except psy.ProgrammingError, e:
+        cur.execute("ROLLBACK TO SAVEPOINT prepare_statement")
+        if e.pgcode == psy_errorcodes.INDETERMINATE_DATATYPE:
+            with _lock:
+                _unpreparable[statement] = query
+        logger.warning("can not prepare statement", statement=statement, code=e.pgcode,
+                       error=str(e).strip())
+        return False
+    cur.execute("RELEASE SAVEPOINT prepare_statement")
+    return True
+
+
+def execute(cur, name, query, vars = None):
+    """
+    Run a query of the API $name through its prepared statement on the cursor's connection
+    """
+    prepared = getattr(cur.connection, 'prepared', None)
+    if not PREPARED_STATEMENTS_ENABLED or prepared is None:
+        return cur.execute(query, vars)
+    statement = statement_name(name, query)
+    if statement not in prepared:
+        if statement in _unpreparable or not _prepare(cur, statement, query):
+            _count(name, 'fallbacks')
+            return cur.execute(query, vars)
+        prepared.add(statement)
+        _count(name, 'prepares')
+    _count(name, 'executes')
+    if isinstance(cur, instrumentation.TimedCursor):
+        cur.prepared_source = (query, vars)
+    if vars:
+        return cur.execute("EXECUTE %s (%s)" % (statement, ", ".join(["%s"] * len(vars))), vars)
+    return cur.execute("EXECUTE %s" % statement)
+
+
+def get_statement_stats():
+    """
+    Get the number of statements prepared, executed and run unprepared per API, the
+    connections that prepared statements and the statements the server refused
+    """
+    with _lock:
+        return {'apis': dict((name, dict(item)) for name, item in _stats.items()),
+                'connections': _stats_connections['connections'],
+                'unpreparable': sorted(_unpreparable)}
@@ -0,0 +1,143 @@
+"""
+Content addressed storage of uploaded pdf files.
+
+A file is stored once, under media/blobs/<first 2 hex digits>/<sha256>.pdf, however many papers
+are uploaded with it. The blobs table counts the papers referencing each file (triggers on
+papers keep ref_count) and caches the text extracted from it, so an upload of a known file
+reuses the text instead of running the extraction again. Papers uploaded before have no blob
+and keep their file at media/<pid>.pdf.
+
+Files can not be part of a transaction, so they are written and removed in this order:
+    save_upload     Stream the upload to a temporary file, hashing it on the way
+    add_new_paper   Reference the blob in the same statement that creates the paper
+    keep            Move the temporary file to the blob's path, or drop it if already there;
+                    if it can not be moved the paper is deleted again and the upload fails
+and when a paper is deleted:
+    release         Once no paper references the blob, delete its row, then remove the file
+                    before the commit, while the row is locked (functions.collect_blob)
+An upload of the same file waits on that row lock in add_new_paper, so its keep always comes
+after the removal.
+"""
+
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+
+from constants import *
+from log import get_logger
+from database_wrapper import call_db
+import functions
+
+
+logger = get_logger(__name__)
+MEDIA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'media')
+BLOB_DIR = os.path.join(MEDIA_DIR, 'blobs')
+
+
+def blob_path(sha256):
+    """
+    Get the path of the file of a sha256
+    """
+    return os.path.join(BLOB_DIR, sha256[:2], sha256 + ".pdf")
+
+
+def make_dirs(path):
+    """
+    Create a directory and its parents unless it exists
+    """
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def save_upload(uploaded):
+    """
+    Write an uploaded file to a temporary file next to the blobs
+
+    :param uploaded: A django UploadedFile
+    :return: (sha256, size, temporary path)
+    """
+    make_dirs(BLOB_DIR)
+    fd, temp_path = tempfile.mkstemp(suffix=".part", dir=BLOB_DIR)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in uploaded.chunks(FILE_CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+    except:
+        discard(temp_path)
+        raise
+    return digest.hexdigest(), size, temp_path
+
+
+def keep(sha256, temp_path):
+    """
+    Store a file written by save_upload under its sha256, once its paper is committed.
+    The move is tried twice; if it still fails the temporary file is removed and the caller
+    must delete the paper again, since its blob row points at the path of the sha256.
+
+    :return: The path of the blob, None if the file can not be moved there
+    """
+    path = blob_path(sha256)
+    for attempt in range(2):
+        if os.path.exists(path):
+            discard(temp_path)
+            return path
+        try:
+            make_dirs(os.path.dirname(path))
+            os.rename(temp_path, path)
+            return path
+        except OSError:
+            logger.exception("can not move file", path=temp_path, sha256=sha256, attempt=attempt)
+    discard(temp_path)
+    return None
+
+
+def discard(temp_path):
+    """
+    Remove a file written by save_upload that is not kept
+    """
+    try:
+        os.remove(temp_path)
+    except OSError:
+        logger.warning("can not remove file", path=temp_path)
+
+
+def remove_blob(sha256):
+    """
+    Remove the file of a sha256, called by functions.collect_blob
+    """
+    try:
+        os.remove(blob_path(sha256))
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def release(sha256):
+    """
+    Remove the file of a sha256 if no paper references it anymore
+
+    :return: True if the file is removed
+    """
+    status, removed = call_db(functions.collect_blob, {'sha256':sha256, 'remove':remove_blob})
+    if status != SUCCESS:
+        logger.error("can not collect blob", sha256=sha256)
+        return False
+    if removed:
+        logger.info("blob removed", sha256=sha256)
+    return removed
+
+
+def clear():
+    """
+    Remove every stored file, after the database is reset
+    """
+    shutil.rmtree(BLOB_DIR, ignore_errors=True)
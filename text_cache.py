@@ -0,0 +1,211 @@
+"""
+Cache of the text extracted from pdf files, on disk and keyed by the sha256 of the file.
+
+Extraction is the most expensive step of an upload or an import, and the same file comes
+back often: re-uploads, retries, bulk imports run again. extraction.extract_text looks the
+file up here first and stores what it extracts. Entries are zlib compressed, one file each
+under <TEXT_CACHE_DIR>/<first 2 hex digits>/<sha256>.z, and written with a rename so that
+the worker processes sharing the directory never read a partial entry.
+
+The directory is kept under TEXT_CACHE_MAX_BYTES by removing the least recently used
+entries; a hit touches the entry's modification time. Every process keeps an estimate of
+the size, which only counts its own writes, and scans the directory once the estimate goes
+over the budget, or after TEXT_CACHE_RESCAN_WRITES writes or TEXT_CACHE_RESCAN_SECONDS
+seconds to catch up with the other processes. The directory thus goes over the budget by
+at most the entries written meanwhile by the other processes.
+
+Hits, misses and the size of the pdf files that did not have to be extracted are counted
+by the process collecting the results, see record and get_text_cache_stats.
+"""
+
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import zlib
+
+from constants import *
+from log import get_logger
+import storage
+
+
+logger = get_logger(__name__)
+
+
+class TextCache(object):
+    """
+    Compressed text files in a directory, with LRU eviction under a size budget
+    """
+
+    def __init__(self, directory, max_bytes=TEXT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Estimated size of the entries, None until the directory is scanned
+        self._size = None
+        self._writes_since_scan = 0
+        self._scanned_at = 0.0
+        self.evictions = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".z")
+
+    def get(self, key):
+        """
+        Get the text of a key, None if it is not cached
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+            return zlib.decompress(data)
+        except (IOError, OSError):
+            return None
+        except zlib.error:
+            logger.warning("corrupt text cache entry", path=path)
+            self._remove(path)
+            return None
+
+    def put(self, key, text):
+        """
+        Store the text of a key, then evict if the budget is exceeded
+        """
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        data = zlib.compress(text, TEXT_CACHE_LEVEL)
+        path = self._path(key)
+        temp_path = None
+        try:
+            storage.make_dirs(os.path.dirname(path))
+            fd, temp_path = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            logger.exception("can not write text cache entry", path=path)
+            if temp_path is not None:
+                self._remove(temp_path)
+            return
+        with self._lock:
+            self._writes_since_scan += 1
+            if self._size is None or self._writes_since_scan >= TEXT_CACHE_RESCAN_WRITES or \
+                    time.time() - self._scanned_at >= TEXT_CACHE_RESCAN_SECONDS:
+                self._size = self._rescan()
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _scan(self):
+        """
+        Get the (mtime, size, path) of every entry and their total size
+        """
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith(".part"):
+                    # Left by a process killed while writing
+                    if st.st_mtime < time.time() - 3600:
+                        self._remove(path)
+                    continue
+                if not name.endswith(".z"):
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        return entries, total
+
+    def _rescan(self):
+        """
+        Get the size of the entries of every process
+        """
+        self._writes_since_scan = 0
+        self._scanned_at = time.time()
+        return self._scan()[1]
+
+    def _evict(self):
+        # Other processes write to the same directory, so start from what is really there
+        self._writes_since_scan = 0
+        self._scanned_at = time.time()
+        entries, total = self._scan()
+        target = self.max_bytes * TEXT_CACHE_LOW_WATER
+        for mtime, size, path in sorted(entries):
+            if total <= target:
+                break
+            if self._remove(path):
+                total -= size
+                self.evictions += 1
+        self._size = total
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                logger.warning("can not remove file", path=path)
+            return False
+
+
+_cache = None
+_cache_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0}
+
+
+def get_text_cache():
+    """
+    Get the cache in TEXT_CACHE_DIR, None if it is disabled
+    """
+    global _cache
+    if not TEXT_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = TextCache(TEXT_CACHE_DIR or os.path.join(storage.MEDIA_DIR, 'text_cache'))
+        return _cache
+
+
+def file_key(path):
+    """
+    Get the sha256 of the content of a file. Stored blobs are named by it already.
+    """
+    if os.path.dirname(os.path.dirname(os.path.abspath(path))) == storage.BLOB_DIR:
+        return os.path.splitext(os.path.basename(path))[0]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(FILE_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def record(hit, size):
+    """
+    Count a lookup of a pdf file of $size bytes
+    """
+    with _stats_lock:
+        if hit:
+            _stats['hits'] += 1
+            _stats['bytes_saved'] += size
+        else:
+            _stats['misses'] += 1
+
+
+def get_text_cache_stats():
+    """
+    Get the hits, misses, hit ratio and the size of the pdf files whose extraction was skipped
+    """
+    with _stats_lock:
+        total = _stats['hits'] + _stats['misses']
+        return dict(_stats, hit_ratio=float(_stats['hits']) / total if total else 0.0)
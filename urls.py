@@ -15,7 +15,11 @@ urlpatterns = [
     url(r'^unlike/(?P<paper_id>[0-9]+)/(?P<source>\w+)/$', views.unlike, name='unlike'),
     url(r'^delete_paper/(?P<paper_id>[0-9]+)$', views.delete_paper, name='delete_paper'),
     url(r'^view_paper/(?P<paper_id>[0-9]+)$', views.view_paper, name='view_paper'),
+    url(r'^extract_status/(?P<paper_id>[0-9]+)$', views.extract_status, name='extract_status'),
+    url(r'^retry_extract/(?P<paper_id>[0-9]+)$', views.retry_extract, name='retry_extract'),
     url(r'^search_view/$', views.search_view, name='search_view'),
     url(r'^tag_view/(?P<tag_name>\w+)$', views.tag_view, name='tag_view'),
     url(r'^reset/$', views.reset, name='reset'),
+    url(r'^stats/$', views.stats, name='stats'),
+    url(r'^metrics/$', views.metrics, name='metrics'),
 ]
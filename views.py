@@ -2,20 +2,34 @@ from django.shortcuts import render
 
 # Create your views here.
 from django.shortcuts import render
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.http import FileResponse, StreamingHttpResponse, Http404
 from django.urls import reverse
 from django.conf import settings
-from django.core.files.storage import FileSystemStorage
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
 
 from pytz import timezone
 from datetime import timedelta
 from datetime import datetime
-import textract
 
 from constants import *
 from database_wrapper import *
 import functions
+import extraction
+import storage
+import like_buffer
+import fragments
+import statements
+import text_cache
+import cache
+import instrumentation
+import hashlib
 import tempfile
+import time
+import log
+
+logger = log.get_logger(__name__)
 
 """
 Utility functions
@@ -67,6 +81,90 @@ def get_upload_file_path(pid):
     return get_upload_dir_path() + "/" + str(pid) + ".pdf"
 
 
+def get_file_etag(st):
+    """
+    Build a strong ETag from the size and modification time of a file
+    """
+    return '"%x-%x"' % (int(st.st_mtime * 1000000), st.st_size)
+
+
+def get_list_page_validators(request, parts = (), not_before = 0):
+    """
+    Build the ETag and Last-Modified of a list page without running its queries.
+    The lists show results of the cached read APIs, whose versions change whenever a paper,
+    a tag or a like is written (cache.get_change_token). The viewer, the query string and
+    $parts tell pages apart; $not_before is the earliest modification time, e.g. when the
+    page depends on the clock. Return (None, None) if the result cache is off, or if the
+    latest change may not have reached the read replicas yet: the body could then be read
+    from a replica behind the token, and a client would keep it under the new ETag.
+    Same right after a write of the viewer (stick_to_primary): the token of another worker's
+    local cache may not know it yet, and a 304 would hide it from them.
+    """
+    if not CACHE_ENABLED or get_primary_until() > time.time():
+        return None, None
+    token, changed = cache.get_change_token(functions.CACHED_PAPER_APIS)
+    if DB_REPLICA_DESCS and time.time() - changed < DB_REPLICA_MAX_LAG:
+        return None, None
+    key = hashlib.md5(repr((token, get_current_user(request), request.GET.urlencode(), parts))).hexdigest()
+    return '"%s"' % key, int(max(changed, not_before))
+
+
+def set_list_page_headers(response, etag, last_modified):
+    """
+    Send the validators of a list page. The page shows the viewer's name and likes, so only
+    their browser may keep it, never a shared proxy.
+    """
+    if etag is None:
+        return response
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, max_age=LIST_PAGE_MAX_AGE)
+    patch_vary_headers(response, ('Cookie', ))
+    return response
+
+
+def parse_range_header(header, size):
+    """
+    Parse a single "bytes=start-end" range of a file of the given size.
+    Return (start, end) with end inclusive, None if the whole file should be sent
+    (no header, several ranges or a unit other than bytes) or INVALID_RANGE if the
+    range can not be satisfied.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, sep, end = header[len('bytes='):].strip().partition('-')
+    try:
+        if start == '':
+            # suffix range, the last $end bytes
+            length = int(end)
+            if length <= 0 or size == 0:
+                return INVALID_RANGE
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = int(end) if end != '' else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return INVALID_RANGE
+    return start, min(end, size - 1)
+
+
+def file_range_iterator(f, start, length, chunk_size=FILE_CHUNK_SIZE):
+    """
+    Yield $length bytes of a file from offset $start, then close it
+    """
+    try:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
 def valid_login(request):
     """
     Validate a user has logged in by setting cookie.
@@ -79,27 +177,18 @@ def valid_login(request):
 
 def append_likes_tags(conn, posts):
     """
-    Utility to append like counts and tags of a given paper
+    Utility to append like counts and tags of the given papers.
+    All papers are decorated with a constant number of queries, so callers should pass
+    every list of a page in one call.
     """
-    likes = list()
-    tag_lists = list()
-    for post in posts:
-        # get like count for the post
-        status, likec = call_db_with_conn(conn, functions.get_likes, {'pid':int(post['pid'])})
-        if status == SUCCESS:
-            likes.append(int(likec))
-        else:
-            likes.append(0)
-        # get all the tags for the post
-        status, tags = call_db_with_conn(conn, functions.get_paper_tags, {'pid':int(post['pid'])})
-        if status == SUCCESS:
-            tag_lists.append(tags)
-        else:
-            tag_lists.append(list())
+    status, res = call_db_with_conn(conn, functions.get_likes_tags_batch,
+                                    {'pids':[int(post['pid']) for post in posts]})
+    likes, tag_lists = res if status == SUCCESS else (dict(), dict())
 
-    for i in range(len(posts)):
-        posts[i]['like'] = likes[i]
-        posts[i]['tags'] = tag_lists[i]
+    for post in posts:
+        pid = int(post['pid'])
+        post['like'] = likes.get(pid, 0)
+        post['tags'] = tag_lists.get(pid, list())
 
 
 def get_paper_dict(paper_list):
@@ -107,7 +196,7 @@ def get_paper_dict(paper_list):
         return \
             [{'pid':x[0], 'username':x[1], 'title':x[2], 'begin_time':x[3], 'desc':x[4]} for x in paper_list]
     except (IndexError, KeyError) as e:
-        print "[TA Hints] May be your return value is not in the correct format"
+        logger.error("paper tuples are not in the expected format")
         raise e
 """
 Views
@@ -131,7 +220,8 @@ def reset(request):
                 try:
                     os.remove(file)
                 except:
-                    print "Can not remove file %s" % file
+                    logger.warning("can not remove file", path=file)
+        storage.clear()
     return render(request, 'paper/reset.html', context)
 
 
@@ -209,58 +299,43 @@ def home(request, err_msg = None):
     # Setup connection
     conn = None
     try:
-        status, conn = get_db_connection()
+        status, conn = get_db_connection(replica=True)
         if status != SUCCESS:
             context['error_message'] = err_internal
             return render(request, 'paper/base_paper_list.html', context)
 
-        # Get timeline
-        status, timeline_papers = call_db_with_conn(conn, functions.get_timeline, {'uname':uname})
+        # Get timeline, liked and recommended papers, their likes and tags and the statistics at once
+        status, bundle = call_db_with_conn(conn, functions.home_page_bundle,
+                                           {'uname':uname, 'cursor':request.GET.get('cursor')})
         if status != SUCCESS:
             context['error_message'] = err_internal
             return render(request, 'paper/base_paper_list.html', context)
 
-        if len(timeline_papers) == 0:
+        if len(bundle['timeline']) == 0:
             context['error_message'] = "No post posted"
-
-        # Get liked
-        status, liked_papers = call_db_with_conn(conn, functions.get_papers_by_liked, {'uname':uname})
-        if status != SUCCESS:
-            context['error_message'] = err_internal
-            return render(request, 'paper/base_paper_list.html', context)
-
-        if len(liked_papers) == 0:
+        if len(bundle['liked']) == 0:
             context['error_message2'] = "Not any liked posts"
-
-        # Get recommendation
-        status, recommend_papers = call_db_with_conn(conn, functions.get_recommend_papers, {'uname':uname})
-        if status != SUCCESS:
-            context['error_message'] = err_internal
-            close_db_connection(conn)
-            return render(request, 'paper/base_paper_list.html', context)
-
-        if len(recommend_papers) == 0:
+        if len(bundle['recommend']) == 0:
             context['error_message3'] = "Not any recommendation posts"
 
-        # Get statistics
-        status, num_post = call_db_with_conn(conn, functions.get_number_papers_user, {'uname':uname})
-        status, num_like = call_db_with_conn(conn, functions.get_number_liked_user, {'uname':uname})
-        status, num_tag = call_db_with_conn(conn, functions.get_number_tags_user, {'uname':uname})
-
-        recommend_paper_dicts = get_paper_dict(recommend_papers)
-        liked_paper_dicts = get_paper_dict(liked_papers)
-        timeline_paper_dicts = get_paper_dict(timeline_papers)
-        append_likes_tags(conn, recommend_paper_dicts)
-        append_likes_tags(conn, liked_paper_dicts)
-        append_likes_tags(conn, timeline_paper_dicts)
+        timeline_paper_dicts = get_paper_dict(bundle['timeline'])
+        liked_paper_dicts = get_paper_dict(bundle['liked'])
+        recommend_paper_dicts = get_paper_dict(bundle['recommend'])
+        for post in timeline_paper_dicts + liked_paper_dicts + recommend_paper_dicts:
+            post['like'] = bundle['likes'].get(post['pid'], 0)
+            post['tags'] = bundle['tags'].get(post['pid'], list())
         context['paper_list'] = timeline_paper_dicts
+        context['next_cursor'] = bundle['timeline'].next_cursor
         context['liked_list'] = liked_paper_dicts
         context['recommend_list'] = recommend_paper_dicts
-        context['num_post'] = num_post
-        context['num_like'] = num_like
-        context['num_tag'] = num_tag
+        context['num_post'], context['num_like'], context['num_tag'] = bundle['stats']
 
+        start = time.time()
+        # The timeline holds the user's own papers and recommendations exclude liked ones
+        fragments.render_cards(timeline_paper_dicts + liked_paper_dicts + recommend_paper_dicts,
+                               context['source'], uname, set(post['pid'] for post in liked_paper_dicts))
         response = render(request, 'paper/base_paper_list.html', context)
+        instrumentation.report_timings('home', {'render': time.time() - start})
         return response
     finally:
         if conn is not None:
@@ -280,52 +355,62 @@ def popular_papers(request, err_msg = None):
     context['popular'] = True
     context['source'] = 'popular'
     context['header_text'] = "What's new"
+
+    # whole minutes, so that the result can be served from the cache
+    begin_time = get_datetime(timedelta(days=-14)).replace(second=0, microsecond=0)
+    etag, last_modified = None, None
+    if err_msg is None:
+        # the popular papers window moves every minute
+        etag, last_modified = get_list_page_validators(request, (str(begin_time), ), int(time.time()) // 60 * 60)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return set_list_page_headers(response, etag, last_modified)
+
     # setup connection
     conn = None
     try:
-        status, conn = get_db_connection()
-        if status != SUCCESS:
-            context['error_message'] = err_internal
-            return render(request, 'paper/base_paper_list.html', context)
-
-        # get popular papers
-        status, popular_paper_list = call_db_with_conn(conn, functions.get_most_popular_papers,
-                                                   {'begin_time':get_datetime(timedelta(days=-14))})
-        if status != SUCCESS:
+        # get popular papers, recent papers and global statistics concurrently
+        results = call_db_concurrently([
+            (functions.get_most_popular_papers, {'begin_time':begin_time, 'cursor':request.GET.get('cursor')}),
+            (functions.get_timeline_all, {'cursor':request.GET.get('recent_cursor')}),
+            (functions.get_most_active_users, {}),
+            (functions.get_most_popular_tags, {}),
+            (functions.get_most_popular_tag_pairs, {}),
+        ])
+        (status, popular_paper_list), (status_recent, recent_paper_list) = results[:2]
+        if status != SUCCESS or status_recent != SUCCESS:
             context['error_message'] = err_internal
             return render(request, 'paper/base_paper_list.html', context)
 
         if len(popular_paper_list) == 0:
             context['error_message'] = "Not any popular papers now, publish your own and become popular!"
 
-        # get recent papers
-        status, recent_paper_list = call_db_with_conn(conn, functions.get_timeline_all, {})
-
-        if status != SUCCESS:
-            context['error_message'] = err_internal
-            return render(request, 'paper/base_paper_list.html', context)
-
         if len(recent_paper_list) == 0:
             context['error_message2'] = "Not any recent papers"
-       # Get global statistics
-        status, active_user = call_db_with_conn(conn, functions.get_most_active_users, {})
-        status, popular_tag = call_db_with_conn(conn, functions.get_most_popular_tags, {})
-        status, popular_tag_pair = call_db_with_conn(conn, functions.get_most_popular_tag_pairs, {})
+        active_user, popular_tag, popular_tag_pair = [res if status == SUCCESS else [] for status, res in results[2:]]
         active_user = active_user[0] if len(active_user) > 0 else ""
         popular_tag = popular_tag[0] if len(popular_tag) > 0 else ""
         popular_tag_pair = popular_tag_pair[0][0] + ", " + popular_tag_pair[0][1] if len(popular_tag_pair) > 0 else ""
 
+        status, conn = get_db_connection(replica=True)
+        if status != SUCCESS:
+            context['error_message'] = err_internal
+            return render(request, 'paper/base_paper_list.html', context)
+
         popular_papers_dicts = get_paper_dict(popular_paper_list)
         recent_papers_dicts = get_paper_dict(recent_paper_list)
-        append_likes_tags(conn, popular_papers_dicts)
-        append_likes_tags(conn, recent_papers_dicts)
+        append_likes_tags(conn, popular_papers_dicts + recent_papers_dicts)
+        fragments.render_cards(popular_papers_dicts + recent_papers_dicts, context['source'], context['username'])
 
         context['paper_list'] = popular_papers_dicts
         context['recent_list'] = recent_papers_dicts
+        context['next_cursor'] = popular_paper_list.next_cursor
+        context['recent_cursor'] = recent_paper_list.next_cursor
         context['active_user'] = active_user
         context['popular_tag'] = popular_tag
         context['popular_pair'] = popular_tag_pair
         response = render(request, 'paper/base_paper_list.html', context)
+        set_list_page_headers(response, etag, last_modified)
 
         return response
     finally:
@@ -352,13 +437,16 @@ def search_view(request):
         # Setup connection
         conn = None
         try:
-            status, conn = get_db_connection()
+            status, conn = get_db_connection(replica=True)
             if status != SUCCESS:
                 context['error_message'] = err_internal
                 return render(request, 'paper/base_paper_list.html', context)
 
             # Get search result
-            status, res_paper_list = call_db_with_conn(conn, functions.get_papers_by_keyword, {'keywords':keywords})
+            rank = request.POST.get('order') == 'relevance'
+            status, res_paper_list = call_db_with_conn(conn, functions.get_papers_by_keyword,
+                                                       {'keyword':keywords, 'rank':rank,
+                                                        'cursor':request.POST.get('cursor') or None})
             if status != SUCCESS:
                 context['error_message'] = err_internal
                 return render(request, 'paper/base_paper_list.html', context)
@@ -366,9 +454,11 @@ def search_view(request):
             if len(res_paper_list) == 0:
                 context['error_message'] = "No post posted"
                 return render(request, 'paper/base_paper_list.html', context)
-           res_paper_dicts = get_paper_dict(res_paper_list)
+            res_paper_dicts = get_paper_dict(res_paper_list)
             append_likes_tags(conn, res_paper_dicts)
+            fragments.render_cards(res_paper_dicts, context['source'], context['username'])
             context['paper_list'] = res_paper_dicts
+            context['next_cursor'] = res_paper_list.next_cursor
             response = render(request, 'paper/base_paper_list.html', context)
             return response
         finally:
@@ -390,16 +480,20 @@ def tag_view(request, tag_name):
     context['tag_view'] = True
     context['source'] = 'tag_view'
     context['header_text'] = 'Posts with #' + tag_name
+
+    etag, last_modified = get_list_page_validators(request, (tag_name, ))
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        return set_list_page_headers(response, etag, last_modified)
+
     # Setup connection
     conn = None
     try:
-        status, conn = get_db_connection()
-        if status != SUCCESS:
-            context['error_message'] = err_internal
-            return render(request, 'paper/base_paper_list.html', context)
-
-       # Get search result
-        status, res_paper_list = call_db_with_conn(conn, functions.get_papers_by_tag, {'tag':tag_name})
+        # Get search result and related tags concurrently
+        (status, res_paper_list), (status_related, related_tags) = call_db_concurrently([
+            (functions.get_papers_by_tag, {'tag':tag_name, 'cursor':request.GET.get('cursor')}),
+            (functions.get_related_tags, {'tag':tag_name}),
+        ])
         if status != SUCCESS:
             context['error_message'] = err_internal
             return render(request, 'paper/base_paper_list.html', context)
@@ -408,11 +502,19 @@ def tag_view(request, tag_name):
             context['error_message'] = "No post posted"
             return render(request, 'paper/base_paper_list.html', context)
 
+        status, conn = get_db_connection(replica=True)
+        if status != SUCCESS:
+            context['error_message'] = err_internal
+            return render(request, 'paper/base_paper_list.html', context)
+
         res_paper_dicts = get_paper_dict(res_paper_list)
         append_likes_tags(conn, res_paper_dicts)
+        fragments.render_cards(res_paper_dicts, context['source'], context['username'])
         context['paper_list'] = res_paper_dicts
+        context['next_cursor'] = res_paper_list.next_cursor
+        context['related_tags'] = [x[0] for x in related_tags] if status_related == SUCCESS else []
         response = render(request, 'paper/base_paper_list.html', context)
-        return response
+        return set_list_page_headers(response, etag, last_modified)
     finally:
         if conn is not None:
             close_db_connection(conn)
@@ -429,7 +531,7 @@ def new_paper(request):
     context['new_paper'] = True
     context['header_text'] = "New posts"
 
-   if request.method == 'POST' and request.FILES.get('post_pdf'):
+    if request.method == 'POST' and request.FILES.get('post_pdf'):
         # Setup connection
         conn = None
         try:
@@ -442,7 +544,6 @@ def new_paper(request):
             title = request.POST['title']
             desc = request.POST['desc']
             pdf_file = request.FILES.get('post_pdf')
-            fs = FileSystemStorage()
             # verify input
             if title == "":
                 context['error_message'] = err_invalid_input;
@@ -453,27 +554,37 @@ def new_paper(request):
             # read  tags
             tags_str = request.POST['tags']
             tags = [str(x).strip() for x in str(tags_str).split(',')]
-            # save the uploaded file
-            filename = fs.save(pdf_file.name, pdf_file)
-            file_path = get_upload_dir_path()
-            file_uploaded = file_path + "/" + filename
-            # extract text from pdf
-            text = textract.process(file_uploaded)
+            # save the uploaded file under its content hash, see storage.py
+            sha256, size, file_uploaded = storage.save_upload(pdf_file)
+            # a known file comes with its text, otherwise it is extracted in the background
+            status, text = call_db_with_conn(conn, functions.get_blob_text, {'sha256':sha256})
+            if status != SUCCESS:
+                text = None
+            # an unknown file gets its extraction job with the paper, from the path it is kept at
+            extract_path = storage.blob_path(sha256) if text is None else None
             status, pid = call_db_with_conn(
-                    conn, functions.add_new_paper, {'uname':uname, 'title':title, 'desc':desc, 'text':text, 'tags':tags})
+                    conn, functions.add_new_paper, {'uname':uname, 'title':title, 'desc':desc, 'text':text,
+                                                    'tags':tags, 'blob':(sha256, size),
+                                                    'extract_path':extract_path})
             if status == SUCCESS:
-                try:
-                    os.rename(file_uploaded, get_upload_file_path(pid))
-                except:
-                    print("[Error] Can not move file")
+                stick_to_primary()
+                file_uploaded = storage.keep(sha256, file_uploaded)
+                if file_uploaded is None:
+                    # the paper and its blob row point at a file that does not exist
+                    status, blob = call_db_with_conn(conn, functions.delete_paper, {'pid':pid})
+                    if status == SUCCESS and blob is not None:
+                        storage.release(blob)
+                    context['error_message'] = "Can not upload, try again"
+                    return render(request, 'paper/base_paper_list.html', context)
+                if text is not None:
+                    logger.info("reused extracted text", pid=pid, sha256=sha256)
+                    return home(request)
+                extraction.submit(pid, file_uploaded)
                 return home(request)
             else:
                 context['error_message'] = "Can not upload, try again"
                 # remove the uploaded file
-                try:
-                    os.remove(file_uploaded)
-                except:
-                    pass
+                storage.discard(file_uploaded)
                 return render(request, 'paper/base_paper_list.html', context)
         finally:
             if conn is not None:
@@ -488,27 +599,128 @@ def delete_paper(request, paper_id):
     """
     if not valid_login(request):
         return render(request, 'paper/login.html', {'error_message': err_login})
-    status, res = call_db(functions.delete_paper, {'pid':int(paper_id)})
+    status, blob = call_db(functions.delete_paper, {'pid':int(paper_id)})
     if status == SUCCESS:
-        filename = str(os.path.join(settings.BASE_DIR, 'media')) + "/" + paper_id + ".pdf"
+        stick_to_primary()
+    if status == SUCCESS and blob is not None:
+        # other papers may share the file
+        storage.release(blob)
+    elif status == SUCCESS:
+        filename = get_upload_file_path(paper_id)
         try:
             os.remove(filename)
         except:
-            print("[Error] Can not remove file")
+            logger.warning("can not remove file", path=filename)
     return home(request)
 
 
 def view_paper(request, paper_id):
     """
-    View the pdf file of a paper
+    View the pdf file of a paper.
+    The file is streamed in chunks, single byte ranges are honored and repeat
+    viewers get a 304 from the ETag/Last-Modified validators.
     """
     if not valid_login(request):
         return render(request, 'paper/login.html', {'error_message': err_login})
-    filename = get_upload_file_path(paper_id)
-    with open(filename, 'r') as pdf:
-        response = HttpResponse(pdf.read(), content_type="application/pdf")
-        response['Content-Disposition'] = 'filename=' + paper_id + ".pdf"
+    status, blob = call_db(functions.get_paper_blob, {'pid':int(paper_id)})
+    if status != SUCCESS:
+        raise Http404("No paper %s" % paper_id)
+    filename = storage.blob_path(blob) if blob is not None else get_upload_file_path(paper_id)
+    try:
+        pdf = open(filename, 'rb')
+    except IOError:
+        raise Http404("No pdf for paper %s" % paper_id)
+
+    st = os.fstat(pdf.fileno())
+    size = st.st_size
+    # the content hash never changes, unlike the modification time of a shared file
+    etag = '"%s"' % blob if blob is not None else get_file_etag(st)
+    last_modified = http_date(st.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=int(st.st_mtime))
+    if response is not None:
+        pdf.close()
+        return response
+
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is None or if_range in (etag, last_modified):
+        byte_range = parse_range_header(request.META.get('HTTP_RANGE'), size)
+
+    if byte_range == INVALID_RANGE:
+        pdf.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
         return response
+    if byte_range is None:
+        # FileResponse hands the file to the server's wsgi.file_wrapper (sendfile where supported)
+        response = FileResponse(pdf, content_type="application/pdf")
+        response['Content-Length'] = str(size)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(file_range_iterator(pdf, start, end - start + 1),
+                                         status=206, content_type="application/pdf")
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        response['Content-Length'] = str(end - start + 1)
+    response['Content-Disposition'] = 'filename=' + paper_id + ".pdf"
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    return response
+
+
+def extract_status(request, paper_id):
+    """
+    Report the state of the text extraction of a paper
+    """
+    if not valid_login(request):
+        return JsonResponse({'error': err_login}, status=403)
+    status, job = call_db(functions.get_extract_job, {'pid':int(paper_id)})
+    if status != SUCCESS:
+        return JsonResponse({'error': "No extraction job"}, status=404)
+    return JsonResponse({'pid': job[0], 'state': job[2], 'attempts': job[3], 'error': job[4],
+                         'update_time': str(job[5])})
+
+
+def retry_extract(request, paper_id):
+    """
+    Extract the text of a paper again after a failure, without re-uploading the pdf
+    """
+    if not valid_login(request):
+        return JsonResponse({'error': err_login}, status=403)
+    if request.method != 'POST':
+        return JsonResponse({'error': err_invalid_input}, status=405)
+    status = extraction.retry(int(paper_id))
+    if status != SUCCESS:
+        return JsonResponse({'error': "No failed extraction job"}, status=409)
+    return JsonResponse({'pid': int(paper_id), 'state': EXTRACT_PENDING})
+
+
+def stats(request):
+    """
+    Report the counters of the connection pool, the prepared statements, the result cache,
+    the text cache, the like buffer, the paper cards, the db API calls with their timed
+    sections, the logger and the latest slow calls
+    """
+    if not valid_login(request):
+        return JsonResponse({'error': err_login}, status=403)
+    return JsonResponse({'db_pool': get_pool_stats(), 'statements': statements.get_statement_stats(),
+                         'cache': cache.get_cache_stats(),
+                         'text_cache': text_cache.get_text_cache_stats(),
+                         'like_buffer': like_buffer.get_like_buffer_stats(),
+                         'fragments': fragments.get_fragment_stats(),
+                         'calls': instrumentation.get_call_stats(), 'log': log.get_log_stats(),
+                         'slow_calls': instrumentation.get_slow_calls()})
+
+
+def metrics(request):
+    """
+    Export the latency histograms and counters of the db API calls and of the timed sections
+    to Prometheus. The scraper has to send a login cookie.
+    """
+    if not valid_login(request):
+        return HttpResponse(err_login, status=403, content_type="text/plain")
+    return HttpResponse(instrumentation.get_metrics_text(), content_type="text/plain; version=0.0.4")
 
 
 def like(request, paper_id, source):
@@ -519,16 +731,59 @@ def unlike(request, paper_id, source):
     return like_helper(request, paper_id, source, False)
 
 
+def wants_json(request):
+    """
+    Tell if the client asked for a json response, e.g. a like button using XMLHttpRequest
+    """
+    return request.is_ajax() or 'application/json' in request.META.get('HTTP_ACCEPT', '')
+
+
 def like_helper(request, paper_id, source, like):
+    """
+    Like or unlike a paper. Scripts get a small json result, a plain link is redirected
+    back to the page it came from instead of rendering that page here.
+    """
     if not valid_login(request):
+        if wants_json(request):
+            return JsonResponse({'error': err_login}, status=403)
         return render(request, 'paper/login.html', {'error_message': err_login})
     uname = get_current_user(request)
-    status = SUCCESS
-    res = None
-    if like:
-        status, res = call_db(functions.like_paper, {'uname':uname, 'pid':int(paper_id)})
-    else:
-        status, res = call_db(functions.unlike_paper, {'uname':uname, 'pid':int(paper_id)})
-    err_msg = "Invalid like" if status != SUCCESS else None
-    return popular_papers(request, err_msg) if source == "popular" else home(request, err_msg)
+    pid = int(paper_id)
+
+    if LIKE_WRITE_BEHIND:
+        # Checked and written by the next flush, see like_buffer.py
+        like_buffer.add(uname, pid, like)
+        stick_to_primary()
+        if wants_json(request):
+            return JsonResponse({'pid': pid, 'liked': like, 'queued': True}, status=202)
+        return HttpResponseRedirect(reverse('paper:popular_papers' if source == "popular" else 'paper:home'))
+
+    conn = None
+    try:
+        status, conn = get_db_connection()
+        if status == SUCCESS:
+            status, res = call_db_with_conn(conn, functions.like_paper if like else functions.unlike_paper,
+                                            {'uname':uname, 'pid':pid})
+        if status == SUCCESS:
+            # The pages the user goes back to must show their like
+            stick_to_primary()
+        if status == SUCCESS and wants_json(request):
+            status, count = call_db_with_conn(conn, functions.get_likes, {'pid':pid})
+            return JsonResponse({'pid': pid, 'liked': like, 'like': count if status == SUCCESS else None})
+        if status != SUCCESS and conn is not None:
+            # A retried like, or an unlike of a like already gone, is not an error
+            status_state, state = call_db_with_conn(conn, functions.get_like_state, {'uname':uname, 'pid':pid})
+            if status_state == SUCCESS and not state[2] and state[0] == like:
+                status = SUCCESS
+                if wants_json(request):
+                    return JsonResponse({'pid': pid, 'liked': like, 'like': state[1]})
+    finally:
+        if conn is not None:
+            close_db_connection(conn)
 
+    if wants_json(request):
+        return JsonResponse({'pid': pid, 'error': "Invalid like"}, status=409)
+    if status != SUCCESS:
+        err_msg = "Invalid like"
+        return popular_papers(request, err_msg) if source == "popular" else home(request, err_msg)
+    return HttpResponseRedirect(reverse('paper:popular_papers' if source == "popular" else 'paper:home'))